@@ -0,0 +1,253 @@
+#! /usr/bin/env python
+
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Chooses which SNRs to decode next when sweeping a partition for its k values.
+#
+# The sweep is stateless: each call fits the LP/ZP and HP/ZP k values to the SNRs
+# which have been decoded and sectioned in the partition directory (as get_snr_k.py
+# does) and prints the SNRs to decode next, one per line. Nothing is printed once
+# the sweep is done. run_k_value.sh -A calls it until then, so SNRs decoded by
+# earlier (full or adaptive) runs are reused and an interrupted sweep resumes.
+#
+# The sweep starts with a coarse grid of SNRs between the lower and upper bounds.
+# From then on, the candidate SNRs of the full grid are scored by how much they
+# would shrink the standard errors of the k values. Each error rate e is treated as
+# binomial with variance e (1 - e) / n, n being the number of reference tokens in
+# the section, and the ZP error rate of an SNR not yet decoded is predicted by
+# interpolating the logits of those that have been. The sweep stops once the
+# standard errors of both k values are within a tolerance, no candidate shrinks
+# them, or the maximum number of decodes is reached.
+#
+# Run from the repository root as
+#
+#   python3 -m faetar_dev_kit.boothroyd.adaptive_sweep DIR
+
+import sys
+import argparse
+
+from typing import Optional, Sequence
+
+import numpy as np
+
+from .get_snr_k import HP, LP, ZP, load_edits
+from .kfit import fit_k
+
+
+def snr_grid(low: float, high: float, step: float) -> np.ndarray:
+    """Every SNR a full sweep from low to high (inclusive) would decode"""
+    return np.round(np.arange(low, high + step / 2, step), 6)
+
+
+def coarse_grid(grid: np.ndarray, num: int) -> np.ndarray:
+    """num SNRs of grid spread evenly from its first to its last"""
+    idx = np.round(np.linspace(0, len(grid) - 1, min(num, len(grid)))).astype(int)
+    return grid[np.unique(idx)]
+
+
+def point_terms(
+    x: np.ndarray, k: np.ndarray, n_x: float, n_y: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Jacobian and variance of each point of the fits of y = x**k
+
+    x is of shape (S,), k and n_y of shape (F,) for F fits against the same x.
+    Returns arrays of shape (F, S).
+    """
+    x = np.clip(x, 0.5 / n_x, 1 - 0.5 / n_x)
+    k = k[:, None]
+    y = x**k
+    jac = y * np.log(x)
+    # the variance of y plus that of x, propagated through x**k
+    var = y * (1 - y) / n_y[:, None] + (k * y / x) ** 2 * x * (1 - x) / n_x
+    return jac, var
+
+
+def k_variance(jac: np.ndarray, var: np.ndarray) -> np.ndarray:
+    """Variance of the unweighted least-squares k of each fit (along the last axis)"""
+    return np.sum(jac**2 * var, -1) / np.sum(jac**2, -1) ** 2
+
+
+def predict_error_rates(
+    snrs: np.ndarray, x: np.ndarray, candidates: np.ndarray, n_x: float
+) -> np.ndarray:
+    """Predict the error rates at candidates by interpolating those at snrs"""
+    x = np.clip(x, 0.5 / n_x, 1 - 0.5 / n_x)
+    logit = np.interp(candidates, snrs, np.log(x / (1 - x)))
+    return 1 / (1 + np.exp(-logit))
+
+
+def largest_gap(snrs: np.ndarray, candidates: np.ndarray) -> np.ndarray:
+    """The candidate closest to the middle of the widest gap between snrs"""
+    gaps = np.diff(snrs)
+    mid = snrs[np.argmax(gaps)] + gaps.max() / 2
+    return candidates[[np.argmin(np.abs(candidates - mid))]]
+
+
+def next_snrs(
+    edits: dict[str, np.ndarray],
+    grid: np.ndarray,
+    num_coarse: int = 5,
+    tol: float = 0.05,
+    batch: int = 1,
+    max_decodes: Optional[int] = None,
+) -> tuple[list[float], str]:
+    """The SNRs to decode next and a summary of the state of the sweep
+
+    edits is as returned by get_snr_k.load_edits. An empty list means the sweep is
+    done.
+    """
+    snrs = np.round(edits["snrs"], 6)
+    num_done, num_full = len(snrs), len(grid)
+    summary = f"{num_done} of {num_full} SNRs decoded"
+
+    coarse = np.setdiff1d(coarse_grid(grid, num_coarse), snrs)
+    if len(coarse):
+        return coarse.tolist(), summary + ". Decoding the coarse grid"
+
+    errors, ref_lens = edits["errors"].sum(-1), edits["ref_lens"].sum(-1)
+    rates = errors / np.maximum(ref_lens, 1)
+    # fits of LP and HP against ZP
+    x, y = rates[:, 2], rates[:, [1, 0]].T
+    n_x = max(ref_lens[:, 2].max(), 1)
+    n_y = np.maximum(ref_lens[:, [1, 0]].max(0), 1)
+    k = fit_k(x, y)
+    candidates = np.setdiff1d(grid, snrs)
+    if max_decodes is not None:
+        batch = min(batch, max_decodes - num_done)
+
+    if np.isnan(k).any():
+        summary += ". k cannot be fit yet"
+        if batch <= 0 or not len(candidates):
+            return [], summary + f". Stopping. Saved {num_full - num_done} decodes"
+        return largest_gap(snrs, candidates).tolist(), summary
+
+    jac, var = point_terms(x, k, n_x, n_y)
+    se = np.sqrt(k_variance(jac, var))
+    summary += "; LP/ZP k {:.3f} ± {:.3f}, HP/ZP k {:.3f} ± {:.3f}".format(
+        k[0], se[0], k[1], se[1]
+    )
+    if se.max() <= tol:
+        stop = f"standard errors within {tol}"
+    elif batch <= 0:
+        stop = "maximum number of decodes reached"
+    elif not len(candidates):
+        stop = "every SNR decoded"
+    else:
+        stop = None
+    if stop is not None:
+        return [], f"{summary}. Stopping: {stop}. Saved {num_full - num_done} decodes"
+
+    # greedily add the candidates which shrink the largest standard error the most
+    cand_jac, cand_var = point_terms(
+        predict_error_rates(snrs, x, candidates, n_x), k, n_x, n_y
+    )
+    num, denom = np.sum(jac**2 * var, -1), np.sum(jac**2, -1)
+    current, chosen = se.max(), []
+    for _ in range(min(batch, len(candidates))):
+        new_se = np.sqrt(
+            (num[:, None] + cand_jac**2 * cand_var)
+            / (denom[:, None] + cand_jac**2) ** 2
+        ).max(0)
+        new_se[chosen] = np.inf
+        best = int(np.argmin(new_se))
+        if new_se[best] >= current:
+            break
+        chosen.append(best)
+        num += cand_jac[:, best] ** 2 * cand_var[:, best]
+        denom += cand_jac[:, best] ** 2
+        current = new_se[best]
+    if not chosen:
+        return [], (
+            f"{summary}. Stopping: no SNR left reduces the standard errors. "
+            f"Saved {num_full - num_done} decodes"
+        )
+    return sorted(candidates[chosen].tolist()), summary
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Print the SNRs to decode next in an adaptive k-value sweep"
+    )
+    parser.add_argument(
+        "-L", "--snr-low", type=float, default=-10, help="Lowest SNR (dB) to decode"
+    )
+    parser.add_argument(
+        "-H", "--snr-high", type=float, default=30, help="Highest SNR (dB) to decode"
+    )
+    parser.add_argument(
+        "--step", type=float, default=1, help="Spacing (dB) of the full SNR grid"
+    )
+    parser.add_argument(
+        "-c",
+        "--coarse",
+        type=int,
+        default=5,
+        help="Number of SNRs in the coarse grid decoded first",
+    )
+    parser.add_argument(
+        "-t",
+        "--tol",
+        type=float,
+        default=0.05,
+        help="Stop once the standard errors of the k values are at most this",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=int,
+        default=1,
+        help="Maximum number of SNRs to choose per call",
+    )
+    parser.add_argument(
+        "-m",
+        "--max-decodes",
+        type=int,
+        default=None,
+        help="Stop once this many SNRs have been decoded",
+    )
+    parser.add_argument(
+        "-j",
+        "--num-proc",
+        type=int,
+        default=None,
+        help="Number of processes to align with. Defaults to the number of CPUs",
+    )
+    parser.add_argument("data_dir", help="Directory of snr<snr> directories")
+    options = parser.parse_args(args)
+
+    if options.snr_low > options.snr_high or options.step <= 0:
+        print("Expected -L <= -H and a positive --step", file=sys.stderr)
+        return 1
+    if options.coarse < 2 or options.batch < 1:
+        print("--coarse must be at least 2 and --batch at least 1", file=sys.stderr)
+        return 1
+
+    edits = load_edits(options.data_dir, (HP, LP, ZP), options.num_proc)
+    snrs, summary = next_snrs(
+        edits,
+        snr_grid(options.snr_low, options.snr_high, options.step),
+        options.coarse,
+        options.tol,
+        options.batch,
+        options.max_decodes,
+    )
+    print(summary, file=sys.stderr)
+    for snr in snrs:
+        print(f"{snr:g}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,291 @@
+#! /usr/bin/env python
+
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Adds generated noise to .wav files at any number of signal-to-noise ratios. This
+# replaces add_noise.sh, keeping its definition of the SNR: a file is mixed with the
+# first len(file) samples of one long noise buffer, scaled so that
+#
+#   rms(file) / rms(scaled noise) = 10^(snr / 20)
+#
+# As with add_noise.sh, whose ``sox -m`` halved the file but not the pre-scaled noise,
+# the file is then halved (SOX_MIX_GAIN), so the effective SNR is about 6 dB lower
+# than requested. --true-snr leaves the file as is.
+#
+# Each file is read once and written once per SNR. The noise buffer is generated
+# from a seed and cached, so that reruns produce identical output.
+
+import os
+import sys
+import glob
+import argparse
+import multiprocessing
+
+from typing import Iterator, Optional, Sequence, Union
+
+import numpy as np
+import soundfile
+
+NOISE_TYPES = ("whitenoise", "pinknoise", "brownnoise")
+# the signal gain of 'sox -m', which add_noise.sh mixed with
+SOX_MIX_GAIN = 0.5
+
+
+def generate_noise(noise_type: str, num_samples: int, seed: int = 0) -> np.ndarray:
+    """Generate num_samples of noise in [-1, 1]
+
+    Pink and brown noise are white noise with a 1/f and 1/f^2 power spectrum,
+    respectively.
+    """
+    if noise_type not in NOISE_TYPES:
+        raise ValueError(
+            f"noise_type must be one of {NOISE_TYPES}, got '{noise_type}'"
+        )
+    rng = np.random.default_rng(seed)
+    noise = rng.uniform(-1.0, 1.0, num_samples)
+    if noise_type != "whitenoise" and num_samples > 1:
+        spectrum = np.fft.rfft(noise)
+        freqs = np.arange(1, len(spectrum), dtype=np.float64)
+        power = 0.5 if noise_type == "pinknoise" else 1.0
+        spectrum[0] = 0.0
+        spectrum[1:] /= freqs**power
+        noise = np.fft.irfft(spectrum, num_samples)
+        noise /= max(np.abs(noise).max(), np.finfo(np.float64).tiny)
+    return noise.astype(np.float32)
+
+
+def load_noise(
+    cache_dir: Optional[str],
+    noise_type: str,
+    num_samples: int,
+    seed: int = 0,
+    sampling_rate: int = 16_000,
+) -> np.ndarray:
+    """Generate noise, or memory-map it from cache_dir if it was generated before"""
+    if cache_dir is None:
+        return generate_noise(noise_type, num_samples, seed)
+    pth = os.path.join(
+        cache_dir, f"{noise_type}_seed{seed}_{sampling_rate}hz_{num_samples}.npy"
+    )
+    if not os.path.isfile(pth):
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f"{pth}.{os.getpid()}.npy"
+        np.save(tmp, generate_noise(noise_type, num_samples, seed))
+        os.replace(tmp, pth)
+    return np.load(pth, mmap_mode="r")
+
+
+def rms(x: np.ndarray) -> float:
+    return float(np.sqrt(np.mean(np.square(x, dtype=np.float64)))) if x.size else 0.0
+
+
+def noise_gains(
+    signal_rms: float, noise_rms: float, snrs: Sequence[float]
+) -> np.ndarray:
+    """Factors to scale noise by to mix it with a signal at each of snrs (in dB)"""
+    snrs = np.asarray(snrs, dtype=np.float64)
+    return signal_rms / np.power(10.0, snrs / 20) / noise_rms
+
+
+def mix_at_snrs(
+    signal: np.ndarray,
+    noise: np.ndarray,
+    snrs: Sequence[float],
+    signal_gain: float = 1.0,
+    noise_rms: Optional[float] = None,
+) -> Iterator[np.ndarray]:
+    """Yield signal mixed with the start of noise at each of snrs
+
+    signal is of shape (samples,) or (samples, channels). `signal_gain` scales the
+    signal after the noise gain has been determined; add_noise.sh effectively used
+    0.5, since ``sox -m`` halves its inputs. noise_rms is that of the first
+    len(signal) samples of noise and is computed if unset.
+    """
+    noise = np.asarray(noise[: len(signal)], dtype=np.float32)
+    if len(noise) < len(signal):
+        raise ValueError(
+            f"noise has {len(noise)} samples; expected at least {len(signal)}"
+        )
+    if noise_rms is None:
+        noise_rms = rms(noise)
+    if signal.ndim == 2:
+        noise = noise[:, None]
+    for gain in noise_gains(rms(signal), noise_rms, snrs):
+        yield signal_gain * signal + np.float32(gain) * noise
+
+
+def snr_name(snr: float) -> str:
+    return f"snr{snr:g}"
+
+
+_noise = _noise_energy = None
+
+
+def _init_worker(noise: Union[np.ndarray, str]):
+    global _noise, _noise_energy
+    # a path to cached noise is memory-mapped so workers share its pages
+    _noise = np.load(noise, mmap_mode="r") if isinstance(noise, str) else noise
+    # noise_rms(n) = sqrt(_noise_energy[n] / n) for any file length n
+    _noise_energy = np.concatenate(
+        [[0.0], np.cumsum(np.square(_noise, dtype=np.float64))]
+    )
+
+
+def _add_noise_to_file(args: tuple[str, str, Sequence[float], float, str]) -> str:
+    in_path, out_dir, snrs, signal_gain, subtype = args
+    signal, sampling_rate = soundfile.read(in_path, dtype="float32")
+    n = len(signal)
+    noise_rms = float(np.sqrt(_noise_energy[n] / n)) if n else 1.0
+    filename = os.path.basename(in_path)
+    for snr, mixed in zip(
+        snrs, mix_at_snrs(signal, _noise, snrs, signal_gain, noise_rms)
+    ):
+        soundfile.write(
+            os.path.join(out_dir, snr_name(snr), filename),
+            np.clip(mixed, -1.0, 1.0),
+            sampling_rate,
+            subtype=subtype,
+        )
+    return filename
+
+
+def add_noise(
+    data_dir: str,
+    out_dir: str,
+    snrs: Sequence[float],
+    noise_type: str = "whitenoise",
+    seed: int = 0,
+    bit_depth: int = 16,
+    signal_gain: float = SOX_MIX_GAIN,
+    num_proc: Optional[int] = None,
+    noise_dir: Optional[str] = None,
+) -> int:
+    """Write each .wav in data_dir mixed with noise to out_dir/snr<snr>/ for each snr
+
+    The noise is cached in noise_dir if set. Returns the number of files written per
+    SNR.
+    """
+    in_paths = sorted(glob.glob(os.path.join(glob.escape(data_dir), "*.wav")))
+    if not in_paths:
+        return 0
+    infos = [soundfile.info(pth) for pth in in_paths]
+    sampling_rates = set(info.samplerate for info in infos)
+    if len(sampling_rates) > 1:
+        raise ValueError(
+            f"'{data_dir}' has multiple sampling rates: {sampling_rates}"
+        )
+    noise = load_noise(
+        noise_dir,
+        noise_type,
+        max(info.frames for info in infos),
+        seed,
+        sampling_rates.pop(),
+    )
+    for snr in snrs:
+        os.makedirs(os.path.join(out_dir, snr_name(snr)), exist_ok=True)
+
+    subtype = f"PCM_{bit_depth}"
+    jobs = [(pth, out_dir, snrs, signal_gain, subtype) for pth in in_paths]
+    if num_proc == 1:
+        _init_worker(noise)
+        for job in jobs:
+            _add_noise_to_file(job)
+    else:
+        if isinstance(noise, np.memmap):
+            noise = noise.filename
+        with multiprocessing.Pool(num_proc, _init_worker, (noise,)) as pool:
+            for _ in pool.imap_unordered(_add_noise_to_file, jobs, chunksize=16):
+                pass
+    return len(jobs)
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Add generated noise to .wav files at one or more SNRs"
+    )
+    parser.add_argument(
+        "-n",
+        "--noise-type",
+        choices=NOISE_TYPES,
+        default="whitenoise",
+        help="The type of noise generated",
+    )
+    parser.add_argument(
+        "-b", "--bit-depth", type=int, default=16, help="The bit depth of the output"
+    )
+    parser.add_argument(
+        "-S", "--seed", type=int, default=0, help="The seed the noise is generated from"
+    )
+    parser.add_argument(
+        "-j",
+        "--num-proc",
+        type=int,
+        default=None,
+        help="Number of processes to mix with. Defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "--true-snr",
+        action="store_true",
+        default=False,
+        help="Don't halve the signal after determining the noise gain, as 'sox -m' "
+        "did in add_noise.sh. The SNR is then as requested, and about 6 dB higher "
+        "than that of add_noise.sh",
+    )
+    parser.add_argument(
+        "-d", "--data-dir", required=True, help="The directory of .wav files"
+    )
+    parser.add_argument("-o", "--out-dir", required=True, help="The output directory")
+    parser.add_argument(
+        "-p", "--partition", default="", help="The partition subdirectory"
+    )
+    parser.add_argument(
+        "-N",
+        "--noise-dir",
+        default=None,
+        help="The directory the noise is cached in. Defaults to <out-dir>/noise. The "
+        "cache is keyed by noise type, seed, sampling rate and length, so it can be "
+        "shared by runs with different outputs",
+    )
+    parser.add_argument(
+        "-s",
+        "--snrs",
+        nargs="+",
+        type=float,
+        required=True,
+        help="The signal-to-noise ratios in dB",
+    )
+    options = parser.parse_args(args)
+
+    if not os.path.isdir(options.data_dir):
+        print(f"'{options.data_dir}' is not a directory!", file=sys.stderr)
+        return 1
+
+    num_files = add_noise(
+        options.data_dir,
+        os.path.join(options.out_dir, options.partition),
+        options.snrs,
+        options.noise_type,
+        options.seed,
+        options.bit_depth,
+        1.0 if options.true_snr else SOX_MIX_GAIN,
+        options.num_proc,
+        options.noise_dir or os.path.join(options.out_dir, "noise"),
+    )
+    print(f"Added noise to {num_files} files at {len(options.snrs)} SNRs")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,21 +1,187 @@
-import kenlm
+#! /usr/bin/env python
+
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Scores the sentences of trn files with a KenLM model, writing
+#
+#   <perplexity>\t<sentence>\t(<utt>)
+#
+# for each line of <trn_dir>/<trn> to <trn_dir>/perplexity_<lm file name>.
+#
+# Perplexities are cached in an SQLite database keyed by the SHA-256 of the LM file
+# and the sentence, so only sentences which haven't been scored by the same LM
+# before are scored. Those are split over worker processes, each of which loads the
+# LM once.
+
+# for n gram character based language models use trn_lstm files
+
 import os
 import sys
+import sqlite3
+import hashlib
+import argparse
+import multiprocessing
 
-# for n gram character based language models use trn_lstm files
+from typing import Iterable, Optional, Sequence
+
+HASH_CHUNK_SIZE = 1 << 20
+QUERY_CHUNK_SIZE = 500
+
+
+def hash_lm(lm_file: str, db: sqlite3.Connection) -> str:
+    """SHA-256 of lm_file, cached by its path, size, and modification time"""
+    stat = os.stat(lm_file)
+    key = (os.path.abspath(lm_file), stat.st_size, stat.st_mtime_ns)
+    row = db.execute(
+        "SELECT sha256 FROM lm_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+        key,
+    ).fetchone()
+    if row is not None:
+        return row[0]
+    hash_ = hashlib.sha256()
+    with open(lm_file, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            hash_.update(chunk)
+    sha256 = hash_.hexdigest()
+    db.execute("INSERT OR REPLACE INTO lm_hashes VALUES (?, ?, ?, ?)", key + (sha256,))
+    db.commit()
+    return sha256
+
+
+def open_cache(pth: str) -> sqlite3.Connection:
+    db = sqlite3.connect(pth)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS lm_hashes "
+        "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS perplexities "
+        "(lm TEXT, sentence TEXT, perplexity REAL, PRIMARY KEY (lm, sentence))"
+    )
+    return db
+
+
+def cached_perplexities(
+    db: sqlite3.Connection, lm: str, sentences: Sequence[str]
+) -> dict[str, float]:
+    perps = dict()
+    for i in range(0, len(sentences), QUERY_CHUNK_SIZE):
+        chunk = sentences[i : i + QUERY_CHUNK_SIZE]
+        perps.update(
+            db.execute(
+                "SELECT sentence, perplexity FROM perplexities WHERE lm = ? AND "
+                f"sentence IN ({', '.join('?' * len(chunk))})",
+                (lm, *chunk),
+            )
+        )
+    return perps
+
+
+_model = None
+
+
+def _init_worker(lm_file: str):
+    global _model
+    import kenlm
+
+    _model = kenlm.Model(lm_file)
+
+
+def _score(sentences: Sequence[str]) -> list[tuple[str, float]]:
+    return [(sentence, _model.perplexity(sentence)) for sentence in sentences]
+
+
+def score_sentences(
+    lm_file: str, sentences: Sequence[str], num_proc: Optional[int] = None
+) -> Iterable[tuple[str, float]]:
+    chunks = [
+        sentences[i : i + QUERY_CHUNK_SIZE]
+        for i in range(0, len(sentences), QUERY_CHUNK_SIZE)
+    ]
+    if num_proc == 1:
+        _init_worker(lm_file)
+        for chunk in chunks:
+            yield from _score(chunk)
+        return
+    num_proc = min(num_proc or os.cpu_count() or 1, len(chunks))
+    with multiprocessing.Pool(num_proc, _init_worker, (lm_file,)) as pool:
+        for scores in pool.imap_unordered(_score, chunks):
+            yield from scores
+
+
+def read_trn(trn_file: str) -> list[tuple[str, str]]:
+    with open(trn_file, "r") as f:
+        return [tuple(line.rsplit(maxsplit=1)) for line in f if line.strip()]
+
+
+def perplexity_path(lm_file: str, trn_file: str) -> str:
+    return f"{os.path.dirname(trn_file)}/perplexity_{os.path.basename(lm_file)}"
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Score the sentences of trn files with a KenLM model"
+    )
+    parser.add_argument(
+        "-j",
+        "--num-proc",
+        type=int,
+        default=None,
+        help="Number of processes to score with. Defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "-c",
+        "--cache",
+        default=None,
+        help="SQLite database to cache perplexities in. Defaults to "
+        "'<lm_file>.perplexities.sqlite'",
+    )
+    parser.add_argument("lm_file", help="KenLM model (ARPA or binary)")
+    parser.add_argument("trn_files", nargs="+", help="trn files to score")
+    options = parser.parse_args(args)
+
+    if options.cache is None:
+        options.cache = options.lm_file + ".perplexities.sqlite"
+
+    trns = dict((trn_file, read_trn(trn_file)) for trn_file in options.trn_files)
+    sentences = sorted(set(x[0] for trn in trns.values() for x in trn))
+
+    with open_cache(options.cache) as db:
+        lm = hash_lm(options.lm_file, db)
+        perps = cached_perplexities(db, lm, sentences)
+        unseen = [sentence for sentence in sentences if sentence not in perps]
+        print(
+            f"{len(sentences) - len(unseen)} of {len(sentences)} sentences cached",
+            file=sys.stderr,
+        )
+        if unseen:
+            scores = list(score_sentences(options.lm_file, unseen, options.num_proc))
+            db.executemany(
+                "INSERT OR REPLACE INTO perplexities VALUES (?, ?, ?)",
+                ((lm, sentence, perp) for sentence, perp in scores),
+            )
+            perps.update(scores)
+    db.close()
 
-lm_file_path = sys.argv[1]
-trn_file = sys.argv[2]
+    for trn_file, trn in trns.items():
+        with open(perplexity_path(options.lm_file, trn_file), "w") as out:
+            for sentence, file in trn:
+                out.write(f"{perps[sentence]:.1f}\t{sentence}\t{file}\n")
 
-model = kenlm.Model(lm_file_path)
+    return 0
 
-out_path = f"{os.path.dirname(trn_file)}/perplexity_{os.path.basename(lm_file_path)}"
-out = open(out_path, "w")
 
-with open(trn_file, "r") as f:
-    for line in f:
-        sentence, file = line.rsplit(maxsplit=1)
-        perp = model.perplexity(sentence)
-        out.write(f"{perp:.1f}\t{sentence}\t{file}\n")
-out.close()
-f.close()
+if __name__ == "__main__":
+    sys.exit(main())
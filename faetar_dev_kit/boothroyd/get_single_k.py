@@ -14,47 +14,32 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Computes the Boothroyd k value of one pair of sections, ln(e_ap) / ln(e_zp), where
+# e_ap and e_zp are the error rates of the section with and without (zero)
+# predictability. With --bootstrap N, also a confidence interval of k from N
+# bootstrap replicates of the per-utterance counts of both sections.
+#
+# Run from the repository root as
+#
+#   python3 -m faetar_dev_kit.boothroyd.get_single_k AP_REF AP_HYP ZP_REF ZP_HYP
+
 import sys
 import argparse
 
 import numpy as np
-import jiwer
-
-from pydrobert.torch.data import read_trn_iter
-
-def get_ln_err(ref_file, hyp_file):
-    ref_dict = dict(read_trn_iter(ref_file))
-    empty_refs = set(key for key in ref_dict if not ref_dict[key])
-    if empty_refs:
-        print(
-            "One or more reference transcriptions are empty: "
-            f"{', '.join(empty_refs)}",
-            file=sys.stderr,
-            end="",
-        )
-        return 1
-    keys = sorted(ref_dict)
-    refs = [" ".join(ref_dict[x]) for x in keys]
-    del ref_dict
-
-    hname = hyp_file.name
-    hyp_dict = dict((k, v) for (k, v) in read_trn_iter(hyp_file))
-    if sorted(hyp_dict) != keys:
-        keys_, keys = set(hyp_dict), set(keys)
-        print(
-            f"ref and hyp file '{hname}' have different utterances!",
-            file=sys.stderr,
-        )
-        diff = sorted(keys - keys_)
-        if diff:
-            print(f"Missing from hyp: " + " ".join(diff), file=sys.stderr)
-        diff = sorted(keys_ - keys)
-        if diff:
-            print(f"Missing from ref: " + " ".join(diff), file=sys.stderr)
-        return 1
-    hyps = [" ".join(hyp_dict[x]) for x in keys]
-    er = jiwer.wer(refs, hyps)
-    return(np.log(er))
+
+from .get_snr_k import count_edits
+from .kfit import bootstrap_rates, confidence_interval
+
+
+def section_counts(ref_file: str, hyp_file: str) -> tuple[np.ndarray, ...]:
+    """Utterance ids, errors and reference lengths, shaped like those of edits.npz"""
+    utts, counts = count_edits(ref_file, hyp_file)
+    return (
+        np.array(utts, dtype=str)[None],
+        counts[None, None, :, 0],
+        counts[None, None, :, 1],
+    )
 
 
 def main(args=None):
@@ -62,26 +47,68 @@ def main(args=None):
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
+    parser.add_argument("ref_file", help="The reference trn file")
+    parser.add_argument("hyp_file", help="The hypothesis trn file")
+    parser.add_argument("ref_zp_file", help="The reference zp trn file")
+    parser.add_argument("hyp_zp_file", help="The hypothesis zp trn file")
     parser.add_argument(
-        "ref_file", type=argparse.FileType("r"), help="The reference trn file"
+        "-B",
+        "--bootstrap",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Compute a confidence interval of k from N bootstrap replicates. "
+        "0 disables",
     )
     parser.add_argument(
-        "hyp_file", type=argparse.FileType("r"), help="The hypothesis trn file",
+        "--ci", type=float, default=0.95, help="Confidence level of the interval"
     )
     parser.add_argument(
-        "ref_zp_file", type=argparse.FileType("r"), help="The reference zp trn file"
+        "--group-pattern",
+        default=None,
+        help="Regular expression whose first group (or match) is the recording id of "
+        "an utterance id. If set, recordings rather than utterances are resampled",
     )
     parser.add_argument(
-        "hyp_zp_file", type=argparse.FileType("r"), help="The hypothesis zp trn file",
+        "--seed", type=int, default=0, help="Seed of the bootstrap replicates"
     )
     options = parser.parse_args(args)
 
-    ap_ln_err = get_ln_err(options.ref_file, options.hyp_file)
-    zp_ln_err = get_ln_err(options.ref_zp_file, options.hyp_zp_file)
+    if options.bootstrap < 0 or not 0 < options.ci < 1:
+        print("--bootstrap must be non-negative and --ci in (0, 1)", file=sys.stderr)
+        return 1
+
+    try:
+        ap = section_counts(options.ref_file, options.hyp_file)
+        zp = section_counts(options.ref_zp_file, options.hyp_zp_file)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    ap_err = ap[1].sum() / ap[2].sum()
+    zp_err = zp[1].sum() / zp[2].sum()
+    print("k: " + str(np.log(ap_err) / np.log(zp_err)))
+
+    if options.bootstrap:
+        rates = [
+            bootstrap_rates(
+                errors,
+                ref_lens,
+                utts,
+                options.bootstrap,
+                options.group_pattern,
+                options.seed + i,
+            )[:, 0, 0]
+            for i, (utts, errors, ref_lens) in enumerate((ap, zp))
+        ]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ks = np.log(rates[0]) / np.log(rates[1])
+        ks[~np.isfinite(ks)] = np.nan
+        lo, hi = confidence_interval(ks, options.ci)
+        print(f"k {options.ci:.0%} CI: {lo} {hi}")
 
-    print("k: " + str(ap_ln_err / zp_ln_err))
+    return 0
 
-    exit()
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -14,107 +14,304 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Fits Boothroyd k values to the sections written by section_data.py for each SNR
+# directory (snr<snr>/<section>/{ref,hyp}.trn) in a partition directory.
+#
+# Every section of every SNR is aligned once, in parallel, and the per-utterance
+# error and reference token counts are saved to <partition dir>/edits.npz as
+# (SNR, section, utterance) arrays. Sections have different numbers of utterances;
+# the shorter ones are padded with zero counts, which don't change any error rate.
+# Later runs, and other analyses, load the counts rather than aligning again.
+#
+# With --bootstrap N, confidence intervals of the k values are computed from N
+# bootstrap replicates of those counts (see kfit.py).
+#
+# Run from the repository root as
+#
+#   python3 -m faetar_dev_kit.boothroyd.get_snr_k DIR
+
 import os
+import re
 import sys
+import argparse
+import multiprocessing
+
+from typing import Optional, Sequence
 
 import numpy as np
-import jiwer
 from scipy.optimize import curve_fit
 import matplotlib
-matplotlib.use
+
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 
 from pydrobert.torch.data import read_trn_iter
 
+from ..scoring import edit_counts
+from .kfit import bootstrap_rates, confidence_interval, fit_k
+
+EDITS_FILE = "edits.npz"
+SNR_PATTERN = re.compile(r"^snr(-?\d+(?:\.\d*)?)$")
+HP, LP, ZP = "1", "2", "3"
+
+
 def boothroyd_func(x, k):
     return x**k
 
-def get_err(ref_file, hyp_file):
+
+def count_edits(ref_file: str, hyp_file: str) -> tuple[list[str], np.ndarray]:
+    """Utterance ids and (errors, reference tokens) for each utterance, sorted by id"""
     ref_dict = dict(read_trn_iter(ref_file))
     empty_refs = set(key for key in ref_dict if not ref_dict[key])
     if empty_refs:
-        print(
-            "One or more reference transcriptions are empty: "
-            f"{', '.join(empty_refs)}",
-            file=sys.stderr,
-            end="",
+        raise ValueError(
+            f"One or more reference transcriptions in '{ref_file}' are empty: "
+            f"{', '.join(sorted(empty_refs))}"
         )
-        return 1
     keys = sorted(ref_dict)
-    refs = [" ".join(ref_dict[x]) for x in keys]
-    del ref_dict
-
-    hyp_dict = dict((k, v) for (k, v) in read_trn_iter(hyp_file))
+    hyp_dict = dict(read_trn_iter(hyp_file))
     if sorted(hyp_dict) != keys:
         keys_, keys = set(hyp_dict), set(keys)
-        print(
-            f"ref and hyp file have different utterances!",
-            file=sys.stderr,
-        )
+        msg = f"'{ref_file}' and '{hyp_file}' have different utterances!"
         diff = sorted(keys - keys_)
         if diff:
-            print(f"Missing from hyp: " + " ".join(diff), file=sys.stderr)
+            msg += "\nMissing from hyp: " + " ".join(diff)
         diff = sorted(keys_ - keys)
         if diff:
-            print(f"Missing from ref: " + " ".join(diff), file=sys.stderr)
+            msg += "\nMissing from ref: " + " ".join(diff)
+        raise ValueError(msg)
+    counts = np.zeros((len(keys), 2), dtype=np.int32)
+    counts[:, 0] = edit_counts(
+        [ref_dict[x] for x in keys], [hyp_dict[x] for x in keys]
+    ).sum(1)
+    counts[:, 1] = [len(ref_dict[x]) for x in keys]
+    return keys, counts
+
+
+def _count_edits(args: tuple[str, str]) -> tuple[list[str], np.ndarray]:
+    return count_edits(*args)
+
+
+def list_snr_dirs(
+    data_dir: str, sections: Sequence[str] = ()
+) -> list[tuple[float, str]]:
+    """(snr, path) of each snr<snr> directory in data_dir, in increasing SNR
+
+    Directories missing the ref.trn or hyp.trn of any of sections, such as those of
+    SNRs which haven't been decoded yet, are skipped.
+    """
+    snr_dirs = []
+    for entry in os.scandir(data_dir):
+        match = SNR_PATTERN.match(entry.name)
+        if entry.is_dir() and match is not None:
+            if not all(
+                os.path.isfile(os.path.join(entry.path, section, name))
+                for section in sections
+                for name in ("ref.trn", "hyp.trn")
+            ):
+                continue
+            snr_dirs.append((float(match.group(1)), entry.path))
+    snr_dirs.sort()
+    return snr_dirs
+
+
+def compute_edits(
+    data_dir: str, sections: Sequence[str], num_proc: Optional[int] = None
+) -> dict[str, np.ndarray]:
+    """Align every section of every SNR in data_dir
+
+    Returns a dict of
+
+    - "snrs": (S,) floats
+    - "sections": (C,) section names
+    - "utts": (C, U) utterance ids of each section, "" for padding
+    - "errors", "ref_lens": (S, C, U) per-utterance error and reference token counts
+    """
+    snr_dirs = list_snr_dirs(data_dir, sections)
+    jobs = [
+        (
+            os.path.join(pth, section, "ref.trn"),
+            os.path.join(pth, section, "hyp.trn"),
+        )
+        for _, pth in snr_dirs
+        for section in sections
+    ]
+    with multiprocessing.Pool(num_proc) as pool:
+        results = pool.map(_count_edits, jobs)
+
+    num_snrs, num_sections = len(snr_dirs), len(sections)
+    max_utts = max((len(utts) for utts, _ in results), default=0)
+    utts = np.full((num_sections, max_utts), "", dtype=object)
+    counts = np.zeros((num_snrs, num_sections, max_utts, 2), dtype=np.int32)
+    for idx, (utts_, counts_) in enumerate(results):
+        snr_idx, section_idx = divmod(idx, num_sections)
+        if snr_idx == 0:
+            utts[section_idx, : len(utts_)] = utts_
+        elif list(utts[section_idx][utts[section_idx] != ""]) != list(utts_):
+            raise ValueError(
+                f"section {sections[section_idx]} of '{snr_dirs[snr_idx][1]}' has "
+                f"different utterances than that of '{snr_dirs[0][1]}'"
+            )
+        counts[snr_idx, section_idx, : len(utts_)] = counts_
+    return {
+        "snrs": np.array([snr for snr, _ in snr_dirs]),
+        "sections": np.array(sections),
+        "utts": utts.astype(str),
+        "errors": counts[..., 0],
+        "ref_lens": counts[..., 1],
+    }
+
+
+def edits_are_fresh(edits_file: str, data_dir: str, sections: Sequence[str]) -> bool:
+    """Whether edits_file is newer than every trn file it would be computed from"""
+    if not os.path.isfile(edits_file):
+        return False
+    with np.load(edits_file) as edits:
+        if list(edits["sections"]) != list(sections):
+            return False
+        snrs = list(edits["snrs"])
+    snr_dirs = list_snr_dirs(data_dir, sections)
+    if [snr for snr, _ in snr_dirs] != snrs:
+        return False
+    mtime = os.path.getmtime(edits_file)
+    return all(
+        os.path.getmtime(os.path.join(pth, section, name)) <= mtime
+        for _, pth in snr_dirs
+        for section in sections
+        for name in ("ref.trn", "hyp.trn")
+    )
+
+
+def load_edits(
+    data_dir: str,
+    sections: Sequence[str] = (HP, LP, ZP),
+    num_proc: Optional[int] = None,
+    force: bool = False,
+) -> dict[str, np.ndarray]:
+    """Load the edit counts of data_dir, computing and saving them if need be"""
+    edits_file = os.path.join(data_dir, EDITS_FILE)
+    if not force and edits_are_fresh(edits_file, data_dir, sections):
+        with np.load(edits_file) as edits:
+            return dict(edits)
+    edits = compute_edits(data_dir, sections, num_proc)
+    np.savez_compressed(edits_file, **edits)
+    return edits
+
+
+def error_rates(edits: dict[str, np.ndarray]) -> np.ndarray:
+    """Corpus-level error rates of shape (S, C)"""
+    return edits["errors"].sum(-1) / np.maximum(edits["ref_lens"].sum(-1), 1)
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Fit Boothroyd k values across the SNR directories of a partition"
+    )
+    parser.add_argument(
+        "-j",
+        "--num-proc",
+        type=int,
+        default=None,
+        help="Number of processes to align with. Defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        default=False,
+        help=f"Align again even if {EDITS_FILE} is up-to-date",
+    )
+    parser.add_argument(
+        "-B",
+        "--bootstrap",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Compute confidence intervals of the k values from N bootstrap "
+        "replicates. 0 disables",
+    )
+    parser.add_argument(
+        "--ci",
+        type=float,
+        default=0.95,
+        help="Confidence level of the bootstrap intervals",
+    )
+    parser.add_argument(
+        "--group-pattern",
+        default=None,
+        help="Regular expression whose first group (or match) is the recording id of "
+        "an utterance id. If set, recordings rather than utterances are resampled",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the bootstrap replicates"
+    )
+    parser.add_argument("data_dir", help="Directory of snr<snr> directories")
+    options = parser.parse_args(args)
+
+    if options.bootstrap < 0 or not 0 < options.ci < 1:
+        print("--bootstrap must be non-negative and --ci in (0, 1)", file=sys.stderr)
         return 1
-    hyps = [" ".join(hyp_dict[x]) for x in keys]
-    er = jiwer.wer(refs, hyps)
-    return(er)
-
-data_dir = sys.argv[1]
-zp_errs = []
-lp_errs = []
-hp_errs = []
-
-out_path = os.path.join(data_dir, "results")
-lp_image = os.path.join(data_dir, "lp_zp_graph.png")
-hp_image = os.path.join(data_dir, "hp_zp_graph.png")
-both_image = os.path.join(data_dir, "overlay_graph.png")
-out = open(out_path, "w")
-
-for snr_dir in os.scandir(data_dir):
-        if snr_dir.is_dir():
-            for _, split_dirs, _ in os.walk(snr_dir):
-                for split_dir in split_dirs:
-                    ref_file = os.path.join(snr_dir, split_dir, "ref.trn")
-                    hyp_file = os.path.join(snr_dir, split_dir, "hyp.trn")
-                    if split_dir == "3":
-                        zp_errs.append(get_err(ref_file,hyp_file))
-                    elif split_dir == "2":
-                        lp_errs.append(get_err(ref_file,hyp_file))
-                    elif split_dir == "1":
-                        hp_errs.append(get_err(ref_file,hyp_file))
-
-lz_k = curve_fit(boothroyd_func, xdata= zp_errs, ydata= lp_errs)[0][0]
-hz_k = curve_fit(boothroyd_func, xdata= zp_errs, ydata= hp_errs)[0][0]
-
-out.write(f"LP/ZP k value:\t{lz_k}\n")
-out.write(f"HP/ZP k value:\t{hz_k}\n")
-out.close
-
-plt.figure(figsize = (10,8))
-plt.plot(zp_errs, lp_errs, 'bo')
-xseq = np.linspace(0, 1, num=100)
-plt.plot(xseq, xseq**lz_k, 'r')
-plt.xlabel('ZP error rate')
-plt.ylabel('LP error rate')
-plt.savefig(lp_image)
-
-plt.figure(figsize = (10,8))
-plt.plot(zp_errs, hp_errs, 'b+')
-xseq = np.linspace(0, 1, num=100)
-plt.plot(xseq, xseq**hz_k, 'g')
-plt.xlabel('ZP error rate')
-plt.ylabel('HP error rate')
-plt.savefig(hp_image)
-
-plt.figure(figsize = (20,16))
-plt.plot(zp_errs, lp_errs, 'bo')
-plt.plot(zp_errs, hp_errs, 'b+')
-xseq = np.linspace(0, 1, num=100)
-plt.plot(xseq, xseq**lz_k, 'r')
-plt.plot(xseq, xseq**hz_k, 'g')
-plt.xlabel('ZP error rate')
-plt.ylabel(' error rate')
-plt.savefig(both_image)
\ No newline at end of file
+
+    data_dir = options.data_dir
+    edits = load_edits(data_dir, (HP, LP, ZP), options.num_proc, options.force)
+    rates = error_rates(edits)
+    hp_errs, lp_errs, zp_errs = rates[:, 0], rates[:, 1], rates[:, 2]
+
+    out_path = os.path.join(data_dir, "results")
+    lp_image = os.path.join(data_dir, "lp_zp_graph.png")
+    hp_image = os.path.join(data_dir, "hp_zp_graph.png")
+    both_image = os.path.join(data_dir, "overlay_graph.png")
+
+    lz_k = curve_fit(boothroyd_func, xdata=zp_errs, ydata=lp_errs)[0][0]
+    hz_k = curve_fit(boothroyd_func, xdata=zp_errs, ydata=hp_errs)[0][0]
+
+    with open(out_path, "w") as out:
+        out.write(f"LP/ZP k value:\t{lz_k}\n")
+        out.write(f"HP/ZP k value:\t{hz_k}\n")
+        if options.bootstrap:
+            boot = bootstrap_rates(
+                edits["errors"],
+                edits["ref_lens"],
+                edits["utts"],
+                options.bootstrap,
+                options.group_pattern,
+                options.seed,
+            )
+            # boot is (N, S, C). Fit LP and HP against ZP for every replicate at once
+            ks = fit_k(boot[:, None, :, 2], boot[..., [1, 0]].transpose(0, 2, 1))
+            pct = f"{options.ci:.0%}"
+            for name, k in (("LP/ZP", ks[:, 0]), ("HP/ZP", ks[:, 1])):
+                lo, hi = confidence_interval(k, options.ci)
+                out.write(f"{name} k {pct} CI:\t{lo}\t{hi}\n")
+
+    plt.figure(figsize=(10, 8))
+    plt.plot(zp_errs, lp_errs, "bo")
+    xseq = np.linspace(0, 1, num=100)
+    plt.plot(xseq, xseq**lz_k, "r")
+    plt.xlabel("ZP error rate")
+    plt.ylabel("LP error rate")
+    plt.savefig(lp_image)
+
+    plt.figure(figsize=(10, 8))
+    plt.plot(zp_errs, hp_errs, "b+")
+    xseq = np.linspace(0, 1, num=100)
+    plt.plot(xseq, xseq**hz_k, "g")
+    plt.xlabel("ZP error rate")
+    plt.ylabel("HP error rate")
+    plt.savefig(hp_image)
+
+    plt.figure(figsize=(20, 16))
+    plt.plot(zp_errs, lp_errs, "bo")
+    plt.plot(zp_errs, hp_errs, "b+")
+    xseq = np.linspace(0, 1, num=100)
+    plt.plot(xseq, xseq**lz_k, "r")
+    plt.plot(xseq, xseq**hz_k, "g")
+    plt.xlabel("ZP error rate")
+    plt.ylabel(" error rate")
+    plt.savefig(both_image)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
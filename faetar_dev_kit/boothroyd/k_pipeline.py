@@ -0,0 +1,584 @@
+#! /usr/bin/env python
+
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Computes the k values of run_k_value.sh as a pipeline of hash-keyed steps (see
+# faetar_dev_kit/pipeline.py):
+#
+#   normalize (partition) -> noise (partition, SNR) -> decode (partition, SNR)
+#     [-> beam-search (partition, SNR)] -> section (partition, SNR) -> k (partition)
+#   reference (partition) -> perplexity (partition) -> section
+#
+# Changing e.g. the beam width, a model checkpoint, or an LM reruns only the steps
+# downstream of the change, and outputs computed before are reused if it is changed
+# back. The code run by a step is one of its inputs, too. Partitions and SNRs are
+# processed concurrently, with at most --gpus decodes at a time. The results of each
+# partition are linked to <out_dir>/results/<partition>.
+#
+# With --decode-only, the partitions of -d are decoded as they are, without noise, and
+# the hyp.trn of each is linked instead: the decode and beam-search stages of
+# run_mms_lsah.sh. Training and scoring (evaluate_asr.sh) are left to that script.
+#
+# The noise of every SNR and partition is cached once in <out_dir>/noise_cache, keyed
+# by its type, seed and length. A model is keyed by the files a decode loads
+# (MODEL_FILES), not by everything in its directory. The LM and beam search are run
+# by scripts of the prep submodule, which must be checked out if -l is at least 1.
+#
+# Run from the repository root as
+#
+#   python3 -m faetar_dev_kit.boothroyd.k_pipeline -m exp/mms_lsah_q -d DIR -P FILE
+
+import os
+import sys
+import shutil
+import argparse
+import subprocess
+
+from pathlib import Path
+from typing import Optional, Sequence
+
+from ..pipeline import Runner, Step, run_command
+from .section_data import split_phones
+
+BOOTHROYD = Path(__file__).resolve().parent
+REPO = BOOTHROYD.parents[1]
+MMS = BOOTHROYD.parent / "mms"
+PYTHON = sys.executable
+NGRAM_LM = REPO / "prep" / "ngram_lm.py"
+PYCTCDECODE = REPO / "prep" / "logits-to-trn-via-pyctcdecode.py"
+
+# the files of a model directory which a decode reads. Others, such as token2id or
+# the quantized_<scheme>_<lang>.pt caches written next to them, don't key it
+MODEL_FILES = (
+    "*config.json",
+    "vocab.json",
+    "special_tokens_map.json",
+    "added_tokens.json",
+    "model*.safetensors",
+    "model.safetensors.index.json",
+    "pytorch_model*.bin",
+    "pytorch_model.bin.index.json",
+    "adapter.*",
+)
+
+
+def _snr_name(snr: float) -> str:
+    return f"snr{snr:g}"
+
+
+def model_files(model_dir: Path) -> tuple[Path, ...]:
+    """The files of model_dir matching MODEL_FILES, sorted"""
+    return tuple(
+        sorted(
+            set(
+                pth
+                for pattern in MODEL_FILES
+                for pth in model_dir.glob(pattern)
+                if pth.is_file()
+            )
+        )
+    )
+
+
+class KValueRecipe(object):
+    """Builds the steps of the k values of a model"""
+
+    def __init__(self, options: argparse.Namespace, runner: Runner):
+        self.options, self.runner = options, runner
+        self.cpus = {"cpu": options.step_cpus}
+        self.lm = self.token2id = None
+        if options.lm_ord >= 1:
+            self.token2id = self.token2id_step()
+        if options.lm_ord >= 2:
+            self.lm = self.lm_step(options.lm_ord)
+
+    def _run(self, out: Path, *args):
+        run_command(args, out, cwd=REPO)
+
+    def lm_step(self, order: int) -> Step:
+        script, text = NGRAM_LM, REPO / "etc" / "lm_text.txt"
+
+        def action(out: Path):
+            with open(text) as in_, open(out / "lm.arpa", "w") as out_:
+                subprocess.run(
+                    [PYTHON, str(script), "-o", str(order), "-t", "0", "1"],
+                    stdin=in_,
+                    stdout=out_,
+                    check=True,
+                    cwd=REPO,
+                )
+
+        return Step("lm", action, {"order": order}, (script, text))
+
+    def token2id_step(self) -> Step:
+        vocab = self.options.model / "vocab.json"
+
+        def action(out: Path):
+            self._run(
+                out, PYTHON, "mms.py", "vocab-to-token2id", vocab, out / "token2id"
+            )
+
+        return Step("token2id", action, inputs=(vocab, MMS))
+
+    def normalize_step(self, part: str) -> Step:
+        opts, script = self.options, BOOTHROYD / "normalize_volume.py"
+
+        def action(out: Path):
+            self._run(
+                out,
+                PYTHON,
+                script,
+                "-j",
+                opts.step_cpus,
+                "-d",
+                opts.data / part,
+                "-o",
+                out / "wavs",
+            )
+
+        return Step(
+            "normalize",
+            action,
+            {"partition": part},
+            (opts.data / part, script),
+            (),
+            self.cpus,
+        )
+
+    def reference_step(self, part: str) -> Step:
+        trn = self.options.data / part / "trn"
+
+        def action(out: Path):
+            with open(trn) as in_, open(out / "trn_lstm", "w") as out_:
+                for line in in_:
+                    text, _, utt = line.strip().rpartition(" ")
+                    if utt:
+                        out_.write(f"{split_phones(text)} {utt}\n")
+
+        return Step(
+            "reference",
+            action,
+            {"partition": part},
+            (trn, BOOTHROYD / "section_data.py"),
+        )
+
+    def perplexity_step(self, part: str, reference: Step) -> Step:
+        opts, runner = self.options, self.runner
+        script = BOOTHROYD / "get_perplexity.py"
+        # the LM used in decoding if -P isn't a file
+        lm = opts.perplexity_lm if opts.perplexity_lm.is_file() else None
+        deps = (reference,) if lm is not None else (reference, self.lm)
+
+        def action(out: Path):
+            lm_ = lm if lm is not None else runner.path(self.lm) / "lm.arpa"
+            shutil.copy(runner.path(reference) / "trn_lstm", out / "trn_lstm")
+            self._run(
+                out,
+                PYTHON,
+                script,
+                "-j",
+                opts.step_cpus,
+                "-c",
+                opts.out_dir / "perplexities.sqlite",
+                lm_,
+                out / "trn_lstm",
+            )
+            os.replace(out / f"perplexity_{os.path.basename(lm_)}", out / "perplexity")
+
+        inputs = (script,) if lm is None else (script, lm)
+        return Step("perplexity", action, {"partition": part}, inputs, deps, self.cpus)
+
+    def noise_step(self, part: str, snr: float, normalize: Step) -> Step:
+        opts, runner = self.options, self.runner
+        script = BOOTHROYD / "add_noise.py"
+
+        def action(out: Path):
+            self._run(
+                out,
+                PYTHON,
+                script,
+                "-j",
+                opts.step_cpus,
+                "-n",
+                opts.noise_type,
+                "-S",
+                opts.noise_seed,
+                "-d",
+                runner.path(normalize) / "wavs",
+                "-o",
+                out,
+                "-N",
+                opts.out_dir / "noise_cache",
+                "-s",
+                snr,
+            )
+            os.replace(out / _snr_name(snr), out / "wavs")
+
+        params = {
+            "partition": part,
+            "snr": snr,
+            "noise_type": opts.noise_type,
+            "seed": opts.noise_seed,
+        }
+        return Step("noise", action, params, (script,), (normalize,), self.cpus)
+
+    def decode_step(
+        self, part: str, snr: Optional[float], noise: Optional[Step]
+    ) -> Step:
+        """Decode the noisy wavs of noise, or the partition itself if noise is None"""
+        opts, runner = self.options, self.runner
+        greedy = opts.lm_ord == 0
+        inputs = model_files(opts.model) + (MMS,)
+        if noise is None:
+            inputs += (opts.data / part,)
+
+        def action(out: Path):
+            wavs = opts.data / part if noise is None else runner.path(noise) / "wavs"
+            if greedy:
+                self._run(
+                    out,
+                    PYTHON,
+                    "mms.py",
+                    "decode",
+                    opts.model,
+                    wavs,
+                    out / "greedy.csv",
+                )
+                self._run(
+                    out,
+                    PYTHON,
+                    "mms.py",
+                    "metadata-to-trn",
+                    out / "greedy.csv",
+                    out / "hyp.trn",
+                )
+            else:
+                self._run(
+                    out,
+                    PYTHON,
+                    "mms.py",
+                    "decode",
+                    "--logits-dir",
+                    out / "logits",
+                    opts.model,
+                    wavs,
+                    out / "greedy.csv",
+                )
+
+        return Step(
+            "decode",
+            action,
+            {"partition": part, "snr": snr, "greedy": greedy},
+            inputs,
+            () if noise is None else (noise,),
+            {"cpu": 1, "gpu": 1},
+        )
+
+    def beam_search_step(self, part: str, snr: Optional[float], decode: Step) -> Step:
+        opts, runner = self.options, self.runner
+        script = PYCTCDECODE
+        words = REPO / "etc" / "lm_words.txt"
+        # as in run_k_value.sh, there's no LM to weigh with -l 1
+        alpha_inv, beta = (1, 1) if opts.lm_ord == 1 else (opts.alpha_inv, opts.beta)
+        deps = (decode, self.token2id) + ((self.lm,) if self.lm is not None else ())
+
+        def action(out: Path):
+            lm_args = ["--lm", runner.path(self.lm) / "lm.arpa"] if self.lm else []
+            self._run(
+                out,
+                PYTHON,
+                script,
+                "--char",
+                *lm_args,
+                "--words",
+                words,
+                "--width",
+                opts.width,
+                "--beta",
+                beta,
+                "--alpha-inv",
+                alpha_inv,
+                "--token2id",
+                runner.path(self.token2id) / "token2id",
+                runner.path(decode) / "logits",
+                out / "hyp.trn",
+            )
+
+        params = {
+            "partition": part,
+            "snr": snr,
+            "width": opts.width,
+            "alpha_inv": alpha_inv,
+            "beta": beta,
+        }
+        return Step("beam-search", action, params, (script, words), deps)
+
+    def section_step(self, part: str, snr: float, perplexity: Step, hyp: Step) -> Step:
+        script, runner = BOOTHROYD / "section_data.py", self.runner
+
+        def action(out: Path):
+            self._run(
+                out,
+                PYTHON,
+                script,
+                runner.path(perplexity) / "perplexity",
+                "3",
+                runner.path(hyp) / "hyp.trn",
+                out,
+            )
+
+        params = {"partition": part, "snr": snr}
+        return Step("section", action, params, (script,), (perplexity, hyp))
+
+    def k_step(self, part: str, sections: dict[float, Step]) -> Step:
+        opts, runner = self.options, self.runner
+        scripts = (
+            BOOTHROYD / "get_snr_k.py",
+            BOOTHROYD / "kfit.py",
+            BOOTHROYD.parent / "scoring.py",
+        )
+
+        def action(out: Path):
+            for snr, section in sections.items():
+                (out / _snr_name(snr)).symlink_to(runner.path(section), True)
+            self._run(
+                out,
+                PYTHON,
+                "-m",
+                "faetar_dev_kit.boothroyd.get_snr_k",
+                "-j",
+                opts.step_cpus,
+                "--bootstrap",
+                opts.bootstrap,
+                out,
+            )
+
+        params = {"partition": part, "bootstrap": opts.bootstrap}
+        return Step("k", action, params, scripts, tuple(sections.values()), self.cpus)
+
+    def hyp_step(
+        self, part: str, snr: Optional[float] = None, noise: Optional[Step] = None
+    ) -> Step:
+        """The step writing hyp.trn: a greedy decode, or a beam search of its logits"""
+        hyp = self.decode_step(part, snr, noise)
+        if self.options.lm_ord >= 1:
+            hyp = self.beam_search_step(part, snr, hyp)
+        return hyp
+
+    def partition_steps(self, part: str) -> Step:
+        """The k step of part, upstream of all the others"""
+        normalize = self.normalize_step(part)
+        perplexity = self.perplexity_step(part, self.reference_step(part))
+        sections = dict()
+        for snr in self.options.snrs:
+            hyp = self.hyp_step(part, snr, self.noise_step(part, snr, normalize))
+            sections[snr] = self.section_step(part, snr, perplexity, hyp)
+        return self.k_step(part, sections)
+
+    def steps(self) -> dict[str, Step]:
+        """The k step of each partition, or its hyp step if --decode-only"""
+        if self.options.decode_only:
+            return dict((part, self.hyp_step(part)) for part in self.options.partitions)
+        return dict(
+            (part, self.partition_steps(part)) for part in self.options.partitions
+        )
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Determine the k values of a model as a pipeline of cached steps"
+    )
+    parser.add_argument(
+        "-m",
+        "--model",
+        type=Path,
+        default=Path("exp/mms_lsah_q"),
+        help="The model directory",
+    )
+    parser.add_argument(
+        "-d", "--data", type=Path, required=True, help="The data directory"
+    )
+    parser.add_argument(
+        "-P",
+        "--perplexity-lm",
+        type=Path,
+        default=Path(""),
+        help="The language model used to calculate the perplexity. Defaults to the "
+        "decoding LM if -l is at least 2",
+    )
+    parser.add_argument(
+        "-o",
+        "--out-dir",
+        type=Path,
+        default=Path("data/boothroyd/pipeline"),
+        help="The directory of step outputs and results",
+    )
+    parser.add_argument(
+        "-p",
+        "--partitions",
+        nargs="+",
+        default=["dev", "test", "train"],
+        help="The partitions to determine k values of",
+    )
+    parser.add_argument(
+        "-L", "--snr-low", type=int, default=-10, help="The lowest SNR (dB)"
+    )
+    parser.add_argument(
+        "-H", "--snr-high", type=int, default=30, help="The highest SNR (dB)"
+    )
+    parser.add_argument(
+        "-s",
+        "--snrs",
+        nargs="+",
+        type=float,
+        default=None,
+        help="The SNRs (dB) to decode. Defaults to every integer from -L to -H",
+    )
+    parser.add_argument(
+        "--noise-type", default="whitenoise", help="The type of noise added"
+    )
+    parser.add_argument(
+        "--noise-seed", type=int, default=0, help="The seed the noise is generated from"
+    )
+    parser.add_argument("-w", "--width", type=int, default=100, help="Beam width")
+    parser.add_argument(
+        "-a", "--alpha-inv", type=int, default=1, help="pyctcdecode's alpha, inverted"
+    )
+    parser.add_argument(
+        "-B", "--beta", type=float, default=1, help="pyctcdecode's beta"
+    )
+    parser.add_argument(
+        "-l",
+        "--lm-ord",
+        type=int,
+        default=0,
+        help="n-gram LM order. 0 is greedy; 1 is prefix with no LM",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Bootstrap replicates of the k value confidence intervals",
+    )
+    parser.add_argument(
+        "-j",
+        "--cpus",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="CPUs to share between concurrent steps",
+    )
+    parser.add_argument(
+        "-g", "--gpus", type=int, default=1, help="Number of decodes run at once"
+    )
+    parser.add_argument(
+        "--step-cpus",
+        type=int,
+        default=4,
+        help="Processes used by each step which can use more than one",
+    )
+    parser.add_argument(
+        "--decode-only",
+        action="store_true",
+        default=False,
+        help="Decode the partitions without noise, as run_mms_lsah.sh does, rather "
+        "than determine k values",
+    )
+    parser.add_argument(
+        "-n",
+        "--dry-run",
+        action="store_true",
+        default=False,
+        help="List the steps which would be run, but don't run them",
+    )
+    options = parser.parse_args(args)
+
+    # steps run from the repository root
+    for name in ("model", "data", "perplexity_lm", "out_dir"):
+        setattr(options, name, getattr(options, name).absolute())
+    if options.snrs is None:
+        options.snrs = [float(x) for x in range(options.snr_low, options.snr_high + 1)]
+    if not (options.model / "config.json").is_file():
+        print(
+            f"'{options.model}' has no config.json! set -m appropriately!",
+            file=sys.stderr,
+        )
+        return 1
+    prep = (PYCTCDECODE,) * (options.lm_ord >= 1) + (NGRAM_LM,) * (options.lm_ord >= 2)
+    for script in prep:
+        if not script.is_file():
+            print(
+                f"'{script}' does not exist! initialize the prep submodule with "
+                "'git submodule update --init --remote prep'",
+                file=sys.stderr,
+            )
+            return 1
+    for part in options.partitions:
+        if not (options.data / part / "trn").is_file():
+            print(
+                f"'{options.data / part}' has no trn file! set -d appropriately!",
+                file=sys.stderr,
+            )
+            return 1
+    if (
+        not options.decode_only
+        and not options.perplexity_lm.is_file()
+        and options.lm_ord < 2
+    ):
+        print(
+            f"'{options.perplexity_lm}' is not a file! set -P appropriately, or -l "
+            "to be greater than 1 to use the decoding LM",
+            file=sys.stderr,
+        )
+        return 1
+    if (
+        min(
+            options.width,
+            options.alpha_inv,
+            options.cpus,
+            options.gpus,
+            options.step_cpus,
+        )
+        < 1
+    ):
+        print(
+            "-w, -a, -j, -g, and --step-cpus must be natural numbers", file=sys.stderr
+        )
+        return 1
+
+    runner = Runner(options.out_dir, {"cpu": options.cpus, "gpu": options.gpus})
+    try:
+        targets = KValueRecipe(options, runner).steps()
+        plan = runner.plan(targets.values())
+        if options.dry_run:
+            for step in plan:
+                print(step.label)
+            print(f"{len(plan)} steps to run", file=sys.stderr)
+            return 0
+        failed = runner.run(targets.values())
+        for part, step in targets.items():
+            if runner.is_done(step):
+                runner.link(step, options.out_dir / "results" / part)
+                name = "hyp.trn" if options.decode_only else "results"
+                print(f"{part}: {options.out_dir / 'results' / part / name}")
+    finally:
+        runner.close()
+    if failed:
+        print(f"{failed} steps failed or were skipped", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
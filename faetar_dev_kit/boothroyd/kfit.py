@@ -0,0 +1,129 @@
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Fitting and bootstrapping Boothroyd k values with NumPy alone.
+#
+# A bootstrap replicate resamples utterances with replacement within each section,
+# or, given a pattern extracting a recording id from each utterance id, resamples
+# recordings (and all of their utterances in the section) instead. A replicate is
+# represented by how many times each utterance was drawn, so the error rates of all
+# replicates are a single matrix product with the per-utterance counts saved by
+# get_snr_k.py.
+
+import re
+
+from typing import Optional, Sequence
+
+import numpy as np
+
+GAUSS_NEWTON_ITERS = 50
+
+
+def fit_k(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    """Least-squares fit of y = x**k along the last axis, batched over the others
+
+    Equivalent to scipy.optimize.curve_fit(lambda x, k: x**k, x, y) for each batch
+    element. k is initialized with the closed-form fit of log y = k log x and refined
+    with Gauss-Newton steps. Returns NaN where no point has 0 < x < 1.
+    """
+    x, y = np.broadcast_arrays(np.asarray(x, np.float64), np.asarray(y, np.float64))
+    inside = (x > 0) & (x < 1)
+    log_x = np.log(np.where(inside, x, 0.5))
+    log_y = np.log(np.clip(y, 1e-12, None))
+    denom = np.sum(np.where(inside, log_x**2, 0), -1)
+    k = np.sum(np.where(inside, log_x * log_y, 0), -1) / np.where(denom, denom, 1)
+    k = np.maximum(k, 1e-3)
+    for _ in range(GAUSS_NEWTON_ITERS):
+        x_k = np.where(x > 0, x, 0) ** k[..., None]
+        # the derivative of x**k with respect to k is zero at x = 0 and x = 1
+        jac = np.where(inside, x_k * log_x, 0)
+        jtj = np.sum(jac**2, -1)
+        step = np.sum(jac * (x_k - y), -1) / np.where(jtj, jtj, 1)
+        k = np.maximum(k - step, 1e-6)
+        if np.all(np.abs(step) <= 1e-10 * np.maximum(np.abs(k), 1)):
+            break
+    return np.where(denom > 0, k, np.nan)
+
+
+def group_ids(utts: Sequence[str], group_pattern: Optional[str] = None) -> np.ndarray:
+    """Integer ids of the recordings of utts
+
+    If group_pattern is unset, each utterance is its own recording. Otherwise, the
+    recording id of an utterance is the first group of the pattern's match in it,
+    or the whole match if it has no groups.
+    """
+    if group_pattern is None:
+        return np.arange(len(utts))
+    pattern = re.compile(group_pattern)
+    recordings = []
+    for utt in utts:
+        match = pattern.search(utt)
+        if match is None:
+            raise ValueError(f"'{group_pattern}' does not match utterance '{utt}'")
+        recordings.append(match.group(1) if pattern.groups else match.group(0))
+    return np.unique(recordings, return_inverse=True)[1].reshape(-1)
+
+
+def resample_weights(
+    groups: np.ndarray, num_replicates: int, rng: np.random.Generator
+) -> np.ndarray:
+    """Times each utterance is drawn in each of num_replicates bootstrap replicates
+
+    Returns an array of shape (num_replicates, len(groups)).
+    """
+    num_groups = int(groups.max()) + 1 if len(groups) else 0
+    if not num_groups:
+        return np.zeros((num_replicates, 0), dtype=np.int64)
+    draws = rng.multinomial(
+        num_groups, np.full(num_groups, 1 / num_groups), size=num_replicates
+    )
+    return draws[:, groups]
+
+
+def bootstrap_rates(
+    errors: np.ndarray,
+    ref_lens: np.ndarray,
+    utts: np.ndarray,
+    num_replicates: int,
+    group_pattern: Optional[str] = None,
+    seed: int = 0,
+) -> np.ndarray:
+    """Error rates of bootstrap replicates of per-utterance counts
+
+    errors and ref_lens are of shape (S, C, U), utts of shape (C, U), with "" for
+    padding, as saved by get_snr_k.py. Utterances are resampled within each section.
+    The same resampled utterances are used for every SNR (the first axis). Returns
+    an array of shape (num_replicates, S, C).
+    """
+    rng = np.random.default_rng(seed)
+    num_snrs, num_sections, _ = errors.shape
+    rates = np.empty((num_replicates, num_snrs, num_sections))
+    for c in range(num_sections):
+        valid = utts[c] != ""
+        weights = resample_weights(
+            group_ids(list(utts[c][valid]), group_pattern), num_replicates, rng
+        )
+        errs = weights @ errors[:, c, valid].T
+        refs = weights @ ref_lens[:, c, valid].T
+        rates[:, :, c] = errs / np.maximum(refs, 1)
+    return rates
+
+
+def confidence_interval(
+    samples: np.ndarray, confidence: float = 0.95
+) -> tuple[float, float]:
+    """Percentile interval of samples, ignoring NaNs"""
+    alpha = (1 - confidence) / 2
+    lo, hi = np.nanquantile(samples, [alpha, 1 - alpha])
+    return float(lo), float(hi)
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Normalizes the volume of .wav files to a reference level. This replaces
+# normalize_data_volume.sh and keeps its semantics: each file is scaled so that its
+# RMS amplitude is pref * 10^(l0 / 20), then shifted so that its mean amplitude is 0.
+#
+# Each output file is written under a temporary name and renamed once complete, so an
+# output file which exists is complete and an interrupted run can be resumed by
+# running it again.
+
+import os
+import sys
+import glob
+import argparse
+import multiprocessing
+
+from typing import Optional, Sequence
+
+import numpy as np
+import soundfile
+
+
+def target_rms(pref: float, l0: float) -> float:
+    return pref * 10 ** (l0 / 20)
+
+
+def normalize_volume(signal: np.ndarray, target: float) -> np.ndarray:
+    """Scale signal to an RMS of target, then remove its DC offset"""
+    x = signal.astype(np.float64)
+    rms = np.sqrt(np.mean(np.square(x))) if x.size else 0.0
+    if rms == 0.0:
+        return signal
+    gain = target / rms
+    # the mean after scaling is gain times the mean before it
+    return (gain * x - gain * x.mean(0)).astype(signal.dtype)
+
+
+def _normalize_file(args: tuple[str, str, float, str]) -> bool:
+    in_path, out_path, target, subtype = args
+    if os.path.exists(out_path):
+        return False
+    signal, sampling_rate = soundfile.read(in_path, dtype="float32")
+    tmp = f"{out_path}.{os.getpid()}.tmp"
+    soundfile.write(
+        tmp,
+        np.clip(normalize_volume(signal, target), -1.0, 1.0),
+        sampling_rate,
+        subtype=subtype,
+        format="WAV",
+    )
+    os.replace(tmp, out_path)
+    return True
+
+
+def normalize_dir(
+    data_dir: str,
+    out_dir: str,
+    pref: float = 0.00001,
+    l0: float = 70,
+    bit_depth: int = 16,
+    num_proc: Optional[int] = None,
+) -> tuple[int, int]:
+    """Normalize each .wav in data_dir into out_dir
+
+    Returns the number of files normalized and the number skipped because they had
+    been already.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    target, subtype = target_rms(pref, l0), f"PCM_{bit_depth}"
+    jobs = [
+        (pth, os.path.join(out_dir, os.path.basename(pth)), target, subtype)
+        for pth in sorted(glob.glob(os.path.join(glob.escape(data_dir), "*.wav")))
+    ]
+    if num_proc == 1:
+        written = list(map(_normalize_file, jobs))
+    else:
+        with multiprocessing.Pool(num_proc) as pool:
+            written = list(pool.imap_unordered(_normalize_file, jobs, chunksize=16))
+    return sum(written), len(written) - sum(written)
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Normalize volume of .wav files to a given reference amplitude + "
+        "dB level"
+    )
+    parser.add_argument(
+        "-p", "--pref", type=float, default=0.00001, help="The reference amplitude"
+    )
+    parser.add_argument(
+        "-l", "--l0", type=float, default=70, help="The reference level (dB)"
+    )
+    parser.add_argument(
+        "-b", "--bit-depth", type=int, default=16, help="The bit depth of the output"
+    )
+    parser.add_argument(
+        "-j",
+        "--num-proc",
+        type=int,
+        default=None,
+        help="Number of processes to normalize with. Defaults to the number of CPUs",
+    )
+    parser.add_argument(
+        "-d", "--data-dir", required=True, help="The directory of .wav files"
+    )
+    parser.add_argument("-o", "--out-dir", required=True, help="The output directory")
+    options = parser.parse_args(args)
+
+    if not os.path.isdir(options.data_dir):
+        print(f"'{options.data_dir}' is not a directory!", file=sys.stderr)
+        return 1
+
+    written, skipped = normalize_dir(
+        options.data_dir,
+        options.out_dir,
+        options.pref,
+        options.l0,
+        options.bit_depth,
+        options.num_proc,
+    )
+    print(f"Normalized {written} files ({skipped} already were)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,10 +10,14 @@
 export PYTHONUTF8=1
 [ -f "path.sh" ] && . "path.sh"
 
-usage="Usage: $0 [-h] [-p] [-D] [-S INT] [-m DIR] [-d DIR] [-P FILE] [-o DIR] [-n DIR] [-N DIR] [-L INT] [-H INT] 
+usage="Usage: $0 [-h] [-p] [-D] [-r] [-M] [-A] [-t REAL] [-S INT] [-m DIR] [-d DIR] [-P FILE] [-o DIR] [-n DIR] [-N DIR] [-L INT] [-H INT] 
 [-w NAT] [-a NAT] [-B NAT] [-l NAT]"
 pointwise=false
 delete_wavs=false
+serve=false
+in_memory=false
+adaptive=false
+tol=0.05
 point_snr=
 model=exp/mms_lsah_q
 data=
@@ -34,6 +38,14 @@ Options
     -h          Display this help message and exit
     -p          Determine the k-value at a for a specific SNR
     -D          Deletes the wav files in the noise dir after decoding (default: '$delete_wavs')
+    -r          Keep the model loaded in a decode server ('mms.py serve') rather
+                than loading it for every decode (default: '$serve')
+    -M          Mix noise into the audio in memory while decoding ('mms.py
+                decode-noisy') rather than writing noisy wav files (default: '$in_memory')
+    -A          Sweep SNRs adaptively ('adaptive_sweep.py'), decoding a coarse grid
+                and then only the SNRs which best narrow the fits of k until
+                their standard errors are within -t (default: '$adaptive')
+    -t REAL     The tolerance of the standard errors of k if -A is set (default: '$tol')
     -s INT      The SNR (in dB) used if -p is set to true (default: '$point_snr')
     -m DIR/{lstm, mms_lsah, mms_lsah_q}
                 The model directory (default: '$model')
@@ -50,7 +62,7 @@ Options
     -B NAT      pyctcdecode's beta (default: $beta)
     -l NAT      n-gram LM order. 0 is greedy; 1 is prefix with no LM (default: $lm_ord)"
 
-while getopts "hpDs:m:d:P:o:n:N:L:H:w:a:B:l:" name; do
+while getopts "hpDrMAt:s:m:d:P:o:n:N:L:H:w:a:B:l:" name; do
     case $name in
         h)
             echo "$usage"
@@ -61,6 +73,14 @@ while getopts "hpDs:m:d:P:o:n:N:L:H:w:a:B:l:" name; do
             pointwise=true;;
         D)
             delete_wavs=true;;
+        r)
+            serve=true;;
+        M)
+            in_memory=true;;
+        A)
+            adaptive=true;;
+        t)
+            tol="$OPTARG";;
         s)
             point_snr="$OPTARG";;
         m)
@@ -152,6 +172,10 @@ if (( "$(bc -l <<< "$beta < 0")" )); then
     echo -e "$beta is not greater than 0! set -B appropriately!"
     exit 1
 fi
+if ! [[ "$tol" =~ ^[0-9]*\.?[0-9]+$ ]] 2> /dev/null; then
+    echo -e "$tol is not a positive real number! set -t appropriately!"
+    exit 1
+fi
 if ! [ "$lm_ord" -ge 0 ] 2> /dev/null; then
     echo -e "$lm_ord is not a non-negative int! set -l appropriately!"
     exit 1
@@ -176,10 +200,226 @@ function split_text() {
     mv "$file"{_,}
 }
 
+function mms_decode() {
+    if $serve; then
+        python3 ./mms.py client --socket "$out_dir/mms.sock" "$@"
+    else
+        python3 ./mms.py decode "$model" "$@"
+    fi
+}
+
+function is_decoded() {
+    # whether the transcription of partition $1 at SNR $2 exists
+    [ -f "$model/k_decode/${1}/${name}/snr${2}_${name}.trn" ]
+}
+
+function greedy_from_logits() {
+    # greedily transcribe partition $1 at SNR $2 from the logits dumped by an
+    # earlier beam search, if there are any, instead of running the model again
+    local part="$1" snr="$2"
+    local logits="$model/k_decode/logits/${part}_snr${snr}"
+    local trn="$model/k_decode/${part}/${name}/snr${snr}_${name}.trn"
+    if is_decoded "$part" "$snr" || ! [ -f "$logits/.done" ]; then
+        return
+    fi
+    if ! [ -f "$model/token2id" ]; then
+        echo "Constructing '$model/token2id'"
+        python3 ./mms.py vocab-to-token2id "$model/"{vocab.json,token2id}
+    fi
+    echo "Greedily decoding logits of '$logits'"
+    mkdir -p "$model/k_decode/${part}/${name}"
+    python3 ./logits-to-trn-via-torchctcdecode.py \
+        --greedy --char --token2id "$model/token2id" "$logits" "${trn}_"
+    mv "$trn"{_,}
+}
+
+function add_noise_snrs() {
+    # add noise to partition $1 at every SNR after it which needs it in one pass
+    local part="$1" snr snrs=( )
+    shift
+    for snr in "$@"; do
+        local spart="$out_dir/$noise_wavs_out_dir/$part/snr${snr}"
+        if ! is_decoded "$part" "$snr" && \
+                ! [[ -f "$spart/.done_noise" || -f "$spart/.done_split" ]]; then
+            snrs+=( "$snr" )
+        fi
+    done
+    if [ ${#snrs[@]} -gt 0 ]; then
+        python3 "$boothroyd"/add_noise.py -d "$out_dir/$norm_wavs_out_dir/$part" \
+            -o "$out_dir/$noise_wavs_out_dir" -p "$part" -s "${snrs[@]}"
+        for snr in "${snrs[@]}"; do
+            touch "$out_dir/$noise_wavs_out_dir/$part/snr${snr}/.done_noise"
+        done
+    fi
+}
+
+function decode_noisy_snrs() {
+    # decode partition $1 at every SNR after it not yet decoded with one model load
+    local part="$1" snr snrs=( )
+    shift
+    for snr in "$@"; do
+        if ! is_decoded "$part" "$snr"; then
+            snrs+=( "$snr" )
+        fi
+    done
+    if [ ${#snrs[@]} -eq 0 ]; then
+        return
+    fi
+    if [ "$lm_ord" = 0 ]; then
+        mkdir -p "$model/k_decode/$part/$name"
+        python3 ./mms.py decode-noisy --snrs "${snrs[@]}" \
+            "$model" "$out_dir/$norm_wavs_out_dir/$part" \
+            "$model/k_decode/${part}/${name}/snr{snr}_${name}.csv"
+    else
+        mkdir -p "$model/k_decode/logits"
+        python3 ./mms.py decode-noisy --snrs "${snrs[@]}" \
+            --logits-dir "$model/k_decode/logits/${part}_snr{snr}" \
+            "$model" "$out_dir/$norm_wavs_out_dir/$part" \
+            "$model/k_decode/logits/${part}_snr{snr}/greedy.csv"
+        for snr in "${snrs[@]}"; do
+            touch "$model/k_decode/logits/${part}_snr${snr}/.done"
+        done
+    fi
+}
+
+function decode_snr() {
+    # decode partition $1 at SNR $2, queueing the transcription for sectioning
+    local part="$1" snr="$2"
+    local spart="$out_dir/$noise_wavs_out_dir/$part/snr${snr}"
+    mkdir -p "$spart"
+    if ! $in_memory && ! is_decoded "$part" "$snr" && \
+            ! [[ -f "$spart/.done_noise" || -f "$spart/.done_split" ]]; then
+        python3 "$boothroyd"/add_noise.py -d "$out_dir/$norm_wavs_out_dir/$part" \
+            -o "$out_dir/$noise_wavs_out_dir" -p "$part" -s "$snr"
+        touch "$spart/.done_noise"
+    fi
+
+    if [[ "$(basename $model)" == "mms_lsah_q" ]]; then
+    if [ "$lm_ord" = 0 ]; then
+        if ! is_decoded "$part" "$snr"; then
+            echo "Greedily decoding '$spart'"
+            mkdir -p "$model/k_decode/$part/$name"
+            mms_decode \
+                "$spart" "$model/k_decode/${part}/${name}/snr${snr}_${name}.csv_"
+            mv "$model/k_decode/${part}/${name}/snr${snr}_${name}.csv"{_,}
+            python3 ./mms.py metadata-to-trn \
+                "$model/k_decode/${part}/${name}/snr${snr}_${name}."{csv,trn_}
+            mv "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn"{_,}
+        fi
+    else
+        if ! is_decoded "$part" "$snr" && \
+                ! [ -f "$model/k_decode/logits/${part}_snr${snr}/.done" ]; then
+            echo "Dumping logits of '$spart'"
+            mkdir -p "$model/k_decode/logits/${part}_snr${snr}"
+            mms_decode --logits-dir "$model/k_decode/logits/${part}_snr${snr}" \
+                "$spart" "/dev/null"
+            touch "$model/k_decode/logits/${part}_snr${snr}/.done"
+        fi
+
+        if ! is_decoded "$part" "$snr"; then
+            echo "Decoding $spart"
+            mkdir -p "$model/k_decode/${part}/${name}"
+            python3 ./prep/logits-to-trn-via-pyctcdecode.py \
+                --char "${lm_args[@]}" \
+                --words "etc/lm_words.txt" \
+                --width $width \
+                --beta $beta \
+                --alpha-inv $alpha_inv \
+                --token2id "$model/token2id" \
+                "$model/k_decode/logits/${part}_snr${snr}" "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn"
+        fi
+    fi
+
+    if $delete_wavs; then
+        rm -rf "$spart"
+        mkdir -p "$spart"
+    fi
+    fi
+
+    if [ ! -f "$spart/.done_split" ]; then
+        to_section+=( "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn" "$spart" )
+    fi
+}
+
+function decode_snrs() {
+    # decode and section partition $1 at every SNR after it
+    local part="$1" snr
+    shift
+    if [ "$lm_ord" = 0 ]; then
+        for snr in "$@"; do
+            greedy_from_logits "$part" "$snr"
+        done
+    fi
+    # add noise at every SNR in one pass, unless the wavs of each SNR are deleted
+    # after decoding, in which case they're made one SNR at a time
+    if $in_memory && [[ "$(basename $model)" == "mms_lsah_q" ]]; then
+        decode_noisy_snrs "$part" "$@"
+    elif ! $in_memory && ! $delete_wavs; then
+        add_noise_snrs "$part" "$@"
+    fi
+
+    to_section=( )
+    for snr in "$@"; do
+        decode_snr "$part" "$snr"
+    done
+
+    # every SNR is sectioned at once, sorting by perplexity only once
+    if [ ${#to_section[@]} -gt 0 ]; then
+        python3 "$boothroyd"/section_data.py "$perplexity_filename" 3 "${to_section[@]}"
+        for (( i = 1; i < ${#to_section[@]}; i += 2 )); do
+            echo -e "split using: $perplexity_filename" > "${to_section[$i]}/.done_split"
+        done
+    fi
+}
+
 set -eo pipefail
 
 boothroyd="$(dirname "$0")"
 
+if $serve && [[ "$(basename $model)" == "mms_lsah_q" ]]; then
+    echo "Starting decode server for '$model'"
+    python3 ./mms.py serve --socket "$out_dir/mms.sock" "$model" &
+    server_pid=$!
+    trap 'kill $server_pid 2> /dev/null' EXIT
+fi
+
+# Decoder setup -------------------------------------------------
+if [ "$lm_ord" = 0 ]; then
+    name="greedy"
+elif [[ "$(basename $model)" == "mms_lsah_q" ]]; then
+    if [ ! -f "prep/ngram_lm.py" ]; then
+        echo "Initializing Git submodule"
+        git submodule update --init --remote prep
+    fi
+
+    if [ "$lm_ord" = 1 ]; then
+        name="w${width}_nolm"
+        alpha_inv=1
+        beta=1
+        lm_args=( )
+    else
+        name="w${width}_lm${lm_ord}_ainv${alpha_inv}_b${beta}"
+        lm="$model/lm/${lm_ord}gram.arpa"
+        lm_args=( --lm "$lm" )
+        if ! [ -f "$lm" ]; then
+            echo "Constructing '$lm'"
+            mkdir -p "$model/lm"
+            python3 ./prep/ngram_lm.py -o $lm_ord -t 0 1 < "etc/lm_text.txt" > "${lm}_"
+            mv "$lm"{_,}
+        fi
+    fi
+
+    if ! [ -f "$model/token2id" ]; then
+        echo "Constructing '$model/token2id'"
+        python3 ./mms.py vocab-to-token2id "$model/"{vocab.json,token2id}
+    fi
+fi
+
+# k calculation uses the decoding lm if -P isn't a file (-l >= 2)
+if [ ! -f "$perplexity_lm" ]; then
+    perplexity_lm=$lm
+fi
+
 if ! $pointwise; then
     for part in "${partitions[@]}"; do
     # Data prep -------------------------------------------------
@@ -188,7 +428,8 @@ if ! $pointwise; then
 
     if ! [ -f "$out_dir/$norm_wavs_out_dir/$part/.done" ]; then
         # Normalize data volume to same reference average RMS
-        bash "$boothroyd"/normalize_data_volume.sh -d "$data/$part" -o "$out_dir/$norm_wavs_out_dir/$part"
+        # files are normalized atomically, so rerunning resumes an interrupted run
+        python3 "$boothroyd"/normalize_volume.py -d "$data/$part" -o "$out_dir/$norm_wavs_out_dir/$part"
         touch "$out_dir/$norm_wavs_out_dir/$part/.done"
     fi
 
@@ -198,106 +439,37 @@ if ! $pointwise; then
         mv "$out_dir/$noise_wavs_out_dir/$part/trn"{,_lstm}
     fi
 
-    for snr in $(seq $snr_low $snr_high); do
-        spart="$out_dir/$noise_wavs_out_dir/$part/snr${snr}"
-        if ! [[ -f "$spart/.done_noise" || -f "$spart/.done_split" ]]; then
-            bash "$boothroyd"/add_noise.sh -d "$out_dir/$norm_wavs_out_dir/$part" -s "$snr" \
-            -o "$out_dir/$noise_wavs_out_dir" -p "$part"
-            touch "$spart/.done_noise"
-        fi
+    perplexity_filename="$out_dir/$noise_wavs_out_dir/$part/perplexity_$(basename $perplexity_lm)"
 
-        # Decoding -------------------------------------------------
-
-        if [[ "$(basename $model)" == "mms_lsah_q" ]]; then
-        if [ "$lm_ord" = 0 ]; then
-            name="greedy"
-            if  ! [ -f "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn" ]; then
-                echo "Greedily decoding '$spart'"
-                mkdir -p "$model/k_decode/$part/$name"
-                python3 ./mms.py decode \
-                    "$model" "$spart" "$model/k_decode/${part}/${name}/snr${snr}_${name}.csv_"
-                mv "$model/k_decode/${part}/${name}/snr${snr}_${name}.csv"{_,}
-                python3 ./mms.py metadata-to-trn \
-                    "$model/k_decode/${part}/${name}/snr${snr}_${name}."{csv,trn_}
-                mv "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn"{_,}
-            fi
-        else
-            if [ ! -f "prep/ngram_lm.py" ]; then
-                echo "Initializing Git submodule"
-                git submodule update --init --remote prep
-            fi
-            if  ! [ -f "$model/k_decode/logits/${part}_snr${snr}/.done" ]; then
-                echo "Dumping logits of '$spart'"
-                mkdir -p "$model/k_decode/logits/${part}_snr${snr}"
-                python3 ./mms.py decode --logits-dir "$model/k_decode/logits/${part}_snr${snr}" \
-                    "$model" "$spart" "/dev/null"
-                touch "$model/k_decode/logits/${part}_snr${snr}/.done"
-            fi
-
-            if [ "$lm_ord" = 1 ]; then
-                name="w${width}_nolm"
-                alpha_inv=1
-                beta=1
-                lm_args=( )
-            else
-                name="w${width}_lm${lm_ord}_ainv${alpha_inv}_b${beta}"
-                lm="$model/lm/${lm_ord}gram.arpa"
-                lm_args=( --lm "$lm" )
-                if ! [ -f "$lm" ]; then
-                    echo "Constructing '$lm'"
-                    mkdir -p "$model/lm"
-                    python3 ./prep/ngram_lm.py -o $lm_ord -t 0 1 < "etc/lm_text.txt" > "${lm}_"
-                    mv "$lm"{_,}
-                fi
-            fi
-
-            if ! [ -f "$model/token2id" ]; then
-                echo "Constructing '$model/token2id'"
-                python3 ./mms.py vocab-to-token2id "$model/"{vocab.json,token2id}
-            fi
+    if [ ! -f "$perplexity_filename" ]; then
+      python3 "$boothroyd"/get_perplexity.py "$perplexity_lm" "$out_dir/$noise_wavs_out_dir/$part/trn_lstm"
+    fi
 
-            if ! [ -f "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn" ]; then
-                echo "Decoding $spart"
-                mkdir -p "$model/k_decode/${part}/${name}"
-                python3 ./prep/logits-to-trn-via-pyctcdecode.py \
-                    --char "${lm_args[@]}" \
-                    --words "etc/lm_words.txt" \
-                    --width $width \
-                    --beta $beta \
-                    --alpha-inv $alpha_inv \
-                    --token2id "$model/token2id" \
-                    "$model/k_decode/logits/${part}_snr${snr}" "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn"
+    # Decoding -------------------------------------------------
+    if $adaptive; then
+        # section the SNRs decoded by earlier runs so the sweep can reuse them
+        decoded=( )
+        for snr in $(seq $snr_low $snr_high); do
+            if is_decoded "$part" "$snr"; then
+                decoded+=( "$snr" )
             fi
+        done
+        if [ ${#decoded[@]} -gt 0 ]; then
+            decode_snrs "$part" "${decoded[@]}"
         fi
-        
-        if $delete_wavs; then
-            rm -rf "$spart"
-            mkdir -p "$spart"
-        fi
-
-        fi
-
-        # k calculation -------------------------------------------------
-        # make sure to set lm above when decoding at some point for -l >= 2
-        if [ ! -f "$perplexity_lm" ]; then
-            perplexity_lm=$lm
-        fi
-
-        perplexity_filename="$out_dir/$noise_wavs_out_dir/$part/perplexity_$(basename $perplexity_lm)"
-
-        if [ ! -f "$perplexity_filename" ]; then
-          python3 "$boothroyd"/get_perplexity.py "$perplexity_lm" "$out_dir/$noise_wavs_out_dir/$part/trn_lstm"
-        fi
-
-        if [ ! -f "$spart/.done_split" ]; then
-            bash "$boothroyd"/section_data.sh \
-            "$perplexity_filename" \
-            "$model/k_decode/${part}/${name}/snr${snr}_${name}.trn" 3 "$spart"
-            echo -e "split using: $perplexity_filename" > "$spart/.done_split"
-        fi
-    done
+        while true; do
+            snrs="$(python3 -m faetar_dev_kit.boothroyd.adaptive_sweep -L $snr_low -H $snr_high \
+                -t $tol "$out_dir/$noise_wavs_out_dir/$part")"
+            if [ -z "$snrs" ]; then
+                break
+            fi
+            decode_snrs "$part" $snrs
+        done
+    else
+        decode_snrs "$part" $(seq $snr_low $snr_high)
+    fi
 
-    python3 "$boothroyd"/get_snr_k.py "$out_dir/$noise_wavs_out_dir/$part"
+    python3 -m faetar_dev_kit.boothroyd.get_snr_k "$out_dir/$noise_wavs_out_dir/$part"
     done
 
 else
@@ -345,12 +517,12 @@ fi
 #     "$data"/"$x"_"$model"/perplexity_5gram.arpa exp/"$exp_name"/decode/"$x"_w100_unlablm5_ainv1_b1.trn 3
     
 #     echo "hp/zp $x"
-#     python3 faetar_dev_kit/boothroyd/get_single_k.py \
+#     python3 -m faetar_dev_kit.boothroyd.get_single_k \
 #     "$data"/"$x"_"$model"/1_ref_perplexity_5gram.arpa "$data"/"$x"_"$model"/1_hyp_perplexity_5gram.arpa \
 #     "$data"/"$x"_"$model"/3_ref_perplexity_5gram.arpa "$data"/"$x"_"$model"/3_hyp_perplexity_5gram.arpa
 
 #     echo "lp/zp $x"
-#     python3 faetar_dev_kit/boothroyd/get_single_k.py \
+#     python3 -m faetar_dev_kit.boothroyd.get_single_k \
 #     "$data"/"$x"_"$model"/2_ref_perplexity_5gram.arpa "$data"/"$x"_"$model"/2_hyp_perplexity_5gram.arpa \
 #     "$data"/"$x"_"$model"/3_ref_perplexity_5gram.arpa "$data"/"$x"_"$model"/3_hyp_perplexity_5gram.arpa
 
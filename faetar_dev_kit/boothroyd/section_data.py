@@ -0,0 +1,161 @@
+#! /usr/bin/env python
+
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Splits utterances into sections of increasing perplexity. This replaces
+# section_data.sh. Utterances are ranked by perplexity; the 5% with the lowest and the
+# 5% with the highest perplexities are discarded and the rest are split into
+# num-to-split sections of (about) equal size. For each (hypothesis trn, out dir)
+# pair, section i's references are written to out_dir/i/ref.trn and their
+# hypotheses, split into phones, to out_dir/i/hyp.trn. Both are in the order of the
+# perplexity file.
+
+import os
+import re
+import sys
+import argparse
+
+from typing import Optional, Sequence
+
+CUT = 0.05
+PHONE_PATTERN = re.compile(r"\[fp\]|d[zʒ]ː|tʃː|d[zʒ]|tʃ|\Sː|\S")
+
+
+def split_phones(text: str) -> str:
+    """Split a transcription into phones, with "_" standing for word boundaries"""
+    return " ".join(PHONE_PATTERN.findall("_".join(text.split())))
+
+
+def read_perplexities(perp_file: str) -> list[tuple[float, str, str]]:
+    """Read (perplexity, sentence, (utt)) triples from a get_perplexity.py file"""
+    with open(perp_file) as f:
+        return [
+            (float(perp), sentence, utt)
+            for perp, sentence, utt in (
+                line.rstrip("\n").split("\t") for line in f if line.strip()
+            )
+        ]
+
+
+def section_indices(perps: Sequence[float], num_sections: int) -> list[list[int]]:
+    """Indices into perps of each section, in increasing order
+
+    Ranks r = 1, 2, ..., L are assigned by increasing perplexity. The ranks of
+    section i in 1..num_sections are those for which
+
+        L cut + L (1 - 2 cut) (i - 1) / num_sections < r
+            <= L cut + L (1 - 2 cut) i / num_sections
+    """
+    num = len(perps)
+    order = sorted(range(num), key=lambda idx: perps[idx])
+    sections = [[] for _ in range(num_sections)]
+    for rank, idx in enumerate(order, 1):
+        if not (num * CUT <= rank <= num * (1 - CUT)):
+            continue
+        for i in range(1, num_sections + 1):
+            lo = num * (1 - 2 * CUT) * ((i - 1) / num_sections) + num * CUT
+            hi = num * (1 - 2 * CUT) * (i / num_sections) + num * CUT
+            if lo < rank <= hi:
+                sections[i - 1].append(idx)
+                break
+    for section in sections:
+        section.sort()
+    return sections
+
+
+def read_hyps(hyp_trn: str) -> dict[str, str]:
+    hyps = dict()
+    with open(hyp_trn) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                hyps[fields[-1]] = " ".join(fields[:-1])
+    return hyps
+
+
+def write_sections(
+    refs: Sequence[tuple[float, str, str]],
+    sections: Sequence[Sequence[int]],
+    hyp_trn: str,
+    out_dir: str,
+) -> list[str]:
+    """Write out_dir/<i>/{ref,hyp}.trn, returning the utterances missing a hyp"""
+    hyps = read_hyps(hyp_trn)
+    missing = []
+    for i, section in enumerate(sections, 1):
+        os.makedirs(os.path.join(out_dir, str(i)), exist_ok=True)
+        with open(os.path.join(out_dir, str(i), "ref.trn"), "w") as ref_f, open(
+            os.path.join(out_dir, str(i), "hyp.trn"), "w"
+        ) as hyp_f:
+            for idx in section:
+                _, sentence, utt = refs[idx]
+                if utt not in hyps:
+                    missing.append(utt)
+                    continue
+                ref_f.write(f"{sentence} {utt}\n")
+                hyp_f.write(" ".join(split_phones(hyps[utt]).split() + [utt]) + "\n")
+    return missing
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Split reference and hypothesis transcriptions into sections of "
+        "increasing perplexity"
+    )
+    parser.add_argument(
+        "perp_file", help="Reference perplexities, as written by get_perplexity.py"
+    )
+    parser.add_argument(
+        "num_to_split", type=int, help="Number of sections to split into"
+    )
+    parser.add_argument(
+        "hyps_and_out_dirs",
+        nargs="+",
+        metavar="HYP_TRN OUT_DIR",
+        help="Pairs of hypothesis trn files and the directories to write their "
+        "sections to",
+    )
+    options = parser.parse_args(args)
+
+    if len(options.hyps_and_out_dirs) % 2:
+        print("Expected pairs of hypothesis trn files and out dirs", file=sys.stderr)
+        return 1
+    pairs = list(
+        zip(options.hyps_and_out_dirs[::2], options.hyps_and_out_dirs[1::2])
+    )
+    for hyp_trn, _ in pairs:
+        if not os.path.isfile(hyp_trn):
+            print(f"'{hyp_trn}' is not a file", file=sys.stderr)
+            return 1
+
+    refs = read_perplexities(options.perp_file)
+    sections = section_indices([x[0] for x in refs], options.num_to_split)
+
+    for hyp_trn, out_dir in pairs:
+        missing = write_sections(refs, sections, hyp_trn, out_dir)
+        if missing:
+            print(
+                f"'{hyp_trn}' has no hypothesis for {len(missing)} utterances: "
+                + " ".join(missing[:10])
+                + (" ..." if len(missing) > 10 else ""),
+                file=sys.stderr,
+            )
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
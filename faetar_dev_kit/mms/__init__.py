@@ -47,6 +47,18 @@ def main(args: Optional[Sequence[str]] = None):
         from .decode_hubert import decode
 
         return decode(options)
+    elif options.cmd == "decode-noisy":
+        from .decode_noisy import decode_noisy
+
+        return decode_noisy(options)
+    elif options.cmd == "serve":
+        from .serve import serve
+
+        return serve(options)
+    elif options.cmd == "client":
+        from .client import client
+
+        return client(options)
     elif options.cmd == "evaluate":
         from .io import evaluate
 
@@ -59,5 +71,25 @@ def main(args: Optional[Sequence[str]] = None):
         from .io import vocab_to_token2id
 
         return vocab_to_token2id(options)
+    elif options.cmd == "compress-logits":
+        from .io import compress_logits
+
+        return compress_logits(options)
+    elif options.cmd == "benchmark-quantize":
+        from .benchmark import benchmark_quantize
+
+        return benchmark_quantize(options)
+    elif options.cmd == "benchmark-workers":
+        from .benchmark import benchmark_workers
+
+        return benchmark_workers(options)
+    elif options.cmd == "cache-info":
+        from .cache import cache_info
+
+        return cache_info(options)
+    elif options.cmd == "cache-prune":
+        from .cache import cache_prune
+
+        return cache_prune(options)
     else:
         raise NotImplementedError
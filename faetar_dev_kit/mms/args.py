@@ -79,6 +79,29 @@ class NatType(ArgparseType[int]):
         return int_
 
 
+class PosRealType(ArgparseType[float]):
+    metavar = "POSREAL"
+
+    @staticmethod
+    def to(arg: str) -> float:
+        float_ = float(arg)
+        if float_ <= 0:
+            raise argparse.ArgumentTypeError(f"'{arg}' is not a positive real number")
+        return float_
+
+
+class BlankThresholdType(ArgparseType[float]):
+    metavar = "PROB"
+
+    @staticmethod
+    def to(arg: str) -> float:
+        float_ = float(arg)
+        # below 0.5, a merged frame might not be a greedy blank (see kept_frames)
+        if not 0.5 <= float_ <= 1:
+            raise argparse.ArgumentTypeError(f"'{arg}' is not in [0.5, 1]")
+        return float_
+
+
 class PathType(ArgparseType[pathlib.Path]):
     metavar = "PTH"
 
@@ -155,6 +178,14 @@ class Options(object):
         "evaluate",
         "metadata-to-trn",
         "vocab-to-token2id",
+        "cache-info",
+        "cache-prune",
+        "compress-logits",
+        "benchmark-quantize",
+        "benchmark-workers",
+        "decode-noisy",
+        "serve",
+        "client",
     ]
 
     # compile-metadata kwargs
@@ -173,6 +204,11 @@ class Options(object):
     metadata_csv: pathlib.Path
     vocab_json: pathlib.Path
 
+    # load_partition kwargs
+    num_proc: int = 1
+    cache_dir: Optional[pathlib.Path] = None
+    cache_size_gb: Optional[float] = None
+
     # train kwargs
     pretrained_model_id: str = "facebook/mms-1b-all"
     pretrained_model_lang: str = "ita"
@@ -187,6 +223,55 @@ class Options(object):
 
     # decode kwargs
     logits_dir: Optional[pathlib.Path] = None
+    logits_format: Literal["pt", "store"] = "pt"
+    logits_dtype: Literal["float32", "float16", "bfloat16"] = "float32"
+    logits_top_k: int = 0
+    logits_blank_threshold: Optional[float] = None
+    logits_quantize: bool = False
+    batch_size: int = 1
+    max_batch_seconds: Optional[float] = None
+    streaming: bool = False
+    prefetch: int = 2
+    quantize: Literal["none", "dynamic-int8", "bf16"] = "none"
+    cache_quantized: bool = False
+    chunk_seconds: Optional[float] = None
+    chunk_overlap_seconds: float = 2.0
+    workers: int = 1
+    threads_per_worker: Optional[int] = None
+
+    # decode-noisy kwargs
+    snrs: Sequence[float] = ()
+    noise_type: Literal["whitenoise", "pinknoise", "brownnoise"] = "whitenoise"
+    noise_seed: int = 0
+    noise_dir: Optional[pathlib.Path] = None
+    true_snr: bool = False
+
+    # decode-noisy args
+    # model_dir: pathlib.Path
+    # data: pathlib.Path
+    # metadata_csv: pathlib.Path
+
+    # serve/client kwargs
+    socket: pathlib.Path = pathlib.Path("mms.sock")
+    wait_seconds: float = 600.0
+
+    # serve args
+    # model_dir: pathlib.Path
+
+    # client args
+    # data: pathlib.Path
+    # metadata_csv: pathlib.Path
+
+    # benchmark-quantize kwargs
+    hubert: bool = False
+    max_utts: Optional[int] = None
+
+    # benchmark-workers kwargs
+    worker_counts: Sequence[int] = (1, 2, 4, 8)
+
+    # benchmark-quantize args
+    # model_dir: pathlib.Path
+    # data: pathlib.Path
 
     # decode args
     # model_dir: pathlib.Path
@@ -208,6 +293,17 @@ class Options(object):
     # vocab_json: pathlib.Path
     token2id: pathlib.Path
 
+    # compress-logits kwargs
+    blank_id: int = -1
+    beam_width: Optional[int] = None
+    beam_tolerance: float = 0.01
+    ref_trn: Optional[pathlib.Path] = None
+    ref_vocab_json: Optional[pathlib.Path] = None
+
+    # compress-logits args
+    # logits_dir: pathlib.Path
+    compressed_logits_dir: pathlib.Path
+
     @classmethod
     def _add_compile_metadata_args(cls, parser: argparse.ArgumentParser):
 
@@ -252,9 +348,113 @@ class Options(object):
             help="Path to vocab.json file (output)",
         )
 
+    @classmethod
+    def _add_load_partition_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--num-proc",
+            type=NatType,
+            help="Number of processes to preprocess AudioFolder data with",
+        )
+        cls._add_argument(
+            parser,
+            "--cache-dir",
+            type=WriteDirType,
+            help="If set, preprocessed partitions are cached in and reused from this "
+            "directory, keyed by the contents of the AudioFolder and the processor",
+        )
+        cls._add_argument(
+            parser,
+            "--cache-size-gb",
+            type=PosRealType,
+            help="If set, least-recently-used entries are deleted from --cache-dir "
+            "until it is at most this size",
+        )
+
+    @classmethod
+    def _add_batch_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--batch-size",
+            type=NatType,
+            help="Maximum number of utterances per forward pass. Utterances are "
+            "sorted by length before batching",
+        )
+        cls._add_argument(
+            parser,
+            "--max-batch-seconds",
+            type=PosRealType,
+            help="If set, maximum seconds of (padded) audio per forward pass",
+        )
+
+    @classmethod
+    def _add_workers_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--threads-per-worker",
+            type=NatType,
+            help="Number of intra-op threads for each worker. Defaults to the number "
+            "of CPUs divided by the number of workers",
+        )
+
+    @classmethod
+    def _add_quantize_args(cls, parser: argparse.ArgumentParser):
+
+        parser.add_argument(
+            "--quantize",
+            choices=["none", "dynamic-int8", "bf16"],
+            default=cls.quantize,
+            help="Quantize the model for inference. 'dynamic-int8' quantizes the "
+            "linear layers to int8 and always runs on CPU. 'bf16' casts the model to "
+            "bfloat16",
+        )
+        parser.add_argument(
+            "--cache-quantized",
+            action="store_true",
+            default=False,
+            help="Save the quantized model in the model directory and load it from "
+            "there in subsequent runs",
+        )
+
+    @classmethod
+    def _add_logits_encoding_args(cls, parser: argparse.ArgumentParser):
+
+        parser.add_argument(
+            "--logits-dtype",
+            choices=["float32", "float16", "bfloat16"],
+            default=cls.logits_dtype,
+            help="Precision to store logits with",
+        )
+        cls._add_argument(
+            parser,
+            "--logits-top-k",
+            type=NonnegType,
+            help="If positive, store only the log-probabilities of this many of the "
+            "most likely tokens per frame (logits store only)",
+        )
+        cls._add_argument(
+            parser,
+            "--logits-blank-threshold",
+            type=BlankThresholdType,
+            help="If set, store runs of consecutive frames whose blank probability "
+            "is at least this value (in [0.5, 1]) as a single frame (logits store "
+            "only)",
+        )
+        parser.add_argument(
+            "--logits-quantize",
+            action="store_true",
+            default=False,
+            help="Store log-probabilities quantized to 8 bits (logits store only)",
+        )
+
     @classmethod
     def _add_train_args(cls, parser: argparse.ArgumentParser):
 
+        cls._add_load_partition_args(parser)
+
         cls._add_argument(
             parser, "--pretrained-model-id", help="model to load from hub"
         )
@@ -298,9 +498,74 @@ class Options(object):
             help="Path to model dir (output)",
         )
 
+    @classmethod
+    def _add_decode_job_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--logits-dir",
+            type=WriteDirType,
+            help="Path to dump logits to (if specified; output)",
+        )
+        parser.add_argument(
+            "--logits-format",
+            choices=["pt", "store"],
+            default=cls.logits_format,
+            help="How to dump logits. 'pt' saves one PyTorch file per utterance. "
+            "'store' writes a logits store: contiguous shards of raw logits with a "
+            "single index, which can be memory-mapped by utterance",
+        )
+        cls._add_logits_encoding_args(parser)
+        cls._add_batch_args(parser)
+        parser.add_argument(
+            "--streaming",
+            action="store_true",
+            default=False,
+            help="Read and preprocess audio lazily in --num-proc background "
+            "processes while decoding, rather than preprocessing the whole partition "
+            "first. Utterances are batched in file order and --max-batch-seconds "
+            "and --cache-dir are ignored",
+        )
+        cls._add_argument(
+            parser,
+            "--prefetch",
+            type=NatType,
+            help="With --streaming, number of batches each process loads ahead",
+        )
+        cls._add_argument(
+            parser,
+            "--chunk-seconds",
+            type=PosRealType,
+            help="If set, run the model on overlapping windows of this many seconds "
+            "and stitch their logits together, bounding memory for long recordings. "
+            "--batch-size then counts windows",
+        )
+        cls._add_argument(
+            parser,
+            "--chunk-overlap-seconds",
+            type=PosRealType,
+            help="With --chunk-seconds, seconds by which consecutive windows overlap",
+        )
+
+    @classmethod
+    def _add_decode_model_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--workers",
+            type=NatType,
+            help="If greater than 1, decode on CPU in this many forked processes "
+            "sharing one copy of the model, each taking a share of the batches. "
+            "Cannot be combined with --streaming",
+        )
+        cls._add_workers_args(parser)
+        cls._add_quantize_args(parser)
+
     @classmethod
     def _add_decode_args(cls, parser: argparse.ArgumentParser):
 
+        cls._add_load_partition_args(parser)
+
         cls._add_argument(
             parser,
             "model_dir",
@@ -313,11 +578,128 @@ class Options(object):
             type=ReadDirType,
             help="Path to AudioFolder to decode",
         )
+        cls._add_decode_job_args(parser)
+        cls._add_decode_model_args(parser)
         cls._add_argument(
             parser,
-            "--logits-dir",
+            "metadata_csv",
+            type=WriteFileType,
+            help="Path to hypothesis metadata.csv file (output)",
+        )
+
+    @classmethod
+    def _add_decode_noisy_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_load_partition_args(parser)
+        parser.add_argument(
+            "--hubert",
+            action="store_true",
+            default=False,
+            help="The model is a fine-tuned hubert model, not an mms model",
+        )
+        parser.add_argument(
+            "--snrs",
+            nargs="+",
+            type=float,
+            required=True,
+            metavar="REAL",
+            help="Signal-to-noise ratios (dB) to decode at",
+        )
+        parser.add_argument(
+            "--noise-type",
+            choices=["whitenoise", "pinknoise", "brownnoise"],
+            default=cls.noise_type,
+            help="The type of noise generated",
+        )
+        cls._add_argument(
+            parser,
+            "--noise-seed",
+            type=IntegerType,
+            help="The seed the noise is generated from",
+        )
+        cls._add_argument(
+            parser,
+            "--noise-dir",
             type=WriteDirType,
-            help="Path to dump logits to (if specified; output)",
+            help="If set, the generated noise is cached in this directory, shared "
+            "with boothroyd/add_noise.py",
+        )
+        parser.add_argument(
+            "--true-snr",
+            action="store_true",
+            default=False,
+            help="Don't halve the signal after determining the noise gain. By "
+            "default it is halved, like 'sox -m' in add_noise.sh and like "
+            "boothroyd/add_noise.py, making the SNR about 6 dB lower than requested",
+        )
+        cls._add_argument(
+            parser,
+            "model_dir",
+            type=ReadDirType,
+            help="Path to model dir",
+        )
+        cls._add_argument(
+            parser,
+            "data",
+            type=ReadDirType,
+            help="Path to AudioFolder of clean (volume-normalized) audio to decode",
+        )
+        cls._add_decode_job_args(parser)
+        cls._add_decode_model_args(parser)
+        cls._add_argument(
+            parser,
+            "metadata_csv",
+            type=WriteFileType,
+            help="Path to hypothesis metadata.csv files (output). '{snr}' is replaced "
+            "with each SNR, as it is in --logits-dir. A .trn file is written next to "
+            "each",
+        )
+
+    @classmethod
+    def _add_serve_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--socket",
+            type=WriteFileType,
+            help="Path of the Unix socket to listen on",
+        )
+        parser.add_argument(
+            "--hubert",
+            action="store_true",
+            default=False,
+            help="The model is a fine-tuned hubert model, not an mms model",
+        )
+        cls._add_decode_model_args(parser)
+        cls._add_argument(
+            parser,
+            "model_dir",
+            type=ReadDirType,
+            help="Path to model dir",
+        )
+
+    @classmethod
+    def _add_client_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--socket",
+            type=WriteFileType,
+            help="Path of the Unix socket the server listens on",
+        )
+        cls._add_argument(
+            parser,
+            "--wait-seconds",
+            type=PosRealType,
+            help="How long to wait for the server to start listening",
+        )
+        cls._add_load_partition_args(parser)
+        cls._add_decode_job_args(parser)
+        cls._add_argument(
+            parser,
+            "data",
+            type=ReadDirType,
+            help="Path to AudioFolder to decode",
         )
         cls._add_argument(
             parser,
@@ -326,6 +708,57 @@ class Options(object):
             help="Path to hypothesis metadata.csv file (output)",
         )
 
+    @classmethod
+    def _add_benchmark_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_load_partition_args(parser)
+        cls._add_batch_args(parser)
+        parser.add_argument(
+            "--hubert",
+            action="store_true",
+            default=False,
+            help="The model is a fine-tuned hubert model, not an mms model",
+        )
+        cls._add_argument(
+            parser,
+            "--max-utts",
+            type=NatType,
+            help="If set, only decode this many utterances of the partition",
+        )
+        cls._add_argument(
+            parser,
+            "model_dir",
+            type=ReadDirType,
+            help="Path to model dir",
+        )
+        cls._add_argument(
+            parser,
+            "data",
+            type=ReadDirType,
+            help="Path to AudioFolder to decode",
+        )
+
+    @classmethod
+    def _add_benchmark_quantize_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_benchmark_args(parser)
+        cls._add_quantize_args(parser)
+
+    @classmethod
+    def _add_benchmark_workers_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_benchmark_args(parser)
+        cls._add_workers_args(parser)
+        cls._add_quantize_args(parser)
+        parser.add_argument(
+            "--worker-counts",
+            nargs="+",
+            type=NatType.to,
+            metavar=NatType.metavar,
+            default=cls.worker_counts,
+            help="Numbers of workers to time decoding with",
+        )
+
     @classmethod
     def _add_evaluate_args(cls, parser: argparse.ArgumentParser):
 
@@ -368,6 +801,78 @@ class Options(object):
             parser, "token2id", type=WriteFileType, help="token2id file (output)"
         )
 
+    @classmethod
+    def _add_compress_logits_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_logits_encoding_args(parser)
+        cls._add_argument(
+            parser,
+            "--blank-id",
+            type=IntegerType,
+            help="Id of the blank token. Negative values count from the end of the "
+            "vocabulary",
+        )
+        cls._add_argument(
+            parser,
+            "--beam-width",
+            type=NatType,
+            help="If set, also compare LM-free CTC prefix beam searches of this width "
+            "over both stores. This is not the recipe's LM decoder; it shows how much "
+            "compression changes the scores of alternatives to the best path",
+        )
+        cls._add_argument(
+            parser,
+            "--beam-tolerance",
+            type=PosRealType,
+            help="Fail if the beam hypotheses of the compressed store have a greater "
+            "token error rate than this against those of the original. That is how "
+            "far the hypotheses diverge, not a change in WER",
+        )
+        cls._add_argument(
+            parser,
+            "--ref-trn",
+            type=ReadFileType,
+            help="If set, also report the WER of the hypotheses of both stores "
+            "against this reference trn file",
+        )
+        cls._add_argument(
+            parser,
+            "--ref-vocab-json",
+            type=ReadFileType,
+            help="vocab.json of the model which wrote the store, to turn the token ids "
+            "of hypotheses into text with --ref-trn. --lang picks its vocabulary",
+        )
+        cls._add_argument(
+            parser, "logits_dir", type=ReadDirType, help="Path to logits store"
+        )
+        cls._add_argument(
+            parser,
+            "compressed_logits_dir",
+            type=WriteDirType,
+            help="Path to compressed logits store (output)",
+        )
+
+    @classmethod
+    def _add_cache_info_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser, "cache_dir", type=ReadDirType, help="Path to feature cache"
+        )
+
+    @classmethod
+    def _add_cache_prune_args(cls, parser: argparse.ArgumentParser):
+
+        cls._add_argument(
+            parser,
+            "--cache-size-gb",
+            type=PosRealType,
+            help="Delete least-recently-used entries until the cache is at most this "
+            "size. If unset, all entries are deleted",
+        )
+        cls._add_argument(
+            parser, "cache_dir", type=ReadDirType, help="Path to feature cache"
+        )
+
     @classmethod
     def parse_args(cls, args: Optional[Sequence[str]] = None, **kwargs):
         parser = argparse.ArgumentParser(**kwargs)
@@ -415,6 +920,28 @@ class Options(object):
             cmds.add_parser("decode-hubert", help="decode with fine-tuned hubert model")
         )
 
+        cls._add_decode_noisy_args(
+            cmds.add_parser(
+                "decode-noisy",
+                help="decode a clean AudioFolder with noise added in memory at each "
+                "of a number of SNRs",
+            )
+        )
+
+        cls._add_serve_args(
+            cmds.add_parser(
+                "serve",
+                help="Keep a fine-tuned model loaded and decode jobs sent to a Unix "
+                "socket by 'client'",
+            )
+        )
+
+        cls._add_client_args(
+            cmds.add_parser(
+                "client", help="decode with a model loaded by 'serve'"
+            )
+        )
+
         cls._add_evaluate_args(
             cmds.add_parser("evaluate", help="Determine error rates")
         )
@@ -433,4 +960,39 @@ class Options(object):
             )
         )
 
+        cls._add_compress_logits_args(
+            cmds.add_parser(
+                "compress-logits",
+                help="Prune a logits store and report how much smaller it is and how "
+                "much greedy (and, with --beam-width, beam search) decoding changes",
+            )
+        )
+
+        cls._add_benchmark_quantize_args(
+            cmds.add_parser(
+                "benchmark-quantize",
+                help="Compare the throughput, peak memory, and greedy output of "
+                "quantized models against the unquantized model. If --quantize is "
+                "'none', all schemes are compared",
+            )
+        )
+
+        cls._add_benchmark_workers_args(
+            cmds.add_parser(
+                "benchmark-workers",
+                help="Report the throughput of CPU decoding with different numbers of "
+                "workers",
+            )
+        )
+
+        cls._add_cache_info_args(
+            cmds.add_parser("cache-info", help="List entries in a feature cache")
+        )
+
+        cls._add_cache_prune_args(
+            cmds.add_parser(
+                "cache-prune", help="Delete least-recently-used feature cache entries"
+            )
+        )
+
         return parser.parse_args(args, namespace=cls())
@@ -0,0 +1,218 @@
+# Copyright 2024 Sean Robertson
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import time
+import resource
+import multiprocessing
+
+from copy import copy
+from queue import Empty
+from typing import Any, Sequence
+
+import torch
+
+from datasets import Dataset
+from transformers import Wav2Vec2Processor
+
+from ..scoring import error_rate
+from .args import Options
+from .data import load_partition
+from .decode import (
+    SPACE_PATTERN,
+    batch_indices,
+    compute_logits,
+    decode_sharded,
+    get_device,
+    load_model,
+    model_loader,
+)
+
+
+def _load_benchmark_partition(
+    options: Options,
+) -> tuple[Wav2Vec2Processor, Dataset, list[list[int]], float]:
+    processor = Wav2Vec2Processor.from_pretrained(
+        options.model_dir, target_lang="fae" if options.hubert else options.lang
+    )
+    ds = load_partition(options, "decode", processor)
+    if options.max_utts is not None and options.max_utts < len(ds):
+        ds = ds.select(range(options.max_utts))
+    sampling_rate = processor.feature_extractor.sampling_rate
+    if options.max_batch_seconds is None:
+        max_batch_len = None
+    else:
+        max_batch_len = int(options.max_batch_seconds * sampling_rate)
+    lengths = ds["input_length"]
+    batches = batch_indices(lengths, options.batch_size, max_batch_len)
+    return processor, ds, batches, sum(lengths) / sampling_rate
+
+
+def _agreement(refs: Sequence[str], hyps: Sequence[str]) -> tuple[float, float]:
+    """Fraction of identical hypotheses and the CER of hyps against refs"""
+    identical = sum(ref == hyp for ref, hyp in zip(refs, hyps)) / max(len(refs), 1)
+    pairs = [(ref, hyp) for ref, hyp in zip(refs, hyps) if ref.strip()]
+    if not pairs:
+        return identical, 0.0
+    return identical, error_rate([list(x[0]) for x in pairs], [list(x[1]) for x in pairs])
+
+
+def _time_scheme(
+    options: Options,
+    processor: Wav2Vec2Processor,
+    ds: Dataset,
+    batches: list[list[int]],
+    queue: multiprocessing.Queue,
+):
+    try:
+        load, lang = model_loader(options)
+        device = get_device(options)
+
+        start = time.perf_counter()
+        model = load_model(options, load, lang).to(device)
+        load_secs = time.perf_counter() - start
+
+        texts = [None] * len(ds)
+        start = time.perf_counter()
+        for batch in batches:
+            batch_logits = compute_logits(
+                model, processor, ds[batch]["input_values"], device
+            )
+            for idx, logits in zip(batch, batch_logits):
+                texts[idx] = SPACE_PATTERN.sub(" ", processor.decode(logits.argmax(-1)))
+        decode_secs = time.perf_counter() - start
+
+        if device == "cpu":
+            # kibibytes on Linux
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        else:
+            peak = torch.cuda.max_memory_allocated(device)
+        queue.put(("done", (load_secs, decode_secs, peak, texts)))
+    except BaseException as e:
+        queue.put(("error", f"{type(e).__name__}: {e}"))
+        raise
+
+
+def _wait_for_scheme(
+    proc: multiprocessing.Process, queue: multiprocessing.Queue
+) -> tuple[str, Any]:
+    """The (kind, message) _time_scheme posted, or an error if proc died first"""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            if proc.is_alive():
+                continue
+        # a message put just before exiting may still be in flight
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            return "error", f"process exited with code {proc.exitcode}"
+
+
+def benchmark_quantize(options: Options):
+
+    if options.quantize == "none":
+        schemes = ["none", "dynamic-int8", "bf16"]
+    else:
+        schemes = ["none", options.quantize]
+
+    processor, ds, batches, audio_secs = _load_benchmark_partition(options)
+
+    # each scheme runs in its own process so that peak memory is its own
+    ctx = multiprocessing.get_context("fork")
+    results, failed = dict(), dict()
+    for scheme in schemes:
+        options_ = copy(options)
+        options_.quantize = scheme
+        queue = ctx.Queue()
+        proc = ctx.Process(
+            target=_time_scheme, args=(options_, processor, ds, batches, queue)
+        )
+        proc.start()
+        try:
+            kind, msg = _wait_for_scheme(proc, queue)
+        finally:
+            proc.join(timeout=10)
+            if proc.is_alive():
+                proc.terminate()
+        if kind == "done":
+            results[scheme] = msg
+        else:
+            failed[scheme] = msg
+            print(f"scheme '{scheme}' failed: {msg}", file=sys.stderr)
+    if "none" in failed:
+        return 1
+
+    baseline = results["none"][3]
+    print(
+        f"{len(ds)} utterances, {audio_secs:.1f}s of audio, batch size "
+        f"{options.batch_size}"
+    )
+    print(
+        f"{'scheme':>14} {'load (s)':>9} {'utt/s':>8} {'RTF':>7} {'peak (GiB)':>11} "
+        f"{'identical':>10} {'CER vs none':>12}"
+    )
+    for scheme, (load_secs, decode_secs, peak, texts) in results.items():
+        identical, cer = _agreement(baseline, texts)
+        print(
+            f"{scheme:>14} {load_secs:9.1f} {len(ds) / decode_secs:8.2f} "
+            f"{decode_secs / audio_secs:7.3f} {peak / (1 << 30):11.2f} "
+            f"{identical:10.1%} {cer:12.2%}"
+        )
+
+    return 1 if failed else 0
+
+
+def benchmark_workers(options: Options):
+
+    processor, ds, batches, audio_secs = _load_benchmark_partition(options)
+    load, lang = model_loader(options)
+    model = load_model(options, load, lang).eval()
+
+    results = dict()
+    for workers in options.worker_counts:
+        options_ = copy(options)
+        options_.workers = workers
+        options_.logits_dir = None
+        texts = [None] * len(ds)
+        start = time.perf_counter()
+        for rows in decode_sharded(options_, model, processor, ds, batches):
+            for idx, row in rows:
+                texts[idx] = row
+        results[workers] = time.perf_counter() - start, texts
+
+    first = options.worker_counts[0]
+    baseline_secs, baseline = results[first]
+    print(
+        f"{len(ds)} utterances, {audio_secs:.1f}s of audio, batch size "
+        f"{options.batch_size}, {os.cpu_count()} CPUs"
+    )
+    print(
+        f"{'workers':>8} {'threads':>8} {'utt/s':>8} {'RTF':>7} "
+        f"{'speedup vs ' + str(first):>15} {'identical':>10}"
+    )
+    for workers, (decode_secs, texts) in results.items():
+        threads = options.threads_per_worker
+        if threads is None:
+            threads = max((os.cpu_count() or 1) // workers, 1)
+        identical, _ = _agreement(baseline, texts)
+        print(
+            f"{workers:>8} {threads:>8} {len(ds) / decode_secs:8.2f} "
+            f"{decode_secs / audio_secs:7.3f} {baseline_secs / decode_secs:15.2f} "
+            f"{identical:10.1%}"
+        )
+
+    return 0
@@ -0,0 +1,172 @@
+# Copyright 2024 Sean Robertson
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# The cache is a flat directory of entries, one per preprocessed partition. Each
+# entry is a Dataset written with Dataset.save_to_disk, so loading it memory-maps
+# the Arrow files rather than reading them. An entry's name is a hash of the
+# contents of every file in the AudioFolder, the feature extractor config, and the
+# tokenizer vocabulary: if any of those change, the entry is simply never hit again
+# and eventually falls out of the LRU.
+
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from typing import Literal, Optional
+from pathlib import Path
+from dataclasses import dataclass
+
+from datasets import Dataset, load_from_disk
+from transformers import Wav2Vec2Processor
+
+from .args import Options
+
+INFO_FILE = "faetar_cache.json"
+LAST_USED_FILE = ".last_used"
+HASH_CHUNK_SIZE = 1 << 20
+
+
+@dataclass
+class CacheEntry:
+
+    key: str
+    path: Path
+    size: int
+    last_used: float
+    info: dict
+
+
+def hash_file(pth: Path) -> str:
+    hash_ = hashlib.sha256()
+    with pth.open("rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+            hash_.update(chunk)
+    return hash_.hexdigest()
+
+
+def partition_key(
+    data: Path, part: Literal["train", "dev", "decode"], processor: Wav2Vec2Processor
+) -> str:
+    hash_ = hashlib.sha256()
+    # training partitions are filtered and have no file_name column
+    hash_.update(("decode" if part == "decode" else "train").encode())
+    hash_.update(processor.feature_extractor.to_json_string().encode())
+    hash_.update(json.dumps(processor.tokenizer.get_vocab(), sort_keys=True).encode())
+    for pth in sorted(data.rglob("*")):
+        rel = pth.relative_to(data)
+        if not pth.is_file() or any(x.startswith(".") for x in rel.parts):
+            continue
+        hash_.update(f"{rel.as_posix()}\0{hash_file(pth)}\0".encode())
+    return hash_.hexdigest()
+
+
+def dir_size(pth: Path) -> int:
+    return sum(x.stat().st_size for x in pth.rglob("*") if x.is_file())
+
+
+def list_entries(cache_dir: Path) -> list[CacheEntry]:
+    entries = []
+    if not cache_dir.is_dir():
+        return entries
+    for pth in cache_dir.iterdir():
+        info_file = pth / INFO_FILE
+        if not info_file.is_file():  # partially written or not an entry
+            continue
+        last_used = pth / LAST_USED_FILE
+        last_used = (last_used if last_used.is_file() else info_file).stat().st_mtime
+        entries.append(
+            CacheEntry(
+                pth.name,
+                pth,
+                dir_size(pth),
+                last_used,
+                json.loads(info_file.read_text()),
+            )
+        )
+    entries.sort(key=lambda x: x.last_used)
+    return entries
+
+
+def prune(cache_dir: Path, max_bytes: int) -> list[CacheEntry]:
+    """Delete least-recently-used entries until the cache fits in max_bytes
+
+    Returns the deleted entries
+    """
+    entries = list_entries(cache_dir)
+    total = sum(entry.size for entry in entries)
+    deleted = []
+    for entry in entries:
+        if total <= max_bytes:
+            break
+        shutil.rmtree(entry.path, ignore_errors=True)
+        total -= entry.size
+        deleted.append(entry)
+    return deleted
+
+
+def load(cache_dir: Path, key: str) -> Optional[Dataset]:
+    pth = cache_dir / key
+    if not (pth / INFO_FILE).is_file():
+        return None
+    (pth / LAST_USED_FILE).touch()
+    return load_from_disk(os.fspath(pth))
+
+
+def store(cache_dir: Path, key: str, ds: Dataset, info: dict) -> Dataset:
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    pth = cache_dir / key
+    tmp = cache_dir / f".{key}.{os.getpid()}"
+    ds.save_to_disk(os.fspath(tmp))
+    info = dict(info, created=time.time())
+    (tmp / INFO_FILE).write_text(json.dumps(info))
+    try:
+        tmp.rename(pth)
+    except OSError:
+        # another process finished the same entry first
+        shutil.rmtree(tmp, ignore_errors=True)
+    return load(cache_dir, key)
+
+
+def gb_to_bytes(gb: float) -> int:
+    return int(gb * (1 << 30))
+
+
+def cache_info(options: Options):
+
+    entries = list_entries(options.cache_dir)
+    for entry in entries:
+        last_used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.last_used))
+        print(
+            f"{entry.key[:16]}  {entry.size / (1 << 20):10.1f} MiB  {last_used}  "
+            f"{entry.info.get('part', '?'):6s}  {entry.info.get('data', '?')}"
+        )
+    total = sum(entry.size for entry in entries)
+    print(f"{len(entries)} entries, {total / (1 << 20):.1f} MiB total")
+
+    return 0
+
+
+def cache_prune(options: Options):
+
+    if options.cache_size_gb is None:
+        max_bytes = 0
+    else:
+        max_bytes = gb_to_bytes(options.cache_size_gb)
+    deleted = prune(options.cache_dir, max_bytes)
+    freed = sum(entry.size for entry in deleted)
+    print(f"Deleted {len(deleted)} entries, freeing {freed / (1 << 20):.1f} MiB")
+
+    return 0
@@ -0,0 +1,116 @@
+# Copyright 2024 Sean Robertson
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A decode job is a single line of JSON holding the options of `decode` which do not
+# depend on the model, sent over the server's Unix socket. The server replies with a
+# single line of JSON holding the job's exit status and, if it raised, the error.
+# This module only imports the standard library so that the client starts quickly.
+
+import os
+import sys
+import json
+import time
+import socket
+
+from copy import copy
+from pathlib import Path
+
+from .args import Options
+
+JOB_KEYS = (
+    "data",
+    "metadata_csv",
+    "num_proc",
+    "cache_dir",
+    "cache_size_gb",
+    "logits_dir",
+    "logits_format",
+    "logits_dtype",
+    "logits_top_k",
+    "logits_blank_threshold",
+    "logits_quantize",
+    "batch_size",
+    "max_batch_seconds",
+    "streaming",
+    "prefetch",
+    "chunk_seconds",
+    "chunk_overlap_seconds",
+)
+PATH_KEYS = ("data", "metadata_csv", "cache_dir", "logits_dir")
+
+
+def job_from_options(options: Options) -> dict:
+    job = dict()
+    for key in JOB_KEYS:
+        val = getattr(options, key)
+        if key in PATH_KEYS and val is not None:
+            # the server need not share our working directory
+            val = os.path.abspath(val)
+        job[key] = val
+    return job
+
+
+def job_to_options(job: dict, options: Options) -> Options:
+    """Set the attributes of (a copy of) options from a job"""
+    unknown = set(job) - set(JOB_KEYS)
+    if unknown:
+        raise ValueError(f"unknown job keys: {', '.join(sorted(unknown))}")
+    options = copy(options)
+    for key, val in job.items():
+        if key in PATH_KEYS and val is not None:
+            val = Path(val)
+        setattr(options, key, val)
+    return options
+
+
+def connect(pth: Path, wait_seconds: float) -> socket.socket:
+    """Connect to the Unix socket at pth, waiting up to wait_seconds for it"""
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(os.fspath(pth))
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(1.0)
+
+
+def client(options: Options):
+
+    try:
+        sock = connect(options.socket, options.wait_seconds)
+    except OSError as e:
+        print(f"Could not connect to '{options.socket}': {e}", file=sys.stderr)
+        return 1
+
+    with sock, sock.makefile("rwb") as fp:
+        fp.write((json.dumps(job_from_options(options)) + "\n").encode())
+        fp.flush()
+        line = fp.readline()
+
+    if not line:
+        print("The server closed the connection without replying", file=sys.stderr)
+        return 1
+    reply = json.loads(line)
+    if "error" in reply:
+        print(f"The server failed to decode: {reply['error']}", file=sys.stderr)
+    elif reply["status"]:
+        print(
+            f"The server returned status {reply['status']}; see its log",
+            file=sys.stderr,
+        )
+    return reply["status"]
@@ -18,14 +18,26 @@
 #
 # last accessed April 15th, 2024
 
+import csv
+
 from typing import Literal
 from pathlib import Path
 
+import librosa
+import soundfile
+import torch
+
 from datasets import load_dataset, Audio, Dataset
 from transformers import Wav2Vec2Processor
 
+from . import cache
 from .args import Options
 
+# decoded audio is held in memory one batch at a time per process
+PREPROCESS_BATCH_SIZE = 32
+
+AUDIO_SUFFIXES = {".wav", ".flac", ".mp3", ".ogg", ".opus"}
+
 
 def load_partition(
     options: Options,
@@ -40,32 +52,118 @@ def load_partition(
         data = options.data
     data = data.absolute()
 
+    if options.cache_dir is not None:
+        key = cache.partition_key(data, part, processor)
+        ds = cache.load(options.cache_dir, key)
+        if ds is not None:
+            return ds
+
     ds = load_dataset("audiofolder", data_dir=data, split="all")
-    ds = ds.cast_column(
-        "audio", Audio(sampling_rate=processor.feature_extractor.sampling_rate)
-    )
+    sampling_rate = processor.feature_extractor.sampling_rate
 
     def filter_short(batch):
-        audio = batch["audio"]
-        duration = len(audio["array"]) / audio["sampling_rate"]
-        return duration > 0.5
+        # only the header is read, not the samples
+        durations = []
+        for audio in batch["audio"]:
+            info = soundfile.info(audio["path"])
+            durations.append(info.frames / info.samplerate)
+        return [duration > 0.5 for duration in durations]
 
     def prepare_dataset(batch):
-        audio = batch["audio"]
+        audios = batch["audio"]
         if part == "decode":
-            batch["file_name"] = Path(audio["path"]).relative_to(data).as_posix()
+            batch["file_name"] = [
+                Path(audio["path"]).relative_to(data).as_posix() for audio in audios
+            ]
 
-        # batched output is "un-batched"
+        # without padding, each utterance is normalized independently
         batch["input_values"] = processor(
-            audio["array"], sampling_rate=audio["sampling_rate"]
-        ).input_values[0]
-        batch["input_length"] = len(batch["input_values"])
+            [audio["array"] for audio in audios], sampling_rate=sampling_rate
+        ).input_values
+        batch["input_length"] = [len(x) for x in batch["input_values"]]
 
         if "sentence" in batch:
             batch["labels"] = processor(text=batch["sentence"]).input_ids
         return batch
 
     if part != "decode":
-        ds = ds.filter(filter_short)
-    ds = ds.map(prepare_dataset, remove_columns=ds.column_names)
+        ds = ds.cast_column("audio", Audio(decode=False))
+        ds = ds.filter(filter_short, batched=True, num_proc=options.num_proc)
+    ds = ds.cast_column("audio", Audio(sampling_rate=sampling_rate))
+    ds = ds.map(
+        prepare_dataset,
+        batched=True,
+        batch_size=PREPROCESS_BATCH_SIZE,
+        num_proc=options.num_proc,
+        remove_columns=ds.column_names,
+    )
+
+    if options.cache_dir is not None:
+        ds = cache.store(options.cache_dir, key, ds, dict(data=str(data), part=part))
+        if options.cache_size_gb is not None:
+            cache.prune(options.cache_dir, cache.gb_to_bytes(options.cache_size_gb))
     return ds
+
+
+class AudioFolderStream(torch.utils.data.Dataset):
+    """Lazily read and preprocess the audio files of an AudioFolder
+
+    Each element is a pair of the file's name (relative to the AudioFolder) and its
+    normalized input values. Unlike :func:`load_partition`, nothing is decoded until
+    the element is requested and nothing is written to disk. Files are listed in the
+    order of the "file_name" column of "metadata.csv", or in sorted order if there is
+    no "metadata.csv".
+    """
+
+    def __init__(self, data: Path, processor: Wav2Vec2Processor):
+        self.data = data
+        self.feature_extractor = processor.feature_extractor
+        metadata_csv = data / "metadata.csv"
+        if metadata_csv.is_file():
+            with metadata_csv.open(newline="") as fp:
+                self.file_names = [row["file_name"] for row in csv.DictReader(fp)]
+        else:
+            self.file_names = sorted(
+                pth.relative_to(data).as_posix()
+                for pth in data.rglob("*")
+                if pth.suffix.lower() in AUDIO_SUFFIXES
+            )
+
+    def __len__(self) -> int:
+        return len(self.file_names)
+
+    def __getitem__(self, idx: int) -> tuple[str, list[float]]:
+        file_name = self.file_names[idx]
+        array, sampling_rate = soundfile.read(self.data / file_name, dtype="float32")
+        if array.ndim > 1:
+            array = array.mean(1)
+        target_rate = self.feature_extractor.sampling_rate
+        if sampling_rate != target_rate:
+            array = librosa.resample(
+                array, orig_sr=sampling_rate, target_sr=target_rate
+            )
+        input_values = self.feature_extractor(
+            array, sampling_rate=target_rate
+        ).input_values[0]
+        return file_name, input_values
+
+
+def unzip(elems: list[tuple]) -> tuple:
+    return tuple(zip(*elems))
+
+
+def stream_partition(
+    options: Options, processor: Wav2Vec2Processor
+) -> torch.utils.data.DataLoader:
+    """Batches of (file_names, input_values) preprocessed by background workers
+
+    At most ``--num-proc * --prefetch`` batches are queued at any time
+    """
+    ds = AudioFolderStream(options.data.absolute(), processor)
+    return torch.utils.data.DataLoader(
+        ds,
+        batch_size=options.batch_size,
+        num_workers=options.num_proc,
+        prefetch_factor=options.prefetch,
+        collate_fn=unzip,
+    )
@@ -14,53 +14,543 @@
 
 import os
 import re
+import sys
+import math
 import torch
+import multiprocessing
 
-from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor
+from typing import Callable, Iterable, Iterator, Optional, Sequence
+
+from datasets import Dataset
+from transformers import (
+    HubertForCTC,
+    PreTrainedModel,
+    Wav2Vec2ForCTC,
+    Wav2Vec2Processor,
+)
 from tqdm import tqdm
 
 from .args import Options
-from .data import load_partition
+from .data import load_partition, stream_partition
+from .logits import (
+    LogitsEncoding,
+    LogitsWriter,
+    encoding_from_options,
+    merge_indices,
+    write_index_file,
+)
+from .quantize import load_quantized, quantized_cache_path
 
 SPACE_PATTERN = re.compile(r"\s+")
 
+# maps the input values of an utterance to new ones
+Transform = Callable[[Sequence[float]], Sequence[float]]
 
-def decode(options: Options):
 
-    if torch.cuda.is_available():
-        device = torch.cuda.current_device()
+def get_device(options: Options):
+    # quantized linear layers only have CPU kernels. Multiple workers share the
+    # model's weights in (CPU) shared memory
+    if (
+        torch.cuda.is_available()
+        and options.quantize != "dynamic-int8"
+        and options.workers == 1
+    ):
+        return torch.cuda.current_device()
     else:
-        device = "cpu"
+        return "cpu"
 
-    model = Wav2Vec2ForCTC.from_pretrained(
-        options.model_dir, target_lang=options.lang
-    ).to(device)
-    processor = Wav2Vec2Processor.from_pretrained(
-        options.model_dir, target_lang=options.lang
+
+def load_model(
+    options: Options, load: Callable[[], PreTrainedModel], lang: str
+) -> PreTrainedModel:
+    if options.cache_quantized and options.quantize != "none":
+        cache_path = quantized_cache_path(options.model_dir, options.quantize, lang)
+    else:
+        cache_path = None
+    return load_quantized(load, options.quantize, cache_path)
+
+
+def model_loader(options: Options) -> tuple[Callable[[], PreTrainedModel], str]:
+    """A function loading the model in options.model_dir and the language it's for"""
+    if options.hubert:
+        return lambda: HubertForCTC.from_pretrained(options.model_dir), "fae"
+    else:
+        return (
+            lambda: Wav2Vec2ForCTC.from_pretrained(
+                options.model_dir, target_lang=options.lang
+            ),
+            options.lang,
+        )
+
+
+def batch_indices(
+    lengths: Sequence[int], batch_size: int, max_batch_len: Optional[int] = None
+) -> list[list[int]]:
+    """Group utterance indices into batches of similar length
+
+    Indices are sorted by decreasing length so that each batch pads as little as
+    possible. A batch holds at most `batch_size` utterances and, if `max_batch_len` is
+    set, at most `max_batch_len` padded samples. An utterance longer than
+    `max_batch_len` is given a batch of its own.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches, batch = [], []
+    for idx in order:
+        # the first utterance in the batch is the longest
+        if batch and (
+            len(batch) == batch_size
+            or (
+                max_batch_len is not None
+                and lengths[batch[0]] * (len(batch) + 1) > max_batch_len
+            )
+        ):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+@torch.inference_mode()
+def compute_logits(
+    model: PreTrainedModel,
+    processor: Wav2Vec2Processor,
+    input_values: Sequence[Sequence[float]],
+    device,
+) -> list[torch.Tensor]:
+    """Batch already-normalized inputs and return per-utterance logits
+
+    Padding is stripped from the returned logits, which have shape ``(T_n, V)``.
+    """
+    inputs = processor.pad(
+        [{"input_values": x} for x in input_values],
+        padding=True,
+        return_tensors="pt",
     )
+    kwargs = dict()
+    if "attention_mask" in inputs:
+        kwargs["attention_mask"] = inputs.attention_mask.to(device)
+    values = inputs.input_values.to(device=device, dtype=model.dtype)
+    logits = model(values, **kwargs).logits.float().cpu()
+    lens = model._get_feat_extract_output_lengths(
+        torch.tensor([len(x) for x in input_values])
+    ).tolist()
+    return [logits_[:len_] for logits_, len_ in zip(logits, lens)]
+
 
+def chunk_starts(num_samples: int, chunk_len: int, stride: int) -> list[int]:
+    """Start samples of windows of chunk_len every stride samples covering the input"""
+    starts = [0]
+    while starts[-1] + chunk_len < num_samples:
+        starts.append(starts[-1] + stride)
+    return starts
+
+
+def stitch_logits(
+    chunk_logits: Sequence[torch.Tensor],
+    starts: Sequence[int],
+    overlap_len: int,
+    frame_len: int,
+    num_frames: int,
+) -> torch.Tensor:
+    """Join the logits of overlapping windows into those of the whole input
+
+    Where two windows overlap, frames before the middle of the overlap are taken from
+    the earlier window and the rest from the later one, so that every frame comes from
+    the window in which it has the most context on both sides. `starts` must be
+    multiples of `frame_len`.
+    """
+    pieces, begin = [], 0
+    for i, (logits, start) in enumerate(zip(chunk_logits, starts)):
+        offset = start // frame_len
+        if i + 1 < len(starts):
+            end = (starts[i + 1] + overlap_len // 2) // frame_len
+        else:
+            end = num_frames
+        pieces.append(logits[begin - offset : end - offset])
+        begin = end
+    return torch.cat(pieces)
+
+
+def compute_chunked_logits(
+    model: PreTrainedModel,
+    processor: Wav2Vec2Processor,
+    input_values: Sequence[Sequence[float]],
+    device,
+    chunk_len: int,
+    overlap_len: int,
+    batch_size: int,
+) -> list[torch.Tensor]:
+    """Like compute_logits, but run the model on overlapping windows of the input
+
+    Attention memory is bounded by `chunk_len` regardless of the length of the input.
+    The windows of all inputs are batched together, `batch_size` at a time.
+    """
+    # align windows with frame boundaries so frames can be mapped between them
+    frame_len = math.prod(model.config.conv_stride)
+    chunk_len = max(chunk_len // frame_len, 1) * frame_len
+    overlap_len = min(overlap_len // frame_len * frame_len, chunk_len - frame_len)
+    stride = chunk_len - overlap_len
+
+    all_starts, chunks = [], []
+    for values in input_values:
+        starts = chunk_starts(len(values), chunk_len, stride)
+        all_starts.append(starts)
+        chunks.extend(values[start : start + chunk_len] for start in starts)
+
+    chunk_logits = []
+    for i in range(0, len(chunks), batch_size):
+        chunk_logits.extend(
+            compute_logits(model, processor, chunks[i : i + batch_size], device)
+        )
+
+    num_frames = model._get_feat_extract_output_lengths(
+        torch.tensor([len(x) for x in input_values])
+    ).tolist()
+    logits, i = [], 0
+    for starts, num_frames_ in zip(all_starts, num_frames):
+        logits.append(
+            stitch_logits(
+                chunk_logits[i : i + len(starts)],
+                starts,
+                overlap_len,
+                frame_len,
+                num_frames_,
+            )
+        )
+        i += len(starts)
+    return logits
+
+
+def sorted_partition(
+    options: Options, processor: Wav2Vec2Processor
+) -> tuple[Dataset, list[list[int]]]:
+    """Load the partition to decode and batch it by decreasing length"""
     ds = load_partition(options, "decode", processor)
+    return ds, partition_batches(options, processor, ds)
+
+
+def partition_batches(
+    options: Options, processor: Wav2Vec2Processor, ds: Dataset
+) -> list[list[int]]:
+    if options.max_batch_seconds is None:
+        max_batch_len = None
+    else:
+        max_batch_len = int(
+            options.max_batch_seconds * processor.feature_extractor.sampling_rate
+        )
+    return batch_indices(ds["input_length"], options.batch_size, max_batch_len)
+
 
-    metadata_csv = options.metadata_csv.open("w")
-    metadata_csv.write("file_name,sentence\n")
+def iter_batches(
+    ds: Dataset, batches: Iterable[list[int]]
+) -> Iterator[tuple[list[int], Sequence[str], Sequence[Sequence[float]]]]:
+    for batch in batches:
+        elems = ds[batch]
+        yield batch, elems["file_name"], elems["input_values"]
 
+
+def streamed_batches(
+    options: Options, processor: Wav2Vec2Processor
+) -> Iterator[tuple[list[int], Sequence[str], Sequence[Sequence[float]]]]:
+    start = 0
+    for file_names, input_values in stream_partition(options, processor):
+        yield list(range(start, start + len(file_names))), file_names, input_values
+        start += len(file_names)
+
+
+def decode_batches(
+    options: Options,
+    model: PreTrainedModel,
+    processor: Wav2Vec2Processor,
+    device,
+    batches: Iterable[tuple[list[int], Sequence[str], Sequence[Sequence[float]]]],
+    logits_writer: Optional[LogitsWriter] = None,
+    transform: Optional[Transform] = None,
+) -> Iterator[list[tuple[int, str]]]:
+    """Decode batches, yielding the indexed metadata.csv rows of each
+
+    If `options.logits_dir` is set, logits are saved to it, or to `logits_writer` if
+    that is set. If `transform` is set, it is applied to each utterance's input
+    values before they're batched.
+    """
+    sampling_rate = processor.feature_extractor.sampling_rate
+    for batch, file_names, input_values in batches:
+        if transform is not None:
+            input_values = [transform(x) for x in input_values]
+        if options.chunk_seconds is None:
+            batch_logits = compute_logits(model, processor, input_values, device)
+        else:
+            batch_logits = compute_chunked_logits(
+                model,
+                processor,
+                input_values,
+                device,
+                int(options.chunk_seconds * sampling_rate),
+                int(options.chunk_overlap_seconds * sampling_rate),
+                options.batch_size,
+            )
+        rows = []
+        for idx, file_name, logits in zip(batch, file_names, batch_logits):
+            if options.logits_dir is not None:
+                utt = os.path.splitext(file_name)[0]
+                logits_ = logits[:, : processor.tokenizer.vocab_size]
+                if logits_writer is not None:
+                    logits_writer.write(utt, logits_.float().numpy())
+                else:
+                    logits_ = logits_.to(getattr(torch, options.logits_dtype))
+                    torch.save(logits_.clone(), options.logits_dir / (utt + ".pt"))
+            text = processor.decode(logits.argmax(-1))
+            text = SPACE_PATTERN.sub(" ", text)
+            rows.append((idx, f"{file_name},{text}\n"))
+        yield rows
+
+
+def shard_batches(
+    batches: Sequence[list[int]], lengths: Sequence[int], num_shards: int
+) -> list[list[list[int]]]:
+    """Split batches into num_shards shards of roughly equal total audio
+
+    Batches are handed out longest first, each to the shard with the least audio so
+    far.
+    """
+    shards = [[] for _ in range(num_shards)]
+    totals = [0] * num_shards
+    padded = [max(lengths[i] for i in batch) * len(batch) for batch in batches]
+    for idx in sorted(range(len(batches)), key=padded.__getitem__, reverse=True):
+        shard = min(range(num_shards), key=totals.__getitem__)
+        shards[shard].append(batches[idx])
+        totals[shard] += padded[idx]
+    return shards
+
+
+def _decode_shard(
+    options: Options,
+    model: PreTrainedModel,
+    processor: Wav2Vec2Processor,
+    ds: Dataset,
+    batches: Sequence[list[int]],
+    encoding: Optional[LogitsEncoding],
+    worker: int,
+    num_threads: int,
+    queue: multiprocessing.Queue,
+    transform: Optional[Transform],
+):
+    torch.set_num_threads(num_threads)
+    try:
+        logits_writer = None
+        if options.logits_dir is not None and options.logits_format == "store":
+            logits_writer = LogitsWriter(
+                options.logits_dir, encoding, prefix=f"shard-w{worker:03d}"
+            )
+        for rows in decode_batches(
+            options,
+            model,
+            processor,
+            "cpu",
+            iter_batches(ds, batches),
+            logits_writer,
+            transform,
+        ):
+            queue.put(("rows", rows))
+        if logits_writer is not None:
+            logits_writer.close(write_index=False)
+            queue.put(("done", logits_writer.index()))
+        else:
+            queue.put(("done", None))
+    except BaseException as e:
+        queue.put(("error", f"worker {worker}: {type(e).__name__}: {e}"))
+        raise
+
+
+def decode_sharded(
+    options: Options,
+    model: PreTrainedModel,
+    processor: Wav2Vec2Processor,
+    ds: Dataset,
+    batches: Sequence[list[int]],
+    encoding: Optional[LogitsEncoding] = None,
+    transform: Optional[Transform] = None,
+) -> Iterator[list[tuple[int, str]]]:
+    """Like decode_batches, but split over options.workers forked CPU processes
+
+    The model is moved to shared memory before forking so that the workers share one
+    copy of its weights. Each worker writes logits to shards of its own in a store,
+    whose indices are merged once all workers are done.
+    """
+    # share_memory() moves parameters and buffers. The packed weights of dynamically
+    # quantized layers aren't among them, but since nothing writes to them they stay
+    # shared copy-on-write
+    model.share_memory()
+    num_threads = options.threads_per_worker
+    if num_threads is None:
+        num_threads = max((os.cpu_count() or 1) // options.workers, 1)
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    procs = [
+        ctx.Process(
+            target=_decode_shard,
+            args=(
+                options,
+                model,
+                processor,
+                ds,
+                shard,
+                encoding,
+                worker,
+                num_threads,
+                queue,
+                transform,
+            ),
+            daemon=True,
+        )
+        for worker, shard in enumerate(
+            shard_batches(batches, ds["input_length"], options.workers)
+        )
+    ]
+    for proc in procs:
+        proc.start()
+    try:
+        indices, num_done = [], 0
+        while num_done < len(procs):
+            kind, msg = queue.get()
+            if kind == "rows":
+                yield msg
+            elif kind == "done":
+                num_done += 1
+                if msg is not None:
+                    indices.append(msg)
+            else:
+                raise RuntimeError(msg)
+        for proc in procs:
+            proc.join()
+    finally:
+        for proc in procs:
+            if proc.is_alive():
+                proc.terminate()
+    if indices:
+        write_index_file(options.logits_dir, merge_indices(indices))
+
+
+def decode_partition(
+    options: Options,
+    model: PreTrainedModel,
+    processor: Wav2Vec2Processor,
+    device,
+    ds: Optional[Dataset] = None,
+    transform: Optional[Transform] = None,
+):
+    """Decode the partition in options.data, writing options.metadata_csv
+
+    If `ds` is set, it is decoded in place of the partition, as loaded by
+    :func:`sorted_partition`. `transform` is passed to :func:`decode_batches`.
+    """
+    if options.batch_size > 1 and not processor.feature_extractor.return_attention_mask:
+        print(
+            "The feature extractor does not return an attention mask, so padding "
+            "may change the output of batched decoding. Set --batch-size 1 to "
+            "reproduce unbatched decoding",
+            file=sys.stderr,
+        )
+
+    # check the options before the logits directory or store is created, so that a
+    # bad command line doesn't touch the disk
+    if options.workers > 1 and options.streaming:
+        print("--workers cannot be combined with --streaming", file=sys.stderr)
+        return 1
+
+    if options.chunk_seconds is not None and (
+        options.chunk_overlap_seconds >= options.chunk_seconds
+    ):
+        print(
+            "--chunk-overlap-seconds must be less than --chunk-seconds",
+            file=sys.stderr,
+        )
+        return 1
+
+    logits_writer = encoding = None
     if options.logits_dir is not None:
+        encoding = encoding_from_options(options, processor.tokenizer.pad_token_id)
+        if options.logits_format == "pt" and encoding.pruned:
+            print(
+                "--logits-top-k, --logits-blank-threshold, and --logits-quantize "
+                "require --logits-format store",
+                file=sys.stderr,
+            )
+            return 1
         options.logits_dir.mkdir(exist_ok=True)
+        if options.logits_format == "store" and options.workers == 1:
+            logits_writer = LogitsWriter(options.logits_dir, encoding)
 
-    for elem in tqdm(ds):
-        input_dict = processor(
-            elem["input_values"],
-            sampling_rate=processor.feature_extractor.sampling_rate,
-            return_tensors="pt",
-            padding=True,
+    if options.streaming and ds is None:
+        batches = decode_batches(
+            options,
+            model,
+            processor,
+            device,
+            streamed_batches(options, processor),
+            logits_writer,
+            transform,
         )
-        logits = model(input_dict.input_values.to(device)).logits.cpu()
-        if options.logits_dir is not None:
-            pt = options.logits_dir / (os.path.splitext(elem["file_name"])[0] + ".pt")
-            torch.save(logits[0, :, : processor.tokenizer.vocab_size], pt)
-        greedy_path = logits.argmax(-1)[0]
-        text = processor.decode(greedy_path)
-        text = SPACE_PATTERN.sub(" ", text)
-        metadata_csv.write(f"{elem['file_name']},{text}\n")
+    else:
+        if ds is None:
+            ds, batches = sorted_partition(options, processor)
+        else:
+            batches = partition_batches(options, processor, ds)
+        if options.workers > 1:
+            batches = decode_sharded(
+                options, model, processor, ds, batches, encoding, transform
+            )
+        else:
+            batches = decode_batches(
+                options,
+                model,
+                processor,
+                device,
+                iter_batches(ds, batches),
+                logits_writer,
+                transform,
+            )
+
+    with options.metadata_csv.open("w") as metadata_csv:
+        metadata_csv.write("file_name,sentence\n")
+
+        # rows are written as soon as all rows before them have been, so the csv is
+        # in the original order whether or not the batches are
+        pending: dict[int, str] = dict()
+        next_idx = 0
+        pbar = tqdm(unit="utt")
+        for rows in batches:
+            pending.update(rows)
+            while next_idx in pending:
+                metadata_csv.write(pending.pop(next_idx))
+                next_idx += 1
+            if options.streaming:
+                metadata_csv.flush()
+            pbar.update(len(rows))
+        pbar.close()
+        assert not pending
+
+    if logits_writer is not None:
+        logits_writer.close()
 
     return 0
+
+
+def decode(options: Options):
+
+    device = get_device(options)
+
+    model = load_model(
+        options,
+        lambda: Wav2Vec2ForCTC.from_pretrained(
+            options.model_dir, target_lang=options.lang
+        ),
+        options.lang,
+    ).to(device)
+    processor = Wav2Vec2Processor.from_pretrained(
+        options.model_dir, target_lang=options.lang
+    )
+
+    return decode_partition(options, model, processor, device)
@@ -12,55 +12,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import os
-import re
-import torch
-
 from transformers import HubertForCTC, Wav2Vec2Processor
-from tqdm import tqdm
 
 from .args import Options
-from .data import load_partition
-
-SPACE_PATTERN = re.compile(r"\s+")
+from .decode import decode_partition, get_device, load_model
 
 
 def decode(options: Options):
 
-    if torch.cuda.is_available():
-        device = torch.cuda.current_device()
-    else:
-        device = "cpu"
+    device = get_device(options)
 
-    model = HubertForCTC.from_pretrained(
-        options.model_dir
+    model = load_model(
+        options, lambda: HubertForCTC.from_pretrained(options.model_dir), "fae"
     ).to(device)
     processor = Wav2Vec2Processor.from_pretrained(
         options.model_dir, target_lang="fae"
     )
 
-    ds = load_partition(options, "decode", processor)
-
-    metadata_csv = options.metadata_csv.open("w")
-    metadata_csv.write("file_name,sentence\n")
-
-    if options.logits_dir is not None:
-        options.logits_dir.mkdir(exist_ok=True)
-
-    for elem in tqdm(ds):
-        input_dict = processor(
-            elem["input_values"],
-            sampling_rate=processor.feature_extractor.sampling_rate,
-            return_tensors="pt",
-            padding=True,
-        )
-        logits = model(input_dict.input_values.to(device)).logits.cpu()
-        if options.logits_dir is not None:
-            pt = options.logits_dir / (os.path.splitext(elem["file_name"])[0] + ".pt")
-            torch.save(logits[0, :, : processor.tokenizer.vocab_size], pt)
-        greedy_path = logits.argmax(-1)[0]
-        text = processor.decode(greedy_path)
-        text = SPACE_PATTERN.sub(" ", text)
-        metadata_csv.write(f"{elem['file_name']},{text}\n")
-
-    return 0
+    return decode_partition(options, model, processor, device)
@@ -0,0 +1,117 @@
+# Copyright 2024 Sean Robertson
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Noise is mixed into the normalized input values of the (clean) partition rather than
+# into its audio. The feature extractor's normalization only shifts and scales an
+# utterance, and the SNR is scale invariant, so mixing and then normalizing again
+# matches normalizing audio written by boothroyd/add_noise.py, up to the quantization
+# and clipping of writing it.
+
+import os
+import sys
+
+from copy import copy
+from pathlib import Path
+from typing import Sequence
+
+import numpy as np
+
+from transformers import Wav2Vec2FeatureExtractor, Wav2Vec2Processor
+
+from ..boothroyd.add_noise import SOX_MIX_GAIN, load_noise, mix_at_snrs
+from .args import Options
+from .data import load_partition
+from .decode import Transform, decode_partition, get_device, load_model, model_loader
+from .io import metadata_to_trn
+
+
+def snr_path(template: Path, snr: float) -> Path:
+    return Path(os.fspath(template).replace("{snr}", f"{snr:g}"))
+
+
+def noisy_transform(
+    feature_extractor: Wav2Vec2FeatureExtractor,
+    noise: np.ndarray,
+    snr: float,
+    signal_gain: float = SOX_MIX_GAIN,
+) -> Transform:
+    """Return a function mixing noise into input values at snr and renormalizing"""
+
+    def transform(input_values: Sequence[float]) -> np.ndarray:
+        x = np.asarray(input_values, dtype=np.float32)
+        (mixed,) = mix_at_snrs(x, noise, [snr], signal_gain)
+        return feature_extractor(
+            mixed, sampling_rate=feature_extractor.sampling_rate
+        ).input_values[0]
+
+    return transform
+
+
+def decode_noisy(options: Options):
+
+    for template in (options.metadata_csv, options.logits_dir):
+        if template is not None and "{snr}" not in os.fspath(template):
+            print(
+                f"'{template}' must contain '{{snr}}' so that each SNR gets its own "
+                "output",
+                file=sys.stderr,
+            )
+            return 1
+
+    device = get_device(options)
+    load, lang = model_loader(options)
+    model = load_model(options, load, lang).to(device)
+    processor = Wav2Vec2Processor.from_pretrained(options.model_dir, target_lang=lang)
+    feature_extractor = processor.feature_extractor
+
+    ds = load_partition(options, "decode", processor)
+    noise = load_noise(
+        options.noise_dir,
+        options.noise_type,
+        max(ds["input_length"], default=0),
+        options.noise_seed,
+        feature_extractor.sampling_rate,
+    )
+
+    for snr in options.snrs:
+        options_ = copy(options)
+        csv = snr_path(options.metadata_csv, snr)
+        options_.trn = csv.with_suffix(".trn")
+        if options_.trn.is_file():
+            print(f"'{options_.trn}' exists. Skipping SNR {snr:g}", file=sys.stderr)
+            continue
+        options_.metadata_csv = csv.with_name(csv.name + "_")
+        if options.logits_dir is not None:
+            options_.logits_dir = snr_path(options.logits_dir, snr)
+        print(f"Decoding '{options.data}' at SNR {snr:g}", file=sys.stderr)
+        status = decode_partition(
+            options_,
+            model,
+            processor,
+            device,
+            ds,
+            noisy_transform(
+                feature_extractor,
+                noise,
+                snr,
+                1.0 if options.true_snr else SOX_MIX_GAIN,
+            ),
+        )
+        if status:
+            return status
+        os.replace(options_.metadata_csv, csv)
+        options_.metadata_csv = csv
+        metadata_to_trn(options_)
+
+    return 0
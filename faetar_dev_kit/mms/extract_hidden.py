@@ -11,7 +11,7 @@
 # limitations under the License.
 
 import os
-import sys
+import argparse
 import torch
 
 from pathlib import Path
@@ -19,13 +19,27 @@ from datasets import load_dataset, Audio
 from transformers import Wav2Vec2ForCTC, Wav2Vec2Processor
 from tqdm import tqdm
 
-def extract_hidden(hidden_dir, model_dir, data_dir, lang):
+try:
+    from .quantize import QUANTIZE_SCHEMES, load_quantized, quantized_cache_path
+except ImportError:  # run as a script
+    from quantize import QUANTIZE_SCHEMES, load_quantized, quantized_cache_path
+
+def extract_hidden(hidden_dir, model_dir, data_dir, lang, quantize="none",
+                   cache_quantized=False):
     hidden_dir = Path(hidden_dir).resolve()
     data_dir = Path(data_dir).resolve()
 
-    model = Wav2Vec2ForCTC.from_pretrained(model_dir, target_lang=lang,
-                                           output_hidden_states=True,
-                                           ignore_mismatched_sizes=True)
+    if cache_quantized and quantize != "none":
+        cache_path = quantized_cache_path(Path(model_dir), quantize, lang)
+    else:
+        cache_path = None
+    model = load_quantized(
+        lambda: Wav2Vec2ForCTC.from_pretrained(model_dir, target_lang=lang,
+                                               output_hidden_states=True,
+                                               ignore_mismatched_sizes=True),
+        quantize,
+        cache_path,
+    )
 
     processor = Wav2Vec2Processor.from_pretrained(model_dir, target_lang=lang,
                                                   ignore_mismatched_sizes=True)
@@ -50,18 +64,33 @@ def extract_hidden(hidden_dir, model_dir, data_dir, lang):
             return_tensors="pt",
             padding=True,
         )
-        states = model(inputs.input_values).hidden_states
+        with torch.inference_mode():
+            states = model(inputs.input_values.to(model.dtype),
+                           output_hidden_states=True).hidden_states
 
         for i in [12, 24, 36, 46, 47, 48]:
             filename = os.path.splitext(Path(audio["path"]).relative_to(data_dir).as_posix())[0]
             partition = data_dir.name
             out_path = f"{hidden_dir}/layer_{i}/{partition}/feat/{filename}.pt"
             os.makedirs(os.path.split(out_path)[0], exist_ok=True)
-            torch.save(torch.squeeze(states[i]), out_path)
+            torch.save(torch.squeeze(states[i]).float(), out_path)
 
     return states
 
 if __name__ == "__main__":
-    _, hidden, model, data, lang, *_ = sys.argv
-    extract_hidden(hidden, model, data, lang)
+    parser = argparse.ArgumentParser(
+        description="Save the hidden states of an mms model on an AudioFolder"
+    )
+    parser.add_argument("--quantize", choices=QUANTIZE_SCHEMES, default="none",
+                        help="Quantize the model for inference")
+    parser.add_argument("--cache-quantized", action="store_true", default=False,
+                        help="Save the quantized model in the model directory and "
+                        "load it from there in subsequent runs")
+    parser.add_argument("hidden_dir")
+    parser.add_argument("model_dir")
+    parser.add_argument("data_dir")
+    parser.add_argument("lang")
+    args = parser.parse_args()
+    extract_hidden(args.hidden_dir, args.model_dir, args.data_dir, args.lang,
+                   args.quantize, args.cache_quantized)
 
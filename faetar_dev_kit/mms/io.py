@@ -21,11 +21,22 @@ from re import compile
 from tqdm import tqdm
 
 from csv import DictReader
+from pathlib import Path
 from collections import Counter
 
-import jiwer
+import numpy as np
 
+from ..scoring import DEL, INS, SUB, edit_counts, tokenize
 from .args import Options
+from .logits import (
+    LogitsReader,
+    LogitsWriter,
+    beam_ids,
+    encoding_from_options,
+    greedy_ids_batch,
+    is_logits_store,
+    log_softmax,
+)
 
 
 def compile_metadata(options: Options):
@@ -123,6 +134,42 @@ def write_vocab(options: Options):
 
     return 0
 
+def evaluate(options: Options):
+
+    def read_sentences(csv):
+        return dict(
+            (row["file_name"], row["sentence"])
+            for row in DictReader(csv.open(newline=""), delimiter=",")
+        )
+
+    refs, hyps = read_sentences(options.ref_csv), read_sentences(options.hyp_csv)
+    if refs.keys() != hyps.keys():
+        print(
+            f"'{options.ref_csv}' and '{options.hyp_csv}' have different files!",
+            file=sys.stderr,
+        )
+        diff = sorted(refs.keys() - hyps.keys())
+        if diff:
+            print("Missing from hyp: " + " ".join(diff), file=sys.stderr)
+        diff = sorted(hyps.keys() - refs.keys())
+        if diff:
+            print("Missing from ref: " + " ".join(diff), file=sys.stderr)
+        return 1
+
+    keys = sorted(refs)
+    refs = [tokenize(refs[key], options.error_type) for key in keys]
+    hyps = [tokenize(hyps[key], options.error_type) for key in keys]
+    counts = edit_counts(refs, hyps).sum(0)
+    num_ref_tokens = sum(len(ref) for ref in refs)
+    print(
+        f"{options.error_type}: {counts.sum() / max(num_ref_tokens, 1):.2%} "
+        f"({counts[SUB]} substitutions, {counts[INS]} insertions, {counts[DEL]} "
+        f"deletions, {num_ref_tokens} reference tokens)"
+    )
+
+    return 0
+
+
 def metadata_to_trn(options: Options):
 
     trn = [
@@ -147,3 +194,124 @@ def vocab_to_token2id(options: Options):
         fp.write(f"{token} {id_}\n")
 
     return 0
+
+
+def _changes(refs: list[np.ndarray], hyps: list[np.ndarray]) -> tuple[int, float]:
+    """The number of hyps which differ from refs, and their token error rate"""
+    num_changed = sum(not np.array_equal(ref, hyp) for ref, hyp in zip(refs, hyps))
+    num_edits = edit_counts(refs, hyps).sum()
+    return num_changed, num_edits / max(sum(len(ref) for ref in refs), 1)
+
+
+def _read_trn(trn: Path) -> dict[str, str]:
+    utts = dict()
+    with trn.open() as fp:
+        for line in fp:
+            text, _, utt = line.strip().rpartition(" ")
+            if utt:
+                utts[utt.strip("()")] = text
+    return utts
+
+
+def _wer(
+    refs: list[list[str]], hyps: list[np.ndarray], id2token: np.ndarray, delim: str
+) -> float:
+    """The WER of the token ids hyps against the words of refs"""
+    hyps = [tokenize("".join(id2token[ids]).replace(delim, " "), "wer") for ids in hyps]
+    return edit_counts(refs, hyps).sum() / max(sum(len(ref) for ref in refs), 1)
+
+
+def compress_logits(options: Options):
+
+    if not is_logits_store(options.logits_dir):
+        print(
+            f"'{options.logits_dir}' is not a logits store. Dump logits with "
+            "--logits-format store",
+            file=sys.stderr,
+        )
+        return 1
+    src = LogitsReader(options.logits_dir)
+    blank_id = options.blank_id % src.vocab_size
+    encoding = encoding_from_options(options, blank_id)
+
+    ref_words = None
+    if options.ref_trn is not None:
+        if options.ref_vocab_json is None:
+            print("--ref-trn requires --ref-vocab-json", file=sys.stderr)
+            return 1
+        ref_texts = _read_trn(options.ref_trn)
+        missing = sorted(set(src) - ref_texts.keys())
+        if missing:
+            print(
+                f"'{options.ref_trn}' is missing utterances: " + " ".join(missing),
+                file=sys.stderr,
+            )
+            return 1
+        ref_words = [tokenize(ref_texts[utt], "wer") for utt in src]
+        token2id = json.load(options.ref_vocab_json.open())[options.lang]
+        id2token = np.full(src.vocab_size, "", dtype=object)
+        for token, id_ in token2id.items():
+            if id_ < src.vocab_size and id_ != blank_id:
+                id2token[id_] = token
+
+    with LogitsWriter(options.compressed_logits_dir, encoding) as writer:
+        for utt in tqdm(src, f"Compressing {options.logits_dir}"):
+            writer.write(utt, np.asarray(src[utt], dtype=np.float32))
+    dst = LogitsReader(options.compressed_logits_dir)
+
+    src_bytes = sum(src.nbytes(utt) for utt in src)
+    dst_bytes = sum(dst.nbytes(utt) for utt in src)
+    refs = greedy_ids_batch([src[utt].argmax(1) for utt in src], blank_id)
+    hyps = greedy_ids_batch([dst[utt].argmax(1) for utt in src], blank_id)
+    refs, hyps = [x.astype(np.int32) for x in refs], [x.astype(np.int32) for x in hyps]
+    num_changed, rate = _changes(refs, hyps)
+
+    print(
+        f"size: {src_bytes / (1 << 20):.1f} MiB -> {dst_bytes / (1 << 20):.1f} MiB "
+        f"({src_bytes / max(dst_bytes, 1):.1f}x smaller)"
+    )
+    print(
+        f"greedy hypotheses changed: {num_changed} of {len(src)}; token error rate "
+        f"against the uncompressed greedy hypotheses: {rate:.2%}"
+    )
+    if ref_words is not None:
+        delim = options.word_delimiter
+        print(
+            f"greedy WER against '{options.ref_trn}': "
+            f"{_wer(ref_words, refs, id2token, delim):.2%} -> "
+            f"{_wer(ref_words, hyps, id2token, delim):.2%}"
+        )
+
+    if options.beam_width is not None:
+        # greedy decoding only sees the best token of a frame, but pruning and
+        # quantization change the others, which a beam search does see
+        width = options.beam_width
+        beams = []
+        stores = ((src, options.logits_dir), (dst, options.compressed_logits_dir))
+        for store, pth in stores:
+            beams.append(
+                [
+                    beam_ids(log_softmax(store[utt]), blank_id, width).astype(np.int32)
+                    for utt in tqdm(src, f"Beam searching {pth}")
+                ]
+            )
+        num_changed, rate = _changes(*beams)
+        print(
+            f"beam (width {width}) hypotheses changed: {num_changed} of {len(src)}; "
+            f"token error rate against the uncompressed beam hypotheses: {rate:.2%}"
+        )
+        if ref_words is not None:
+            print(
+                f"beam (width {width}) WER against '{options.ref_trn}': "
+                f"{_wer(ref_words, beams[0], id2token, delim):.2%} -> "
+                f"{_wer(ref_words, beams[1], id2token, delim):.2%}"
+            )
+        if rate > options.beam_tolerance:
+            print(
+                f"the beam token error rate exceeds --beam-tolerance "
+                f"({options.beam_tolerance:.2%})",
+                file=sys.stderr,
+            )
+            return 1
+
+    return 0
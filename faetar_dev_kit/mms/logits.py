@@ -0,0 +1,462 @@
+# Copyright 2024 Sean Robertson
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A logits store is a directory of raw, contiguous shard files and a JSON index.
+# Each utterance's logits are a C-contiguous (frames, vocab) array at some byte
+# offset of some shard, so reading one is a single np.memmap call. This module
+# only depends on NumPy so that scripts outside the package can read stores.
+#
+# Stores may also be pruned. Pruned stores hold log-probabilities rather than
+# logits and any combination of
+#
+# - runs: consecutive frames whose blank probability exceeds a threshold are stored
+#   once, with a uint32 count of how many frames they stand for;
+# - top-k: only the k most likely tokens per frame are stored, with their uint16
+#   ids. The remaining probability mass is spread evenly over the other tokens on
+#   reading;
+# - quantization: log-probabilities are clamped to [-QUANTIZE_RANGE, 0] and stored
+#   as uint8.
+#
+# An utterance in a pruned store is laid out as [runs][ids] vals, contiguously.
+# Reading expands it back to a dense (frames, vocab) float32 array. Since all
+# hypotheses share the same number of frames, the per-frame normalization of the
+# log-softmax shifts all hypothesis scores equally and does not change the search.
+
+import os
+import json
+import math
+
+from typing import Iterator, Literal, Mapping, Optional, Sequence
+from pathlib import Path
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+SHARD_PATTERN = "{prefix}-{no:05d}.bin"
+DEFAULT_SHARD_BYTES = 1 << 30
+FORMAT_VERSION = 2
+QUANTIZE_RANGE = 24.0
+MIN_RESIDUAL = 1e-10
+# the smallest blank threshold which new stores and decodes may merge frames with.
+# See kept_frames
+MIN_BLANK_THRESHOLD = 0.5
+
+LogitsDtype = Literal["float32", "float16", "bfloat16"]
+LOGITS_DTYPES = ("float32", "float16", "bfloat16")
+
+# NumPy has no bfloat16. We store its bits as uint16
+STORAGE_DTYPES = {"float32": "<f4", "float16": "<f2", "bfloat16": "<u2"}
+
+
+def float32_to_bfloat16_bits(x: np.ndarray) -> np.ndarray:
+    bits = np.ascontiguousarray(x, dtype=np.float32).view(np.uint32)
+    # round to nearest even
+    bits = bits + (0x7FFF + ((bits >> 16) & 1))
+    return (bits >> 16).astype(np.uint16)
+
+
+def bfloat16_bits_to_float32(x: np.ndarray) -> np.ndarray:
+    return (x.astype(np.uint32) << 16).view(np.float32)
+
+
+def log_softmax(x: np.ndarray) -> np.ndarray:
+    x = x - x.max(1, keepdims=True)
+    return x - np.log(np.exp(x).sum(1, keepdims=True))
+
+
+def greedy_ids_batch(paths: Sequence[np.ndarray], blank_id: int) -> list[np.ndarray]:
+    """Best-path CTC decoding of the per-frame argmax ids of many utterances at once"""
+    if not len(paths):
+        return []
+    lens = np.fromiter(map(len, paths), np.int64, len(paths))
+    starts = np.cumsum(lens) - lens
+    path = np.concatenate(paths)
+    keep = np.ones(len(path), dtype=bool)
+    keep[1:] = path[1:] != path[:-1]
+    # repeats are only collapsed within an utterance
+    keep[starts[lens > 0]] = True
+    keep &= path != blank_id
+    kept = np.r_[0, np.cumsum(keep)]
+    counts = kept[starts + lens] - kept[starts]
+    return np.split(path[keep], np.cumsum(counts)[:-1])
+
+
+def greedy_ids(x: np.ndarray, blank_id: int) -> np.ndarray:
+    """Best-path CTC decoding of (frames, vocab) logits into token ids"""
+    return greedy_ids_batch([x.argmax(1)], blank_id)[0]
+
+
+def _logaddexp(a: float, b: float) -> float:
+    if a < b:
+        a, b = b, a
+    return a if b == -math.inf else a + math.log1p(math.exp(b - a))
+
+
+def beam_ids(x: np.ndarray, blank_id: int, width: int) -> np.ndarray:
+    """CTC prefix beam search of (frames, vocab) log-probabilities into token ids
+
+    There is no LM. Each frame extends the `width` most probable prefixes by the
+    `width` most probable tokens of the frame.
+    """
+    # prefix -> (log prob. of the paths ending in blank, those ending in a token)
+    beams: dict[tuple[int, ...], tuple[float, float]] = {(): (0.0, -math.inf)}
+    k = min(width, x.shape[1])
+    for frame in x:
+        tokens = np.argpartition(frame, -k)[-k:].tolist()
+        frame = frame.tolist()
+        next_: dict[tuple[int, ...], list[float]] = dict()
+
+        def add(prefix: tuple[int, ...], idx: int, logp: float):
+            probs = next_.setdefault(prefix, [-math.inf, -math.inf])
+            probs[idx] = _logaddexp(probs[idx], logp)
+
+        for prefix, (blank, nonblank) in beams.items():
+            total = _logaddexp(blank, nonblank)
+            add(prefix, 0, total + frame[blank_id])
+            for token in tokens:
+                if token == blank_id:
+                    continue
+                if prefix and prefix[-1] == token:
+                    # a repeat collapses unless a blank separates it
+                    add(prefix, 1, nonblank + frame[token])
+                    add(prefix + (token,), 1, blank + frame[token])
+                else:
+                    add(prefix + (token,), 1, total + frame[token])
+        beams = dict(sorted(next_.items(), key=lambda kv: -_logaddexp(*kv[1]))[:width])
+    best = max(beams, key=lambda prefix: _logaddexp(*beams[prefix]))
+    return np.array(best, dtype=np.int64)
+
+
+def kept_frames(x: np.ndarray, blank_id: int, blank_threshold: float) -> np.ndarray:
+    """Indices of the frames of (frames, vocab) log-probabilities x to keep
+
+    Each run of consecutive frames whose blank probability is at least blank_threshold
+    is merged into its first frame. Since a blank frame remains between the tokens on
+    either side of a run, repeated tokens separated by one stay distinct.
+
+    Merging is only safe if blank is the argmax of every merged frame, which a
+    blank_threshold of at least MIN_BLANK_THRESHOLD (0.5) guarantees. Below it, a frame
+    whose best token isn't blank can be dropped, changing even the greedy path.
+    """
+    confident = x[:, blank_id] >= np.log(blank_threshold)
+    # a frame is kept unless it continues a run of confident blanks
+    return np.flatnonzero(~confident | np.r_[True, ~confident[:-1]])
+
+
+def is_logits_store(pth: Path) -> bool:
+    return (pth / INDEX_FILE).is_file()
+
+
+@dataclass
+class LogitsEncoding:
+    """How logits are stored in a logits store
+
+    The default is dense, unnormalized logits of type `dtype`. Setting any of `top_k`,
+    `blank_threshold`, or `quantize` prunes the store. `blank_threshold` is a
+    probability and needs `blank_id`. `dtype` is ignored when `quantize` is set.
+    """
+
+    dtype: LogitsDtype = "float32"
+    top_k: int = 0
+    blank_id: Optional[int] = None
+    blank_threshold: Optional[float] = None
+    quantize: bool = False
+
+    def __post_init__(self):
+        if self.dtype not in LOGITS_DTYPES:
+            raise ValueError(
+                f"dtype must be one of {LOGITS_DTYPES}, got '{self.dtype}'"
+            )
+        if self.top_k < 0:
+            raise ValueError(f"top_k must be non-negative, got {self.top_k}")
+        if self.blank_threshold is not None:
+            if self.blank_id is None:
+                raise ValueError("blank_threshold requires blank_id")
+            if not 0 < self.blank_threshold <= 1:
+                raise ValueError(
+                    f"blank_threshold must be in (0, 1], got {self.blank_threshold}"
+                )
+
+    @property
+    def pruned(self) -> bool:
+        return bool(self.top_k) or self.blank_threshold is not None or self.quantize
+
+    @property
+    def vals_dtype(self) -> str:
+        return "u1" if self.quantize else STORAGE_DTYPES[self.dtype]
+
+
+def encoding_from_options(options, blank_id: Optional[int] = None) -> LogitsEncoding:
+    """Build an encoding from the --logits-* flags of mms.py"""
+    threshold = options.logits_blank_threshold
+    if threshold is not None and not MIN_BLANK_THRESHOLD <= threshold <= 1:
+        raise ValueError(
+            f"logits_blank_threshold must be in [{MIN_BLANK_THRESHOLD}, 1], got "
+            f"{threshold}"
+        )
+    return LogitsEncoding(
+        options.logits_dtype,
+        options.logits_top_k,
+        blank_id,
+        options.logits_blank_threshold,
+        options.logits_quantize,
+    )
+
+
+def encode_logits(
+    logits: np.ndarray, encoding: LogitsEncoding
+) -> tuple[list[np.ndarray], int]:
+    """Encode (frames, vocab) logits as a list of buffers and the number of frames"""
+    if not encoding.pruned:
+        if encoding.dtype == "bfloat16":
+            return [float32_to_bfloat16_bits(logits)], len(logits)
+        return [np.ascontiguousarray(logits, dtype=encoding.vals_dtype)], len(logits)
+
+    x = log_softmax(np.asarray(logits, dtype=np.float32))
+    bufs = []
+    if encoding.blank_threshold is not None:
+        keep = kept_frames(x, encoding.blank_id, encoding.blank_threshold)
+        bufs.append(np.diff(np.r_[keep, len(x)]).astype("<u4"))
+        x = x[keep]
+    if encoding.top_k and encoding.top_k < x.shape[1]:
+        if x.shape[1] > np.iinfo(np.uint16).max + 1:
+            raise ValueError(f"vocabulary of size {x.shape[1]} is too large for top-k")
+        ids = np.argpartition(-x, encoding.top_k - 1, axis=1)[:, : encoding.top_k]
+        x = np.take_along_axis(x, ids, 1)
+        bufs.append(ids.astype("<u2"))
+    if encoding.quantize:
+        x = np.rint(np.clip(-x / QUANTIZE_RANGE, 0, 1) * 255).astype("u1")
+    elif encoding.dtype == "bfloat16":
+        x = float32_to_bfloat16_bits(x)
+    bufs.append(np.ascontiguousarray(x, dtype=encoding.vals_dtype))
+    return bufs, len(x)
+
+
+class LogitsWriter(object):
+    """Write per-utterance logits to a logits store
+
+    Logits are appended to the current shard until it would exceed `shard_bytes`,
+    after which a new shard is started. The index is only written by
+    :func:`close`, so an interrupted write leaves no (partial) store behind.
+
+    Use as a context manager or call :func:`close` when done.
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        encoding: Optional[LogitsEncoding] = None,
+        shard_bytes: int = DEFAULT_SHARD_BYTES,
+        prefix: str = "shard",
+    ):
+        self.root = Path(root)
+        self.encoding = LogitsEncoding() if encoding is None else encoding
+        self.shard_bytes = shard_bytes
+        self.prefix = prefix
+        self.entries: dict[str, tuple[str, int, int, int]] = dict()
+        self.vocab_size: Optional[int] = None
+        self.shard_no = -1
+        self.shard_fp = None
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def _next_shard(self):
+        if self.shard_fp is not None:
+            self.shard_fp.close()
+        self.shard_no += 1
+        name = SHARD_PATTERN.format(prefix=self.prefix, no=self.shard_no)
+        self.shard_fp = (self.root / name).open("wb")
+        self.shard_name = name
+
+    def write(self, utt: str, logits: np.ndarray):
+        logits = np.asarray(logits)
+        if logits.ndim != 2:
+            raise ValueError(
+                f"expected logits of shape (frames, vocab), got {logits.shape}"
+            )
+        if self.vocab_size is None:
+            self.vocab_size = logits.shape[1]
+        elif logits.shape[1] != self.vocab_size:
+            raise ValueError(
+                f"'{utt}' has vocabulary size {logits.shape[1]}; expected "
+                f"{self.vocab_size}"
+            )
+        if utt in self.entries:
+            raise ValueError(f"'{utt}' was already written")
+        bufs, stored_frames = encode_logits(logits, self.encoding)
+        nbytes = sum(buf.nbytes for buf in bufs)
+        if self.shard_fp is None or (
+            self.shard_fp.tell() > 0
+            and self.shard_fp.tell() + nbytes > self.shard_bytes
+        ):
+            self._next_shard()
+        self.entries[utt] = (
+            self.shard_name,
+            self.shard_fp.tell(),
+            logits.shape[0],
+            stored_frames,
+        )
+        for buf in bufs:
+            self.shard_fp.write(buf.tobytes())
+
+    def index(self) -> dict:
+        return {
+            "version": FORMAT_VERSION,
+            "encoding": asdict(self.encoding),
+            "vocab_size": self.vocab_size,
+            "utts": [[utt, *self.entries[utt]] for utt in sorted(self.entries)],
+        }
+
+    def close(self, write_index: bool = True):
+        """Close the current shard and, if write_index, write the index
+
+        Writers sharing a store pass ``write_index=False`` and have their indices
+        combined with :func:`merge_indices` instead.
+        """
+        if self.shard_fp is not None:
+            self.shard_fp.close()
+            self.shard_fp = None
+        if write_index:
+            write_index_file(self.root, self.index())
+
+    def __enter__(self) -> "LogitsWriter":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.shard_fp is not None:
+            self.shard_fp.close()
+
+
+def write_index_file(root: Path, index: dict):
+    tmp = Path(root) / (INDEX_FILE + "_")
+    tmp.write_text(json.dumps(index))
+    os.replace(tmp, Path(root) / INDEX_FILE)
+
+
+def merge_indices(indices: Sequence[dict]) -> dict:
+    """Combine the indices of writers with distinct prefixes sharing one store"""
+    encoding, vocab_size, utts = None, None, dict()
+    for index in indices:
+        if encoding is None:
+            encoding = index["encoding"]
+        elif index["encoding"] != encoding:
+            raise ValueError("cannot merge indices with different encodings")
+        if index["vocab_size"] is not None:
+            if vocab_size is not None and index["vocab_size"] != vocab_size:
+                raise ValueError(
+                    f"cannot merge indices with vocabulary sizes {vocab_size} and "
+                    f"{index['vocab_size']}"
+                )
+            vocab_size = index["vocab_size"]
+        for entry in index["utts"]:
+            if entry[0] in utts:
+                raise ValueError(f"'{entry[0]}' is in more than one index")
+            utts[entry[0]] = entry
+    return {
+        "version": FORMAT_VERSION,
+        "encoding": encoding if encoding is not None else asdict(LogitsEncoding()),
+        "vocab_size": vocab_size,
+        "utts": [utts[utt] for utt in sorted(utts)],
+    }
+
+
+class LogitsReader(Mapping[str, np.ndarray]):
+    """Read-only mapping from utterance ids to logits in a logits store
+
+    Iteration is in sorted utterance order. For dense float32 and float16 stores,
+    values are zero-copy :class:`numpy.memmap` views of the shards. bfloat16 logits
+    are widened to float32 on access and pruned stores are expanded to dense float32
+    log-probabilities; :func:`raw` returns the stored buffers instead.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        index = json.loads((self.root / INDEX_FILE).read_text())
+        if index["version"] > FORMAT_VERSION:
+            raise ValueError(
+                f"'{self.root}' was written by a newer version (v{index['version']}) "
+                "of this module"
+            )
+        if index["version"] == 1:
+            self.encoding = LogitsEncoding(index["dtype"])
+            self.entries = dict((x[0], (*x[1:], x[3])) for x in index["utts"])
+        else:
+            self.encoding = LogitsEncoding(**index["encoding"])
+            self.entries = dict((x[0], tuple(x[1:])) for x in index["utts"])
+        self.vocab_size: int = index["vocab_size"]
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    def __contains__(self, utt) -> bool:
+        return utt in self.entries
+
+    def num_frames(self, utt: str) -> int:
+        return self.entries[utt][2]
+
+    def nbytes(self, utt: str) -> int:
+        return sum(x.nbytes for x in self.raw(utt).values())
+
+    def raw(self, utt: str) -> dict[str, np.ndarray]:
+        """The stored buffers of an utterance, as memory-mapped arrays
+
+        Dense stores only have "vals". Pruned stores may also have "runs" and "ids"
+        """
+        encoding = self.encoding
+        shard, offset, _, stored_frames = self.entries[utt]
+        layout = []
+        if encoding.blank_threshold is not None:
+            layout.append(("runs", "<u4", (stored_frames,)))
+        if encoding.top_k and encoding.top_k < self.vocab_size:
+            layout.append(("ids", "<u2", (stored_frames, encoding.top_k)))
+            cols = encoding.top_k
+        else:
+            cols = self.vocab_size
+        layout.append(("vals", encoding.vals_dtype, (stored_frames, cols)))
+        raw = dict()
+        for name, dtype, shape in layout:
+            if not stored_frames:  # can't memory-map zero bytes
+                raw[name] = np.empty(shape, dtype=dtype)
+                continue
+            raw[name] = np.memmap(
+                self.root / shard, dtype=dtype, mode="r", offset=offset, shape=shape
+            )
+            offset += raw[name].nbytes
+        return raw
+
+    def __getitem__(self, utt: str) -> np.ndarray:
+        encoding, raw = self.encoding, self.raw(utt)
+        vals = raw["vals"]
+        if encoding.quantize:
+            vals = vals.astype(np.float32) * (-QUANTIZE_RANGE / 255)
+        elif encoding.dtype == "bfloat16":
+            vals = bfloat16_bits_to_float32(vals)
+        if not encoding.pruned:
+            return vals
+        vals = np.asarray(vals, dtype=np.float32)
+        if "ids" in raw:
+            k = encoding.top_k
+            residual = np.maximum(1 - np.exp(vals).sum(1), MIN_RESIDUAL)
+            residual = np.log(residual / (self.vocab_size - k)).astype(np.float32)
+            x = np.repeat(residual[:, None], self.vocab_size, 1)
+            np.put_along_axis(x, raw["ids"].astype(np.intp), vals, 1)
+            vals = x
+        if "runs" in raw:
+            vals = np.repeat(vals, raw["runs"], 0)
+        return vals
@@ -0,0 +1,86 @@
+# Copyright 2024 Sean Robertson
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This module only imports torch so that extract_hidden.py can import it when run as
+# a script.
+
+import os
+
+from typing import Callable, Literal, Optional
+from pathlib import Path
+
+import torch
+
+QuantizeScheme = Literal["none", "dynamic-int8", "bf16"]
+QUANTIZE_SCHEMES = ("none", "dynamic-int8", "bf16")
+QUANTIZED_PREFIX = "quantized_"
+
+
+def quantize_model(model: torch.nn.Module, scheme: QuantizeScheme) -> torch.nn.Module:
+    """Quantize a model for inference, in place
+
+    "dynamic-int8" stores the weights of linear layers as int8 and quantizes their
+    activations on the fly. It only runs on CPU. "bf16" casts all parameters to
+    bfloat16; inputs must be cast to match.
+    """
+    if scheme == "none":
+        return model
+    elif scheme == "dynamic-int8":
+        return torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+        )
+    elif scheme == "bf16":
+        return model.to(torch.bfloat16)
+    else:
+        raise ValueError(f"scheme must be one of {QUANTIZE_SCHEMES}, got '{scheme}'")
+
+
+def quantized_cache_path(model_dir: Path, scheme: QuantizeScheme, lang: str) -> Path:
+    return model_dir / f"{QUANTIZED_PREFIX}{scheme}_{lang}.pt"
+
+
+def cache_is_fresh(cache_path: Path, model_dir: Path) -> bool:
+    """Whether cache_path is newer than every other file in model_dir"""
+    if not cache_path.is_file():
+        return False
+    mtime = cache_path.stat().st_mtime
+    return all(
+        pth.stat().st_mtime <= mtime
+        for pth in model_dir.iterdir()
+        if pth.is_file() and not pth.name.startswith(QUANTIZED_PREFIX)
+    )
+
+
+def load_quantized(
+    load_model: Callable[[], torch.nn.Module],
+    scheme: QuantizeScheme,
+    cache_path: Optional[Path] = None,
+) -> torch.nn.Module:
+    """Load a model with load_model, then quantize it
+
+    If cache_path is set, the quantized model is pickled there and, so long as it is
+    newer than the files next to it, loaded from there on subsequent calls without
+    calling load_model at all.
+    """
+    if scheme == "none":
+        return load_model()
+    if cache_path is not None and cache_is_fresh(cache_path, cache_path.parent):
+        model = torch.load(cache_path, map_location="cpu", weights_only=False)
+        return model.eval()
+    model = quantize_model(load_model(), scheme).eval()
+    if cache_path is not None:
+        tmp = cache_path.with_name(cache_path.name + "_")
+        torch.save(model, tmp)
+        os.replace(tmp, cache_path)
+    return model
@@ -0,0 +1,103 @@
+# Copyright 2024 Sean Robertson
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import json
+import signal
+import traceback
+import socketserver
+
+from transformers import PreTrainedModel, Wav2Vec2Processor
+
+from .args import Options
+from .client import connect, job_to_options
+from .decode import decode_partition, get_device, load_model, model_loader
+
+
+class DecodeServer(socketserver.UnixStreamServer):
+    """Decodes jobs sent to a Unix socket with a model which stays loaded
+
+    Jobs are decoded one at a time, in the order they're received.
+    """
+
+    def __init__(
+        self,
+        options: Options,
+        model: PreTrainedModel,
+        processor: Wav2Vec2Processor,
+        device,
+    ):
+        self.options = options
+        self.model = model
+        self.processor = processor
+        self.device = device
+        super().__init__(os.fspath(options.socket), DecodeHandler)
+
+    def decode(self, job: dict) -> int:
+        options = job_to_options(job, self.options)
+        print(f"Decoding '{options.data}' to '{options.metadata_csv}'", file=sys.stderr)
+        return decode_partition(options, self.model, self.processor, self.device)
+
+
+class DecodeHandler(socketserver.StreamRequestHandler):
+
+    server: DecodeServer
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                reply = {"status": self.server.decode(json.loads(line))}
+            except Exception as e:
+                traceback.print_exc()
+                reply = {"status": 1, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(reply) + "\n").encode())
+            self.wfile.flush()
+
+
+def _raise_exit(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def serve(options: Options):
+
+    if options.socket.is_socket():
+        try:
+            connect(options.socket, 0).close()
+        except ConnectionRefusedError:
+            # left behind by a server which didn't exit cleanly
+            options.socket.unlink()
+        else:
+            print(
+                f"A server is already listening on '{options.socket}'", file=sys.stderr
+            )
+            return 1
+
+    device = get_device(options)
+    load, lang = model_loader(options)
+    model = load_model(options, load, lang).to(device)
+    processor = Wav2Vec2Processor.from_pretrained(options.model_dir, target_lang=lang)
+
+    # so that the socket is removed when the recipe kills us
+    signal.signal(signal.SIGTERM, _raise_exit)
+    with DecodeServer(options, model, processor, device) as server:
+        try:
+            print(f"Listening on '{options.socket}'", file=sys.stderr)
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            options.socket.unlink(missing_ok=True)
+
+    return 0
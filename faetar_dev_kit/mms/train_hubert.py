@@ -36,13 +36,10 @@ from transformers import (
     TrainingArguments,
     Trainer,
 )
-from evaluate import load
-
+from ..scoring import error_rate
 from .args import Options
 from .data import load_partition
 
-wer_metric = load("wer")
-
 
 @dataclass
 class TrainingRoutines:
@@ -91,7 +88,9 @@ class TrainingRoutines:
         # we do not want to group tokens when computing the metrics
         label_str = self.processor.batch_decode(pred.label_ids, group_tokens=False)
 
-        wer = wer_metric.compute(predictions=pred_str, references=label_str)
+        wer = error_rate(
+            [x.split() for x in label_str], [x.split() for x in pred_str]
+        )
 
         return {"wer": wer}
 
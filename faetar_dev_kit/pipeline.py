@@ -0,0 +1,295 @@
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# A small runner of pipelines of steps whose outputs are keyed by their inputs.
+#
+# A step writes its output to a directory of its own, <root>/<name>/<key>, where the
+# key hashes the step's name, its parameters, the contents of its input files and
+# directories, and the keys of the steps it depends on. Changing any of those gives
+# the step, and every step downstream of it, a new key, so exactly the invalidated
+# part of a pipeline is run again and nothing stale is reused. Outputs are written to
+# a temporary directory and renamed once the step succeeds, so an output directory
+# which exists is complete.
+#
+# Steps run in threads (most just wait on a subprocess) as soon as their
+# dependencies are done and the resources they claim (e.g. {"cpu": 1, "gpu": 1})
+# fit within the runner's limits.
+
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import hashlib
+import threading
+import subprocess
+import concurrent.futures
+
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterable, Optional, Sequence, Union
+
+HASH_CHUNK_SIZE = 1 << 20
+MANIFEST = "step.json"
+LOG = "log.txt"
+
+
+@dataclass(eq=False)
+class Step:
+    """A step of a pipeline
+
+    action is called with the (temporary) directory to write the step's output to.
+    Input paths are keyed by their contents; directories by the names and contents of
+    the files directly in them (not of those in subdirectories).
+    """
+
+    name: str
+    action: Callable[[Path], None]
+    params: dict[str, Any] = field(default_factory=dict)
+    inputs: Sequence[Union[str, Path]] = ()
+    deps: Sequence["Step"] = ()
+    resources: dict[str, int] = field(default_factory=lambda: {"cpu": 1})
+
+    @property
+    def label(self) -> str:
+        return f"{self.name}({', '.join(f'{k}={v}' for k, v in self.params.items())})"
+
+
+class FileHasher(object):
+    """SHA-256 of files, cached in SQLite by path, size, and modification time"""
+
+    def __init__(self, db_path: Union[str, Path]):
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, sha256 TEXT)"
+        )
+        self.lock = threading.Lock()
+
+    def hash_file(self, pth: Union[str, Path]) -> str:
+        stat = os.stat(pth)
+        key = (os.path.abspath(pth), stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            row = self.db.execute(
+                "SELECT sha256 FROM file_hashes "
+                "WHERE path = ? AND size = ? AND mtime_ns = ?",
+                key,
+            ).fetchone()
+        if row is not None:
+            return row[0]
+        hash_ = hashlib.sha256()
+        with open(pth, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                hash_.update(chunk)
+        sha256 = hash_.hexdigest()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                key + (sha256,),
+            )
+            self.db.commit()
+        return sha256
+
+    def hash_path(self, pth: Union[str, Path]) -> str:
+        if not os.path.exists(pth):
+            raise FileNotFoundError(f"input '{pth}' does not exist")
+        if not os.path.isdir(pth):
+            return self.hash_file(pth)
+        hash_ = hashlib.sha256()
+        for entry in sorted(os.scandir(pth), key=lambda x: x.name):
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            hash_.update(f"{entry.name}\0{self.hash_file(entry.path)}\0".encode())
+        return hash_.hexdigest()
+
+    def close(self):
+        self.db.close()
+
+
+def run_command(args: Sequence[Union[str, Path]], out: Path, **kwargs):
+    """Run a command, appending its output to the log of step output out"""
+    with open(out / LOG, "ab") as log:
+        log.write(("$ " + " ".join(str(x) for x in args) + "\n").encode())
+        log.flush()
+        subprocess.run(
+            [str(x) for x in args],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            check=True,
+            **kwargs,
+        )
+
+
+def collect(targets: Iterable[Step]) -> list[Step]:
+    """targets and every step they depend on, dependencies first"""
+    order, seen = [], set()
+
+    def visit(step: Step):
+        if step in seen:
+            return
+        seen.add(step)
+        for dep in step.deps:
+            visit(dep)
+        order.append(step)
+
+    for step in targets:
+        visit(step)
+    return order
+
+
+class Runner(object):
+    """Runs steps, storing their outputs under root"""
+
+    def __init__(
+        self,
+        root: Union[str, Path],
+        resources: Optional[dict[str, int]] = None,
+        verbose: bool = True,
+    ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.resources = dict(resources or {"cpu": os.cpu_count() or 1})
+        self.verbose = verbose
+        self.hasher = FileHasher(self.root / "hashes.sqlite")
+        self._keys: dict[Step, str] = dict()
+        self._manifests: dict[Step, dict[str, Any]] = dict()
+
+    def key(self, step: Step) -> str:
+        key = self._keys.get(step)
+        if key is None:
+            # inputs are keyed by their contents alone, not where they are
+            manifest = self.manifest(step)
+            payload = dict(manifest, inputs=sorted(manifest["inputs"].values()))
+            key = hashlib.sha256(
+                json.dumps(payload, sort_keys=True, default=str).encode()
+            ).hexdigest()[:20]
+            self._keys[step] = key
+        return key
+
+    def manifest(self, step: Step) -> dict[str, Any]:
+        manifest = self._manifests.get(step)
+        if manifest is None:
+            manifest = self._manifests[step] = self._make_manifest(step)
+        return manifest
+
+    def _make_manifest(self, step: Step) -> dict[str, Any]:
+        return {
+            "name": step.name,
+            "params": step.params,
+            "inputs": dict(
+                (os.path.abspath(x), self.hasher.hash_path(x)) for x in step.inputs
+            ),
+            "deps": dict(
+                (f"{dep.name}/{self.key(dep)}", dep.label) for dep in step.deps
+            ),
+        }
+
+    def path(self, step: Step) -> Path:
+        """The directory a step's output is (or will be) in"""
+        return (self.root / step.name / self.key(step)).resolve()
+
+    def is_done(self, step: Step) -> bool:
+        return self.path(step).is_dir()
+
+    def _claim(self, step: Step) -> dict[str, int]:
+        # a step asking for more than the limit gets all of it rather than never running
+        return dict(
+            (name, min(num, self.resources.get(name, num)))
+            for name, num in step.resources.items()
+        )
+
+    def _execute(self, step: Step) -> Path:
+        final = self.path(step)
+        tmp = final.with_name(f"{final.name}.tmp{os.getpid()}")
+        if tmp.exists():
+            shutil.rmtree(tmp)
+        tmp.mkdir(parents=True)
+        with open(tmp / MANIFEST, "w") as f:
+            json.dump(self.manifest(step), f, indent=2, sort_keys=True, default=str)
+        try:
+            step.action(tmp)
+        except BaseException:
+            # keep the log, but where it can't be mistaken for an output
+            if (tmp / LOG).is_file():
+                shutil.copy(tmp / LOG, final.with_name(f"{final.name}.failed.log"))
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        os.replace(tmp, final)
+        final.with_name(f"{final.name}.failed.log").unlink(missing_ok=True)
+        return final
+
+    def plan(self, targets: Iterable[Step]) -> list[Step]:
+        """The steps which running targets would run, in order"""
+        return [step for step in collect(targets) if not self.is_done(step)]
+
+    def run(self, targets: Iterable[Step]) -> int:
+        """Run targets and their dependencies which aren't done, returning # failed"""
+        pending = self.plan(targets)
+        total, started = len(pending), 0
+        free = dict(self.resources)
+        failed: set[Step] = set()
+        running: dict[concurrent.futures.Future, Step] = dict()
+        with concurrent.futures.ThreadPoolExecutor(max(total, 1)) as pool:
+            while pending or running:
+                for step in list(pending):
+                    if any(dep in failed for dep in step.deps):
+                        pending.remove(step)
+                        failed.add(step)
+                        self._log(f"skipping {step.label}: a dependency failed")
+                        continue
+                    if not all(self.is_done(dep) for dep in step.deps):
+                        continue
+                    claim = self._claim(step)
+                    if any(free.get(name, num) < num for name, num in claim.items()):
+                        continue
+                    for name, num in claim.items():
+                        if name in free:
+                            free[name] -= num
+                    pending.remove(step)
+                    started += 1
+                    self._log(f"[{started}/{total}] {step.label} -> {self.path(step)}")
+                    running[pool.submit(self._execute, step)] = step
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    step = running.pop(future)
+                    for name, num in self._claim(step).items():
+                        if name in free:
+                            free[name] += num
+                    exc = future.exception()
+                    if exc is not None:
+                        failed.add(step)
+                        log = self.path(step).with_name(f"{self.key(step)}.failed.log")
+                        self._log(f"{step.label} failed: {exc}. See '{log}'")
+        return len(failed)
+
+    def link(self, step: Step, pth: Union[str, Path]):
+        """Point a symbolic link at pth to the output of step"""
+        pth = Path(pth)
+        pth.parent.mkdir(parents=True, exist_ok=True)
+        tmp = pth.with_name(f".{pth.name}.tmp{os.getpid()}")
+        if tmp.is_symlink():
+            tmp.unlink()
+        tmp.symlink_to(self.path(step), target_is_directory=True)
+        os.replace(tmp, pth)
+
+    def close(self):
+        self.hasher.close()
+
+    def _log(self, msg: str):
+        if self.verbose:
+            print(msg, file=sys.stderr, flush=True)
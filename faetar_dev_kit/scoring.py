@@ -0,0 +1,278 @@
+#! /usr/bin/env python
+
+# Copyright 2024 Sean Robertson, Michael Ong
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Batched Levenshtein alignment of token sequences with NumPy.
+#
+# Tokens are interned to integers and utterances of similar lengths are padded into
+# batches. The edit distance matrices of a batch are filled one reference token (row)
+# at a time for every utterance and hypothesis token at once. Within a row, the
+# chain of insertions is resolved without a loop: with T[j] the best cost of cell j
+# from the row above (a match, substitution, or deletion),
+#
+#   D[j] = min_{k <= j} T[k] + (j - k) = cummin(T - j) + j
+#
+# Substitution, insertion, and deletion counts are carried along with the costs, so
+# each utterance's counts are those of a minimum-cost alignment. When alignments
+# tie, the counts may be split between error types differently than jiwer splits
+# them, but their sum, the edit distance, is the same.
+#
+# Run as "python3 -m faetar_dev_kit.scoring" to benchmark against jiwer on random
+# utterances.
+
+import re
+import sys
+import time
+import argparse
+
+from itertools import chain
+from typing import Iterable, Optional, Sequence, Union
+
+import numpy as np
+
+SUB, INS, DEL = 0, 1, 2
+BATCH_SIZE = 512
+BRACKETED_PATTERN = re.compile(r"\[[^]][^]]*\]|<[^>][^>]*> ")
+PHONE_PATTERN = re.compile(r"d[zʒ]ː|t[sʃ]ː|d[zʒ]|t[sʃ]|\Sː|\S")
+
+Tokens = Union[Sequence[str], np.ndarray]
+
+
+class Interner(object):
+    """Maps tokens to consecutive integers, assigning new ones as they're seen"""
+
+    def __init__(self):
+        self.ids: dict[str, int] = dict()
+
+    def __call__(self, tokens: Tokens) -> np.ndarray:
+        flat, _ = self.intern_all([tokens])
+        return flat
+
+    def intern_all(self, seqs: Iterable[Tokens]) -> tuple[np.ndarray, np.ndarray]:
+        """Intern sequences of tokens, returning their concatenated ids and lengths
+
+        Sequences which are integer arrays already are taken as ids.
+        """
+        seqs = list(seqs)
+        lens = np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs))
+        if seqs and all(
+            isinstance(x, np.ndarray) and x.dtype.kind in "iu" for x in seqs
+        ):
+            return np.concatenate(seqs).astype(np.int32, copy=False), lens
+        flat = list(chain.from_iterable(seqs))
+        ids = self.ids
+        for token in sorted(set(flat).difference(ids)):
+            ids[token] = len(ids)
+        return np.fromiter(map(ids.__getitem__, flat), np.int32, len(flat)), lens
+
+
+def tokenize(text: str, error_type: str = "wer") -> list[str]:
+    """Split text into the tokens of an error type, as evaluate_asr.sh does
+
+    Bracketed tokens ("[fp]", "<unk> ") are removed. "wer" tokens are words, "cer"
+    tokens characters (with "_" between words), and "per" tokens phones.
+    """
+    words = BRACKETED_PATTERN.sub("", text).split()
+    if error_type == "wer":
+        return words
+    elif error_type == "cer":
+        return list("_".join(words))
+    elif error_type == "per":
+        return PHONE_PATTERN.findall("".join(words))
+    raise ValueError(f"invalid error type '{error_type}'")
+
+
+def _edit_counts_batch(
+    refs: np.ndarray, ref_lens: np.ndarray, hyps: np.ndarray, hyp_lens: np.ndarray
+) -> np.ndarray:
+    # An alignment's cost and its insertion and deletion counts are packed into one
+    # integer (its substitutions being the rest of its cost) so that edits are
+    # additions and the cheapest alignment, with the fewest insertions then deletions
+    # on ties, is the minimum. Counts fit in 10 bits, and all of them in an int32,
+    # unless some utterance's reference and hypothesis are 1024 tokens or longer
+    bits, dtype = 10, np.int32
+    if len(ref_lens) and (ref_lens + hyp_lens).max() >= 1 << bits:
+        bits, dtype = 21, np.int64
+    cost_, ins_, del_, mask = 1 << (2 * bits), 1 << bits, 1, (1 << bits) - 1
+    num, max_hyp_len = hyps.shape
+    rows = np.arange(num)
+    inserts = np.arange(max_hyp_len + 1, dtype=dtype) * dtype(cost_ + ins_)
+    # the first row: every hypothesis token is an insertion
+    packed = np.tile(inserts, (num, 1))
+    final = packed[rows, hyp_lens]
+    best = np.empty_like(packed)
+    for i in range(1, refs.shape[1] + 1):
+        # a match or substitution from the diagonal, or a deletion from above
+        best[:, 0] = packed[:, 0] + dtype(cost_ + del_)
+        np.minimum(
+            packed[:, :-1] + (refs[:, i - 1, None] != hyps) * dtype(cost_),
+            packed[:, 1:] + dtype(cost_ + del_),
+            out=best[:, 1:],
+        )
+        # then the chain of insertions from the left
+        best -= inserts
+        np.minimum.accumulate(best, axis=1, out=packed)
+        packed += inserts
+        done = ref_lens == i
+        if done.any():
+            final[done] = packed[rows[done], hyp_lens[done]]
+    final = final.astype(np.int64)
+    cost, ins = final >> (2 * bits), (final >> bits) & mask
+    dels = final & mask
+    counts = np.empty((num, 3), dtype=np.int64)
+    counts[:, SUB], counts[:, INS], counts[:, DEL] = cost - ins - dels, ins, dels
+    return counts
+
+
+def _pad(
+    flat: np.ndarray, offsets: np.ndarray, lens: np.ndarray, fill: int
+) -> np.ndarray:
+    """Gather the sequences starting at offsets in flat into a padded matrix"""
+    cols = np.arange(lens.max(initial=0))
+    valid = cols < lens[:, None]
+    idx = np.where(valid, offsets[:, None] + cols, 0)
+    return np.where(valid, flat[idx] if len(flat) else fill, fill).astype(np.int32)
+
+
+def edit_counts(
+    refs: Iterable[Tokens],
+    hyps: Iterable[Tokens],
+    interner: Optional[Interner] = None,
+    batch_size: int = BATCH_SIZE,
+) -> np.ndarray:
+    """Per-utterance substitution, insertion, and deletion counts
+
+    refs and hyps are sequences of tokens (or of integer arrays). Returns an array of
+    shape (N, 3) whose columns are indexed by SUB, INS, and DEL.
+    """
+    if interner is None:
+        interner = Interner()
+    refs, ref_lens = interner.intern_all(refs)
+    hyps, hyp_lens = interner.intern_all(hyps)
+    if len(ref_lens) != len(hyp_lens):
+        raise ValueError(f"{len(ref_lens)} references but {len(hyp_lens)} hypotheses")
+    ref_offsets = np.cumsum(ref_lens) - ref_lens
+    hyp_offsets = np.cumsum(hyp_lens) - hyp_lens
+    counts = np.zeros((len(ref_lens), 3), dtype=np.int64)
+    # batch utterances of similar lengths together to keep padding down
+    order = np.lexsort((hyp_lens, ref_lens))
+    for start in range(0, len(order), batch_size):
+        idx = order[start : start + batch_size]
+        counts[idx] = _edit_counts_batch(
+            _pad(refs, ref_offsets[idx], ref_lens[idx], -1),
+            ref_lens[idx],
+            _pad(hyps, hyp_offsets[idx], hyp_lens[idx], -2),
+            hyp_lens[idx],
+        )
+    return counts
+
+
+def error_rate(
+    refs: Sequence[Tokens], hyps: Sequence[Tokens], interner: Optional[Interner] = None
+) -> float:
+    """Total edits over total reference tokens"""
+    num_ref_tokens = sum(len(x) for x in refs)
+    return edit_counts(refs, hyps, interner).sum() / max(num_ref_tokens, 1)
+
+
+def random_utterances(
+    num: int, vocab_size: int, mean_len: float, error_prob: float, seed: int = 0
+) -> tuple[list[np.ndarray], list[np.ndarray]]:
+    """Random reference and hypothesis token id sequences for benchmarking"""
+    rng = np.random.default_rng(seed)
+    refs, hyps = [], []
+    for ref_len in rng.poisson(mean_len, num):
+        ref = rng.integers(vocab_size, size=ref_len)
+        ops = rng.choice(4, size=ref_len, p=[1 - error_prob] + [error_prob / 3] * 3)
+        hyp = []
+        for token, op in zip(ref.tolist(), ops.tolist()):
+            if op == 1:  # substitution
+                hyp.append((token + 1) % vocab_size)
+            elif op == 2:  # insertion
+                hyp += [token, int(rng.integers(vocab_size))]
+            elif op == 0:
+                hyp.append(token)
+        refs.append(ref.astype(np.int32))
+        hyps.append(np.array(hyp, dtype=np.int32))
+    return refs, hyps
+
+
+def main(args: Optional[Sequence[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark batched alignment against jiwer on random utterances"
+    )
+    parser.add_argument(
+        "-n", "--num-utts", type=int, default=100_000, help="Number of utterances"
+    )
+    parser.add_argument(
+        "-v", "--vocab-size", type=int, default=50, help="Number of distinct tokens"
+    )
+    parser.add_argument(
+        "-l", "--mean-len", type=float, default=30, help="Mean reference length"
+    )
+    parser.add_argument(
+        "-e", "--error-prob", type=float, default=0.2, help="Per-token error rate"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    options = parser.parse_args(args)
+
+    refs, hyps = random_utterances(
+        options.num_utts,
+        options.vocab_size,
+        options.mean_len,
+        options.error_prob,
+        options.seed,
+    )
+    words = [f"w{x}" for x in range(options.vocab_size)]
+    ref_strs = [" ".join(words[x] for x in ref) for ref in refs]
+    hyp_strs = [" ".join(words[x] for x in hyp) for hyp in hyps]
+    num_ref_tokens = sum(len(x) for x in refs)
+    print(
+        f"{options.num_utts} utterances, {num_ref_tokens} reference tokens",
+        file=sys.stderr,
+    )
+
+    start = time.perf_counter()
+    counts = edit_counts([x.split() for x in ref_strs], [x.split() for x in hyp_strs])
+    elapsed = time.perf_counter() - start
+    print(
+        f"scoring: {elapsed:.2f}s, error rate {counts.sum() / num_ref_tokens:.4%} "
+        f"(S {counts[:, SUB].sum()}, I {counts[:, INS].sum()}, "
+        f"D {counts[:, DEL].sum()})"
+    )
+
+    try:
+        import jiwer
+    except ImportError:
+        print("jiwer is not installed; not comparing", file=sys.stderr)
+        return 0
+    start = time.perf_counter()
+    ref_out = jiwer.process_words(ref_strs, hyp_strs)
+    jiwer_elapsed = time.perf_counter() - start
+    jiwer_edits = ref_out.substitutions + ref_out.insertions + ref_out.deletions
+    print(
+        f"jiwer: {jiwer_elapsed:.2f}s, error rate {ref_out.wer:.4%} "
+        f"(S {ref_out.substitutions}, I {ref_out.insertions}, "
+        f"D {ref_out.deletions})"
+    )
+    print(f"speedup: {jiwer_elapsed / elapsed:.1f}x")
+    if jiwer_edits != counts.sum():
+        print("total edits differ from jiwer's!", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
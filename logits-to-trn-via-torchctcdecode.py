@@ -14,12 +14,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import sys
+import json
+import time
 import argparse
+import itertools
+import multiprocessing
 
 from pathlib import Path
-from typing import Optional, Sequence, TextIO
+from typing import Any, Iterator, Optional, Sequence, TextIO
 import warnings
 
+import numpy as np
 import torch
 from torchaudio.models.decoder import ctc_decoder
 
@@ -27,8 +33,20 @@ from pyctcdecode import build_ctcdecoder
 from pyctcdecode.alphabet import BLANK_TOKEN_PTN
 from pyctcdecode.constants import DEFAULT_BEAM_WIDTH, DEFAULT_ALPHA, DEFAULT_BETA
 
+from faetar_dev_kit.scoring import Interner, edit_counts, tokenize
+from faetar_dev_kit.mms.logits import (
+    MIN_BLANK_THRESHOLD,
+    LogitsReader,
+    greedy_ids_batch,
+    is_logits_store,
+    kept_frames,
+    log_softmax,
+)
+
 BLANK_TOKEN = "<pad>"
 UNK_TOKEN = "<unk>"
+DEFAULT_LEXICON = Path(__file__).resolve().parent / "etc" / "lm_words_torchaudio.txt"
+SWEEP_CHUNK = 16
 
 DESCRIPTION = """Decode logits in folder using pyctcdecode
 
@@ -36,6 +54,10 @@ Intended to be used in concert with "asr-baseline.py decode --write-logits", thi
 script decodes all PyTorch data files in a flat directory into hypothesis transcriptions
 using pyctcdecode (https://github.com/kensho-technologies/pyctcdecode).
 
+The logit directory may instead be a logits store, as written by "mms.py decode
+--logits-format store". Stores are read by memory-mapping each utterance's logits;
+--file-prefix and --file-suffix are ignored.
+
 pyctcdecode is intended for character or subword-level ASR systems. The type of system
 must be specified with either the "--char" or "--bpe" flag. Unlike the vanilla
 prefix search of asr-baseline.py in which the mixed LM is assumed to be of the same
@@ -48,8 +70,534 @@ hyperparameters influencing the search: "--alpha" and "--beta". "--alpha" contro
 weight of the LM prediction (higher = more) while "--beta" is a "length score
 adjustment". Documentation is minimal
 (https://github.com/kensho-technologies/pyctcdecode/issues/16).
+
+With "--batch-size N" for N > 0, utterances are decoded by N worker processes, each of
+which builds the decoder (and loads the LM and lexicon) once. Utterances are handed
+out longest first so that no worker is left with a long utterance at the end, and
+hypotheses are written in the same (sorted) order as in the serial mode as soon as
+all those before them are done. "--benchmark" decodes everything both serially and
+in parallel and reports the throughput of each.
+
+The best hypothesis of each utterance is written to the trn file. "--nbest N" keeps
+the N best, which "--nbest-file" writes as JSON lines, one per utterance:
+
+    {"utt": ..., "hyps": [{"text": ..., "am": ..., "lm": ..., "total": ...}, ...]}
+
+"total" is the decoder's score of the hypothesis, "lm" the (log10) score KenLM gives
+its words (0 without an LM), and "am" the rest of the total once the weighted LM
+score and the word score "--beta" per word are taken out.
+
+"--sweep-dir DIR" decodes with every combination of the values of "--sweep-width",
+"--sweep-alpha", and "--sweep-beta" (each defaulting to the single value of "--width",
+"--alpha", or "--beta"), or with "--sweep-random N" of them drawn at random. The
+logits are read into memory once and the LM is loaded once and shared by the workers
+and, if torchaudio allows it, by the decoders of all configurations. Each
+configuration's best hypotheses are written to DIR/width<W>_alpha<A>_beta<B>.trn. If
+"--ref" is given a reference trn file, a table of the word and character error rates
+of each configuration is printed to stdout.
+
+Most frames are confidently blank, yet the search expands its beam on every one of
+them. "--blank-prune-threshold P" merges each run of frames whose blank probability
+is at least P into its first frame before decoding, as pruned logits stores do. A
+blank frame is left between the tokens on either side of a run, so a token repeated
+across it is still decoded twice. "--prune-report" decodes with and without pruning
+and reports the reduction in frames, the speedup, and how many hypotheses changed.
+
+"--greedy" skips the search (and needs neither an LM nor a lexicon), writing the
+best-path transcriptions of the logits: the most likely token of each frame, with
+repeats collapsed and blanks removed, as "mms.py decode" would have written them.
+This way greedy and beam search results come from the same acoustic model pass.
 """
 
+_decoder = None
+_reader: Optional[LogitsReader] = None
+_scorer: Optional["LMScorer"] = None
+_logits: list[np.ndarray] = []
+_sweep: tuple[dict[str, Any], list[dict[str, Any]]] = (dict(), [])
+_sweep_decoder: tuple[Optional[int], Any] = (None, None)
+_blank_prune: Optional[tuple[int, float]] = None
+
+Hypothesis = dict[str, Any]
+
+
+class LMScorer(object):
+    """Splits decoder scores into their acoustic and LM parts"""
+
+    def __init__(self, lm: Optional[str], lm_weight: float, word_score: float):
+        if lm is None:
+            self.model = None
+        else:
+            import kenlm
+
+            self.model = kenlm.Model(lm)
+        self.lm_weight, self.word_score = lm_weight, word_score
+
+    def __call__(self, words: Sequence[str], total: float) -> Hypothesis:
+        lm = 0.0
+        if self.model is not None:
+            lm = self.model.score(" ".join(words), bos=True, eos=True)
+        am = total - self.lm_weight * lm - self.word_score * len(words)
+        return {"am": am, "lm": lm, "total": total}
+
+
+def _load_scorer(decoder_kwargs: dict[str, Any], with_scores: bool):
+    global _scorer
+    # loaded before the workers are forked so that they share the LM's pages
+    _scorer = None
+    if with_scores:
+        _scorer = LMScorer(
+            decoder_kwargs["lm"],
+            decoder_kwargs["lm_weight"],
+            decoder_kwargs["word_score"],
+        )
+
+
+def _init_worker(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    blank_prune: Optional[tuple[int, float]] = None,
+):
+    global _decoder, _reader, _blank_prune
+    # each worker searches one utterance at a time; more threads only contend
+    torch.set_num_threads(1)
+    _decoder = ctc_decoder(**decoder_kwargs)
+    _reader = LogitsReader(logit_dir) if is_logits_store(logit_dir) else None
+    _blank_prune = blank_prune
+
+
+def list_utterances(
+    logit_dir: Path, fp: str, fs: str
+) -> list[tuple[str, Optional[Path], int]]:
+    """Utterances to decode as (utt, logit file or None for a store, size), sorted
+
+    The size of an utterance is its number of frames in a store and the size of its
+    file otherwise. Either is proportional to how long it takes to decode.
+    """
+    if is_logits_store(logit_dir):
+        reader = LogitsReader(logit_dir)
+        return [(utt, None, reader.num_frames(utt)) for utt in sorted(reader)]
+    utts = []
+    for logit_pth in sorted(logit_dir.iterdir()):
+        utt = logit_pth.name
+        if not logit_pth.is_file() or not utt.startswith(fp) or not utt.endswith(fs):
+            continue
+        utt = utt[len(fp) :]
+        if fs:
+            utt = utt[: -len(fs)]
+        utts.append((utt, logit_pth, logit_pth.stat().st_size))
+    return utts
+
+
+def load_logits(utt: str, logit_pth: Optional[Path]) -> np.ndarray:
+    if logit_pth is None:
+        return _reader[utt]
+    return torch.load(logit_pth).detach().float().numpy()
+
+
+def prune_blanks(
+    logits: np.ndarray, blank_prune: Optional[tuple[int, float]]
+) -> np.ndarray:
+    """Merge the runs of confident blanks in logits, given (blank id, threshold)
+
+    The frames kept are unchanged. Normalizing them would shift the scores of all
+    hypotheses equally.
+    """
+    if blank_prune is None:
+        return logits
+    logits = np.asarray(logits, dtype=np.float32)
+    return logits[kept_frames(log_softmax(logits), *blank_prune)]
+
+
+def decode_logits(
+    decoder, logits: np.ndarray, scorer: Optional[LMScorer] = None
+) -> list[Hypothesis]:
+    """The n-best hypotheses of one utterance's (frames, vocab) logits
+
+    The beam search is run once. Each hypothesis has its "text" and, if scorer is
+    set, its scores.
+    """
+    emissions = torch.as_tensor(np.array(logits, dtype=np.float32)).unsqueeze(0)
+    hyps = []
+    for hyp in decoder(emissions)[0]:
+        out = {"text": "".join(hyp.words).replace("_", " ").strip()}
+        if scorer is not None:
+            out.update(scorer(hyp.words, float(hyp.score)))
+        hyps.append(out)
+    return hyps
+
+
+def _decode_utterance(
+    job: tuple[int, str, Optional[Path]],
+) -> tuple[int, list[Hypothesis]]:
+    no, utt, logit_pth = job
+    logits = prune_blanks(load_logits(utt, logit_pth), _blank_prune)
+    return no, decode_logits(_decoder, logits, _scorer)
+
+
+def decode_serial(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    with_scores: bool = False,
+    blank_prune: Optional[tuple[int, float]] = None,
+) -> Iterator[tuple[int, list[Hypothesis]]]:
+    """Decode utts in this process, yielding (index in utts, hypotheses) in order"""
+    _load_scorer(decoder_kwargs, with_scores)
+    _init_worker(decoder_kwargs, logit_dir, blank_prune)
+    for no, (utt, logit_pth, _) in enumerate(utts):
+        yield _decode_utterance((no, utt, logit_pth))
+
+
+def decode_parallel(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    num_workers: int,
+    with_scores: bool = False,
+    blank_prune: Optional[tuple[int, float]] = None,
+) -> Iterator[tuple[int, list[Hypothesis]]]:
+    """Like decode_serial, but decoding over num_workers processes"""
+    jobs = sorted(
+        ((no, utt, logit_pth) for no, (utt, logit_pth, _) in enumerate(utts)),
+        key=lambda job: -utts[job[0]][2],
+    )
+    ctx = multiprocessing.get_context("fork")
+    done: dict[int, list[Hypothesis]] = dict()
+    next_no = 0
+    _load_scorer(decoder_kwargs, with_scores)
+    init_args = (decoder_kwargs, logit_dir, blank_prune)
+    with ctx.Pool(num_workers, _init_worker, init_args) as pool:
+        for no, hyps in pool.imap_unordered(_decode_utterance, jobs):
+            done[no] = hyps
+            # hold results back until all those before them are in
+            while next_no in done:
+                yield next_no, done.pop(next_no)
+                next_no += 1
+
+
+def decode(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    num_workers: int = 0,
+    with_scores: bool = False,
+    blank_prune: Optional[tuple[int, float]] = None,
+) -> Iterator[tuple[int, list[Hypothesis]]]:
+    """decode_parallel with num_workers workers, or decode_serial if it's 0"""
+    args = (decoder_kwargs, logit_dir, utts)
+    if num_workers:
+        return decode_parallel(*args, num_workers, with_scores, blank_prune)
+    return decode_serial(*args, with_scores, blank_prune)
+
+
+def write_hyps(
+    trn: TextIO,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    results: Iterator[tuple[int, list[Hypothesis]]],
+    nbest_file: Optional[TextIO] = None,
+):
+    """Write the best hypotheses to trn and, if set, all of them to nbest_file"""
+    for no, hyps in results:
+        utt = utts[no][0]
+        trn.write(f"{hyps[0]['text'] if hyps else ''} ({utt})\n")
+        if nbest_file is not None:
+            nbest_file.write(json.dumps({"utt": utt, "hyps": hyps}) + "\n")
+
+
+def benchmark(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    num_workers: int,
+    with_scores: bool = False,
+    blank_prune: Optional[tuple[int, float]] = None,
+) -> list[tuple[int, list[Hypothesis]]]:
+    """Decode utts serially and in parallel, reporting the throughput of each"""
+    args = (decoder_kwargs, logit_dir, utts)
+    runs = []
+    for mode, workers in (("serial", 0), (f"{num_workers} workers", num_workers)):
+        start = time.perf_counter()
+        results = list(decode(*args, workers, with_scores, blank_prune))
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        print(
+            f"{mode}: {elapsed:.2f}s, {len(utts) / elapsed:.2f} utterances/s",
+            file=sys.stderr,
+        )
+        runs.append((elapsed, results))
+    (serial_elapsed, serial), (parallel_elapsed, parallel) = runs
+    print(f"speedup: {serial_elapsed / parallel_elapsed:.2f}x", file=sys.stderr)
+    if serial != parallel:
+        num_diff = sum(x != y for x, y in zip(serial, parallel))
+        warnings.warn(f"{num_diff} utterances decoded differently in parallel")
+    return parallel
+
+
+def prune_report(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    num_workers: int,
+    with_scores: bool,
+    blank_prune: tuple[int, float],
+) -> list[tuple[int, list[Hypothesis]]]:
+    """Decode utts with and without blank pruning, reporting what pruning changes"""
+    global _reader
+    _reader = LogitsReader(logit_dir) if is_logits_store(logit_dir) else None
+    num_frames = num_kept = 0
+    for utt, logit_pth, _ in utts:
+        logits = load_logits(utt, logit_pth)
+        num_frames += len(logits)
+        num_kept += len(prune_blanks(logits, blank_prune))
+    print(
+        f"frames: {num_frames} -> {num_kept} "
+        f"({1 - num_kept / max(num_frames, 1):.1%} fewer)",
+        file=sys.stderr,
+    )
+    args = (decoder_kwargs, logit_dir, utts, num_workers, with_scores)
+    runs = []
+    for mode, prune in (("unpruned", None), ("pruned", blank_prune)):
+        start = time.perf_counter()
+        results = list(decode(*args, prune))
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        print(f"{mode}: {elapsed:.2f}s", file=sys.stderr)
+        runs.append((elapsed, results))
+    (unpruned_elapsed, unpruned), (pruned_elapsed, pruned) = runs
+    print(f"speedup: {unpruned_elapsed / pruned_elapsed:.2f}x", file=sys.stderr)
+    changed = [
+        utts[no][0]
+        for (no, x), (_, y) in zip(unpruned, pruned)
+        if [hyp["text"] for hyp in x[:1]] != [hyp["text"] for hyp in y[:1]]
+    ]
+    print(
+        f"best hypotheses changed: {len(changed)} of {len(utts)} utterances"
+        + (f" ({' '.join(changed)})" if changed else ""),
+        file=sys.stderr,
+    )
+    return pruned
+
+
+def load_shared_lm(decoder_kwargs: dict[str, Any]) -> Any:
+    """Load the LM of decoder_kwargs so that decoders can share it
+
+    ctc_decoder loads its LM from a path anew each time, but also accepts a loaded
+    one. That needs torchaudio's private KenLM wrapper; if it can't be imported, or
+    its signature has changed, the path is returned and each decoder loads its own
+    copy.
+    """
+    lm = decoder_kwargs["lm"]
+    if lm is None:
+        return None
+    try:
+        from torchaudio.models.decoder._ctc_decoder import (
+            _KenLM,
+            _get_word_dict,
+            _load_words,
+        )
+
+        # the decoder's word dictionary comes from the lexicon when there is one
+        lexicon = _load_words(decoder_kwargs["lexicon"])
+        return _KenLM(lm, _get_word_dict(lexicon, lm, None, None, UNK_TOKEN))
+    except (ImportError, TypeError, AttributeError):
+        return lm
+
+
+def sweep_configs(
+    widths: Sequence[int],
+    alphas: Sequence[float],
+    betas: Sequence[float],
+    num_random: Optional[int] = None,
+    seed: int = 0,
+) -> list[dict[str, Any]]:
+    """The grid of decoder settings, or num_random of them drawn without replacement"""
+    grid = [
+        dict(beam_size=width, lm_weight=alpha, word_score=beta)
+        for width, alpha, beta in itertools.product(widths, alphas, betas)
+    ]
+    if num_random is not None and num_random < len(grid):
+        idx = np.random.default_rng(seed).choice(len(grid), num_random, replace=False)
+        grid = [grid[i] for i in sorted(idx)]
+    return grid
+
+
+def config_name(config: dict[str, Any]) -> str:
+    return "width{}_alpha{:g}_beta{:g}".format(
+        config["beam_size"], config["lm_weight"], config["word_score"]
+    )
+
+
+def _decode_chunk(job: tuple[int, int, int]) -> tuple[int, int, list[str]]:
+    global _sweep_decoder
+    config_no, start, stop = job
+    # jobs are handed out config by config, so a worker rarely rebuilds its decoder
+    if _sweep_decoder[0] != config_no:
+        decoder_kwargs, configs = _sweep
+        _sweep_decoder = (
+            config_no,
+            ctc_decoder(**dict(decoder_kwargs, **configs[config_no])),
+        )
+    decoder = _sweep_decoder[1]
+    hyps = []
+    for logits in _logits[start:stop]:
+        nbest = decode_logits(decoder, logits)
+        hyps.append(nbest[0]["text"] if nbest else "")
+    return config_no, start, hyps
+
+
+def decode_sweep(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    configs: Sequence[dict[str, Any]],
+    num_workers: int,
+    blank_prune: Optional[tuple[int, float]] = None,
+) -> Iterator[tuple[int, list[str]]]:
+    """Decode utts with each of configs, yielding (config index, best hypotheses)
+
+    Configurations are yielded as they finish. Logits and the LM are loaded in this
+    process before the workers are forked so that they share them.
+    """
+    global _logits, _sweep, _sweep_decoder, _reader
+    _reader = LogitsReader(logit_dir) if is_logits_store(logit_dir) else None
+    _logits = [
+        np.array(prune_blanks(load_logits(utt, logit_pth), blank_prune), np.float32)
+        for utt, logit_pth, _ in utts
+    ]
+    _sweep = (dict(decoder_kwargs, lm=load_shared_lm(decoder_kwargs), nbest=1), configs)
+    _sweep_decoder = (None, None)
+    jobs = [
+        (config_no, start, min(start + SWEEP_CHUNK, len(utts)))
+        for config_no in range(len(configs))
+        for start in range(0, len(utts), SWEEP_CHUNK)
+    ]
+    hyps = [[""] * len(utts) for _ in configs]
+    num_left = [len(range(0, len(utts), SWEEP_CHUNK)) for _ in configs]
+    for config_no, num in enumerate(num_left):
+        if not num:
+            yield config_no, hyps[config_no]
+    if num_workers:
+        ctx = multiprocessing.get_context("fork")
+        pool = ctx.Pool(num_workers, torch.set_num_threads, (1,))
+        results = pool.imap_unordered(_decode_chunk, jobs)
+    else:
+        pool, results = None, map(_decode_chunk, jobs)
+    try:
+        for config_no, start, chunk in results:
+            hyps[config_no][start : start + len(chunk)] = chunk
+            num_left[config_no] -= 1
+            if not num_left[config_no]:
+                yield config_no, hyps[config_no]
+                hyps[config_no] = []
+    finally:
+        if pool is not None:
+            pool.terminate()
+        _logits = []
+
+
+def read_trn(trn_file: Path) -> dict[str, str]:
+    trn = dict()
+    with open(trn_file) as f:
+        for line in f:
+            fields = line.split()
+            if fields:
+                trn[fields[-1].strip("()")] = " ".join(fields[:-1])
+    return trn
+
+
+def sweep_error_rates(
+    refs: dict[str, str], utts: Sequence[str], hyps: Sequence[str]
+) -> dict[str, float]:
+    """Word and character error rates of hyps against refs, over the utts in refs"""
+    rates = dict()
+    for error_type in ("wer", "cer"):
+        pairs = [
+            (tokenize(refs[utt], error_type), tokenize(hyp, error_type))
+            for utt, hyp in zip(utts, hyps)
+            if utt in refs
+        ]
+        num_ref_tokens = sum(len(ref) for ref, _ in pairs)
+        counts = edit_counts(*zip(*pairs), Interner()) if pairs else np.zeros(3)
+        rates[error_type] = counts.sum() / max(num_ref_tokens, 1)
+    return rates
+
+
+def sweep(
+    decoder_kwargs: dict[str, Any],
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    configs: Sequence[dict[str, Any]],
+    num_workers: int,
+    sweep_dir: Path,
+    ref_trn: Optional[Path] = None,
+    blank_prune: Optional[tuple[int, float]] = None,
+):
+    """Decode with each of configs, writing trn files and, given refs, an error table"""
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+    refs, names = None, [utt for utt, _, _ in utts]
+    if ref_trn is not None:
+        refs = read_trn(ref_trn)
+        missing = len(set(names) - refs.keys())
+        if missing:
+            warnings.warn(
+                f"{missing} utterances are not in '{ref_trn}' and won't be scored"
+            )
+    rates = dict()
+    for config_no, hyps in decode_sweep(
+        decoder_kwargs, logit_dir, utts, configs, num_workers, blank_prune
+    ):
+        name = config_name(configs[config_no])
+        with open(sweep_dir / f"{name}.trn", "w") as f:
+            for utt, hyp in zip(names, hyps):
+                f.write(f"{hyp} ({utt})\n")
+        if refs is not None:
+            rates[config_no] = sweep_error_rates(refs, names, hyps)
+            print(
+                f"{name}: wer {rates[config_no]['wer']:.2%}, "
+                f"cer {rates[config_no]['cer']:.2%}",
+                file=sys.stderr,
+            )
+        else:
+            print(f"{name}: done", file=sys.stderr)
+    if refs is None:
+        return
+    print("width\talpha\tbeta\twer\tcer")
+    for config_no, config in enumerate(configs):
+        print(
+            "{}\t{:g}\t{:g}\t{:.2%}\t{:.2%}".format(
+                config["beam_size"],
+                config["lm_weight"],
+                config["word_score"],
+                rates[config_no]["wer"],
+                rates[config_no]["cer"],
+            )
+        )
+    best = min(range(len(configs)), key=lambda config_no: rates[config_no]["wer"])
+    print(f"best (wer): {config_name(configs[best])}")
+
+
+def greedy_texts(
+    paths: Sequence[np.ndarray], vocab: Sequence[str], blank_id: int
+) -> list[str]:
+    """Best-path transcriptions of the per-frame argmax ids of many utterances"""
+    vocab = np.array(vocab, dtype=object)
+    return [
+        " ".join("".join(vocab[ids]).replace("\u2581", " ").replace("_", " ").split())
+        for ids in greedy_ids_batch(paths, blank_id)
+    ]
+
+
+def write_greedy(
+    trn: TextIO,
+    logit_dir: Path,
+    utts: Sequence[tuple[str, Optional[Path], int]],
+    vocab: Sequence[str],
+    blank_id: int,
+):
+    global _reader
+    _reader = LogitsReader(logit_dir) if is_logits_store(logit_dir) else None
+    paths = [load_logits(utt, logit_pth).argmax(1) for utt, logit_pth, _ in utts]
+    for (utt, _, _), text in zip(utts, greedy_texts(paths, vocab, blank_id)):
+        trn.write(f"{text} ({utt})\n")
+
 
 def main(args: Optional[Sequence[str]] = None):
     parser = argparse.ArgumentParser(
@@ -75,13 +623,102 @@ def main(args: Optional[Sequence[str]] = None):
         default=None,
         help="Path to list of words, one per line",
     )
+    lex_arg = parser.add_argument(
+        "--lexicon",
+        type=Path,
+        default=DEFAULT_LEXICON,
+        help="Path to torchaudio lexicon file, mapping words to their spellings",
+    )
     width_arg = parser.add_argument("--width", type=int, default=DEFAULT_BEAM_WIDTH)
+    nbest_arg = parser.add_argument(
+        "--nbest",
+        type=int,
+        default=1,
+        help="Number of hypotheses to keep per utterance",
+    )
+    parser.add_argument(
+        "--nbest-file",
+        type=argparse.FileType("w"),
+        default=None,
+        help="Where to write the n-best hypotheses and their scores, as JSON lines",
+    )
     beta_arg = parser.add_argument("--beta", type=float, default=DEFAULT_BETA)
     batch_arg = parser.add_argument(
         "--batch-size",
         type=int,
         default=0,
-        help="Number of utterances to process simultaneously. Default (0) is serial",
+        help="Number of worker processes decoding utterances simultaneously. "
+        "Default (0) is serial",
+    )
+    parser.add_argument(
+        "--sweep-dir",
+        type=Path,
+        default=None,
+        help="Decode with a sweep of settings, writing a trn file per setting here",
+    )
+    parser.add_argument(
+        "--sweep-width",
+        type=int,
+        nargs="+",
+        default=None,
+        help="Beam widths to sweep. Defaults to --width",
+    )
+    parser.add_argument(
+        "--sweep-alpha",
+        type=float,
+        nargs="+",
+        default=None,
+        help="LM weights to sweep. Defaults to --alpha",
+    )
+    parser.add_argument(
+        "--sweep-beta",
+        type=float,
+        nargs="+",
+        default=None,
+        help="Word scores to sweep. Defaults to --beta",
+    )
+    sweep_random_arg = parser.add_argument(
+        "--sweep-random",
+        type=int,
+        default=None,
+        help="Decode with this many settings drawn at random from the sweep's grid",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of --sweep-random's draws"
+    )
+    ref_arg = parser.add_argument(
+        "--ref",
+        type=Path,
+        default=None,
+        help="Reference trn file to score the sweep's settings against",
+    )
+    prune_arg = parser.add_argument(
+        "--blank-prune-threshold",
+        type=float,
+        default=None,
+        help="Merge runs of frames whose blank probability is at least this before "
+        f"decoding. Must be in [{MIN_BLANK_THRESHOLD}, 1], so that merged frames are "
+        "all greedy blanks",
+    )
+    parser.add_argument(
+        "--prune-report",
+        action="store_true",
+        default=False,
+        help="Decode with and without --blank-prune-threshold, reporting the "
+        "reduction in frames, the speedup, and changes to the hypotheses to stderr",
+    )
+    parser.add_argument(
+        "--greedy",
+        action="store_true",
+        default=False,
+        help="Write best-path transcriptions instead of searching",
+    )
+    parser.add_argument(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="Decode both serially and with --batch-size workers, reporting the "
+        "throughput of each to stderr",
     )
 
     style_group = parser.add_mutually_exclusive_group(required=True)
@@ -111,7 +748,9 @@ def main(args: Optional[Sequence[str]] = None):
         help="Path to token2id.txt file, mapping tokens to integer ids",
     )
 
-    ldir_arg = parser.add_argument("logit_dir", type=Path, help="Logit directory")
+    ldir_arg = parser.add_argument(
+        "logit_dir", type=Path, help="Logit directory or logits store"
+    )
     parser.add_argument(
         "trn",
         nargs="?",
@@ -145,6 +784,9 @@ def main(args: Optional[Sequence[str]] = None):
     if width <= 0:
         raise argparse.ArgumentError(width_arg, "is negative")
 
+    if options.nbest <= 0:
+        raise argparse.ArgumentError(nbest_arg, "is non-positive")
+
     if options.alpha_inv is not None:
         if options.alpha_inv <= 0:
             raise argparse.ArgumentError(ainv_arg, "is non-positive")
@@ -154,6 +796,30 @@ def main(args: Optional[Sequence[str]] = None):
 
     if batch_size < 0:
         raise argparse.ArgumentError(batch_arg, "is negative")
+    elif options.benchmark and not batch_size:
+        raise argparse.ArgumentError(batch_arg, "must be positive with --benchmark")
+
+    if not options.greedy and not options.lexicon.is_file():
+        raise argparse.ArgumentError(lex_arg, "is not a file")
+
+    if options.sweep_width is not None and min(options.sweep_width) <= 0:
+        raise argparse.ArgumentError(width_arg, "--sweep-width is non-positive")
+
+    if options.sweep_random is not None and options.sweep_random <= 0:
+        raise argparse.ArgumentError(sweep_random_arg, "is non-positive")
+
+    if options.ref is not None and not options.ref.is_file():
+        raise argparse.ArgumentError(ref_arg, "is not a file")
+
+    if options.blank_prune_threshold is not None:
+        if not MIN_BLANK_THRESHOLD <= options.blank_prune_threshold <= 1:
+            raise argparse.ArgumentError(
+                prune_arg, f"is not in [{MIN_BLANK_THRESHOLD}, 1]"
+            )
+    elif options.prune_report:
+        raise argparse.ArgumentError(prune_arg, "must be set with --prune-report")
+    if options.prune_report and options.benchmark:
+        raise argparse.ArgumentError(batch_arg, "--benchmark and --prune-report clash")
 
     if not logit_dir.is_dir():
         raise argparse.ArgumentError(ldir_arg, "not a directory")
@@ -229,57 +895,57 @@ def main(args: Optional[Sequence[str]] = None):
             )
             vocab.append(blank_token)
 
-    decoder = ctc_decoder(
+    utts = list_utterances(logit_dir, fp, fs)
+    if options.greedy:
+        write_greedy(trn, logit_dir, utts, vocab, vocab.index(blank_token))
+        return
+
+    decoder_kwargs = dict(
         tokens=vocab,
         lm=lm,
         beam_size=width,
-        lexicon="/home/michael/faetar/faetar-dev-kit/etc/lm_words_torchaudio.txt",
-        nbest=5,
+        lexicon=str(options.lexicon),
+        nbest=options.nbest,
         lm_weight=alpha,
         word_score=beta,
         blank_token=blank_token,
-        sil_token="[PAD]"
+        sil_token="[PAD]",
     )
 
-    pool = None
-    if batch_size:
-        try:
-            pool = torch.multiprocessing.get_context("fork").Pool(processes=batch_size)
-        except:
-            pass
-
-    utt_batch: list[str] = []
-    logit_batch: list[torch.Tensor] = []
-
-    def decode():
-        if pool and len(utt_batch):
-            hyp_batch = decoder.decode_batch(pool, logit_batch, width)
-            assert len(utt_batch) == len(hyp_batch)
-            for utt, hyp in zip(utt_batch, hyp_batch):
-                trn.write(f"{hyp.strip()} ({utt})\n")
-        else:
-            assert len(utt_batch) == len(logit_batch)
-            for utt, logits in zip(utt_batch, logit_batch):
-                loaded_logit = torch.as_tensor(logits).contiguous().unsqueeze(0)
-                for i in range(5):
-                    hyp = "".join(decoder(loaded_logit)[0][i].words).replace("_", " ")
-                    trn.write(f"{i} {hyp.strip()} ({utt})\n")
-        utt_batch.clear()
-        logit_batch.clear()
-
-    for logit_pth in sorted(logit_dir.iterdir()):
-        utt = logit_pth.name
-        if not logit_pth.is_file() or not utt.startswith(fp) or not utt.endswith(fs):
-            continue
-        utt = utt[len(fp) :]
-        if fs:
-            utt = utt[: -len(fs)]
-        logits = torch.load(logit_pth)
-        utt_batch.append(utt)
-        logit_batch.append(logits.detach().numpy())
-        if len(utt_batch) > batch_size:
-            decode()
-    decode()
+    blank_prune = None
+    if options.blank_prune_threshold is not None:
+        blank_prune = (vocab.index(blank_token), options.blank_prune_threshold)
+
+    if options.sweep_dir is not None:
+        configs = sweep_configs(
+            options.sweep_width or [width],
+            options.sweep_alpha or [alpha],
+            options.sweep_beta or [beta],
+            options.sweep_random,
+            options.seed,
+        )
+        sweep(
+            decoder_kwargs,
+            logit_dir,
+            utts,
+            configs,
+            batch_size,
+            options.sweep_dir,
+            options.ref,
+            blank_prune,
+        )
+        return
+
+    nbest_file: Optional[TextIO] = options.nbest_file
+    with_scores = nbest_file is not None
+    args = (decoder_kwargs, logit_dir, utts, batch_size, with_scores, blank_prune)
+    if options.benchmark:
+        results = iter(benchmark(*args))
+    elif options.prune_report:
+        results = iter(prune_report(*args))
+    else:
+        results = decode(*args)
+    write_hyps(trn, utts, results, nbest_file)
 
 
 if __name__ == "__main__":
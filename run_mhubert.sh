@@ -163,7 +163,22 @@ fi
 
 if [ "$lm_ord" = 0 ]; then
     for part in "${dec_partitions[@]}"; do
-        if  ! [ -f "$exp/decode/${part}_greedy.trn" ]; then
+        if [ -f "$exp/decode/${part}_greedy.trn" ]; then
+            continue
+        fi
+        if [ -f "$exp/decode/logits/$part/.done" ]; then
+            # reuse the logits of an earlier beam search instead of the model
+            if ! [ -f "$exp/token2id" ]; then
+                echo "Constructing '$exp/token2id'"
+                ./mms.py vocab-to-token2id "$exp/"{vocab.json,token2id}
+            fi
+            echo "Greedily decoding logits of '$data/$part'"
+            python3 ./logits-to-trn-via-torchctcdecode.py \
+                --greedy --char \
+                --token2id "$exp/token2id" \
+                "$exp/decode/"{logits/$part,${part}_greedy.trn_}
+            mv "$exp/decode/${part}_greedy.trn"{_,}
+        else
             echo "Greedily decoding '$data/$part'"
             mkdir -p "$exp/decode"
             ./mms.py decode-hubert \
@@ -172,8 +187,8 @@ if [ "$lm_ord" = 0 ]; then
             ./mms.py metadata-to-trn \
                 "$exp/decode/${part}_greedy."{csv,trn_}
             mv "$exp/decode/${part}_greedy.trn"{_,}
-            if $only; then exit 0; fi
         fi
+        if $only; then exit 0; fi
     done
 else
 
@@ -188,7 +203,7 @@ else
             echo "Dumping logits of '$data/$part'"
             mkdir -p "$exp/decode/logits/$part"
             ./mms.py decode-hubert \
-                --dump-logits "$exp/decode/logits/$part" \
+                --logits-dir "$exp/decode/logits/$part" \
                 "$exp" "$data/$part" "/dev/null"
             touch "$exp/decode/logits/$part/.done"
             if $only; then exit 0; fi